@@ -0,0 +1,20 @@
+#version 150
+
+// Same lighting as the fixed-function path: texture * baked brightness * (ambient + directional)
+
+uniform sampler2D p3d_Texture0;
+uniform vec3 sun_direction;     // direction the directional light shines in
+uniform vec3 sun_color;
+uniform vec3 ambient_color;
+
+in vec2 texcoord;
+in vec3 normal;
+in float brightness;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    vec4 color = texture(p3d_Texture0, texcoord);
+    vec3 light = ambient_color + sun_color * max(dot(normal, -sun_direction), 0.0);
+    p3d_FragColor = vec4(color.rgb * light * brightness, color.a);
+}
@@ -0,0 +1,36 @@
+#version 150
+
+// Decodes the compact terrain vertex layout of chunk_mesher.compact_vertices.
+// Positions are relative to the node, which is placed at the mesh origin.
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+in vec4 compact_position;       // x, y, z, face index
+in vec4 compact_attribute;      // atlas tile x, tile y, corner index, baked brightness
+
+out vec2 texcoord;
+out vec3 normal;
+out float brightness;
+
+const vec3 face_normals[6] = vec3[6](
+    vec3(0, 0, -1), vec3(0, 0, 1), vec3(0, -1, 0), vec3(0, 1, 0), vec3(-1, 0, 0), vec3(1, 0, 0));
+
+// atlas layout, see chunk_mesher.tile_uvs
+const float atlas_res = 90.0;
+const float tile_full_res = 18.0;
+const float inner_res = 16.0;
+const float padding = 1.0;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * vec4(compact_position.xyz, 1.0);
+    normal = face_normals[int(compact_position.w + 0.5)];
+
+    vec2 pixel = compact_attribute.xy * tile_full_res + padding;
+    vec2 uv_start = (pixel + 0.5) / atlas_res;
+    vec2 uv_end = (pixel + inner_res - 0.7) / atlas_res;
+    // corners in the order (start, start), (start, end), (end, end), (end, start)
+    int corner = int(compact_attribute.z + 0.5);
+    texcoord = vec2(corner >= 2 ? uv_end.x : uv_start.x, (corner == 1 || corner == 2) ? uv_end.y : uv_start.y);
+
+    brightness = compact_attribute.w / 255.0;
+}
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from panda3d.core import LVector3, NodePath
+
+from cell import *
+
+
+# Cell construction as it was before the cell-type registry: every cell parsed its hex color,
+# built its own Geom and NodePath and kept an 18-entry neighbor list in its __dict__.
+class LegacyCell:
+    def __init__(self, pos, hpr, hex_color="#bebebe", width=0.5):
+        self.pos = LVector3(pos)
+        self.width = width
+        step = width / 2
+        small_step = step / 2
+        self.free_neighbor_positions = [
+            LVector3(0, step, 0), LVector3(0, 0, step), LVector3(step, 0, 0),
+            LVector3(0, -step, 0), LVector3(0, 0, -step), LVector3(-step, 0, 0),
+            LVector3(0, small_step, small_step), LVector3(small_step, small_step, 0),
+            LVector3(small_step, 0, small_step), LVector3(0, -small_step, -small_step),
+            LVector3(-small_step, -small_step, 0), LVector3(-small_step, 0, -small_step),
+            LVector3(small_step, -small_step, 0), LVector3(-small_step, small_step, 0),
+            LVector3(small_step, 0, -small_step), LVector3(-small_step, 0, small_step),
+            LVector3(0, small_step, -small_step), LVector3(0, -small_step, small_step)]
+        self.node_path = Cell.generate_rhombic_dodecahedron(self.pos, self.width)
+        self.node_path.setPos(pos)
+        self.node_path.setHpr(hpr)
+        hex_str = hex_color.lstrip('#')
+        r, g, b = tuple(int(hex_str[i:i+2], 16) for i in (0, 2, 4))
+        self.node_path.setColor(r/255, g/255, b/255, 1.0)
+        self.gravity = False
+
+
+def measure(label, make, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    cells = [make(i) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<32} {elapsed / count * 1e6:>9.2f} us/cell {current / count:>9.0f} B/cell (Python heap)")
+    return elapsed / count, current / count
+
+
+def main(count=20000):
+    print(f"Constructing {count} cells")
+    legacy = measure("legacy (geometry per cell)", lambda i: LegacyCell((i * 0.25, 0, 0), (0, 0, 0)), count)
+    headless = measure("factory, headless", lambda i: create_cell("Bone", (i * 0.25, 0, 0)), count)
+
+    def with_node(i):
+        cell = create_cell("Bone", (i * 0.25, 0, 0))
+        cell.node_path = cell.create_node_path()
+        return cell
+    rendered = measure("factory, with shared-geom node", with_node, count)
+
+    print(f"speedup headless: {legacy[0] / headless[0]:.1f}x time, {legacy[1] / headless[1]:.1f}x memory")
+    print(f"speedup rendered: {legacy[0] / rendered[0]:.1f}x time, {legacy[1] / rendered[1]:.1f}x memory")
+    print("Geom objects: legacy one per cell, factory one per cell width")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,78 @@
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from panda3d.core import loadPrcFileData
+loadPrcFileData('', 'window-type none\naudio-library-name null')
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import LVector3
+
+from node_pool import *
+from entity import *
+
+
+# Spawns and kills organisms at increasing rates, with and without node pooling, and reports time, scene-graph
+# node allocations (in total and per round once the population is steady), pool hit rate, GC collections and
+# Python heap growth.
+# Only the scene-graph nodes are pooled: with the pool, new nodes are only allocated while the population grows
+# to its peak and almost none once it is steady. The Python objects of a cell (the Cell, its lattice key and body
+# graph entries) are still created on every spawn, so GC collections and heap churn grow with the spawn rate
+# the same way with and without the pool.
+def churn(rounds, organisms_per_round, cells_per_organism, warmup_rounds=4):
+    gc.collect()
+    collections_before = sum(stat["collections"] for stat in gc.get_stats())
+    allocations_before = node_pool.misses
+    tracemalloc.start()
+    heap_start = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    entity_id = 0
+    alive = []
+    steady_before = None
+    for round_number in range(rounds):
+        if round_number == warmup_rounds:
+            steady_before = node_pool.misses
+        for _ in range(organisms_per_round):
+            entity = Entity(LVector3(0, 0, 0), (0, 0, 0), entity_id=entity_id)
+            entity_id += 1
+            for _ in range(cells_per_organism - 1):
+                entity.add_cell(entity.cells[entity.rng.integers(len(entity.cells))], "Bone")
+            alive.append(entity)
+        # the older half of the population dies every round
+        for entity in alive[:len(alive) // 2]:
+            entity.destroy()
+        alive = alive[len(alive) // 2:]
+    elapsed = time.perf_counter() - start
+    steady = (node_pool.misses - steady_before) / (rounds - warmup_rounds)
+
+    heap_growth = tracemalloc.get_traced_memory()[0] - heap_start
+    tracemalloc.stop()
+    for entity in alive:
+        entity.destroy()
+
+    collections = sum(stat["collections"] for stat in gc.get_stats()) - collections_before
+    return elapsed, node_pool.misses - allocations_before, steady, collections, heap_growth
+
+
+def main():
+    ShowBase()
+    print(f"{'pool':<6}{'organisms/round':>16}{'seconds':>10}{'node allocations':>18}{'per steady round':>18}"
+          f"{'hit rate':>10}{'gc runs':>9}{'heap growth':>13}")
+    for high_water in (0, 4096):
+        for per_round in (10, 40, 160):
+            node_pool.free.clear()
+            node_pool.high_water = high_water
+            node_pool.hits = node_pool.misses = 0
+            elapsed, allocations, steady, collections, heap = churn(20, per_round, 20)
+            print(f"{'on' if high_water else 'off':<6}{per_round:>16}{elapsed:>10.3f}{allocations:>18}{steady:>18.0f}"
+                  f"{node_pool.hit_rate():>10.1%}{collections:>9}{heap / 1024:>11.0f}kB")
+    print("The pool removes node allocations only, the Python objects of every cell are still created per spawn "
+          "(gc runs and heap growth).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from connectivity import *
+
+
+# Large random bodies grown cell by cell from the root, then cells are killed until the deaths are used up:
+#   surface      cells picked at random, mostly leaves of the spanning tree (the O(1) case)
+#   inner        of a few random cells the one with the largest subtree, so the subtree is re-hung
+#   filaments    cells of the thin filaments joining blobs of cells, every such death cuts off whatever
+#                hangs beyond it (articulation points, the cascade path)
+# Compares the incremental BodyGraph.remove with a full graph walk (BodyGraph.build) after every death,
+# and checks that both leave the same cells alive.
+def grow_blob(rng, graph, nodes, start, cells):
+    # grows 'cells' new cells around randomly picked cells of the blob started at 'start'
+    blob = [start]
+    while cells > 0:
+        node = blob[rng.integers(len(blob))]
+        free = [n for n in lattice_neighbors(node) if n not in graph]
+        if free:
+            new = free[rng.integers(len(free))]
+            graph.add(new)
+            nodes.append(new)
+            blob.append(new)
+            cells -= 1
+    return blob
+
+
+def grow_body(rng, cells):
+    graph = BodyGraph((0, 0, 0))
+    nodes = [(0, 0, 0)]
+    grow_blob(rng, graph, nodes, (0, 0, 0), cells - 1)
+    return graph, nodes, nodes[1:]
+
+
+def grow_filament_body(rng, cells, blob_cells=50, filament_length=6):
+    # blobs joined into a tree by straight filaments of single cells
+    graph = BodyGraph((0, 0, 0))
+    nodes = [(0, 0, 0)]
+    blobs = [grow_blob(rng, graph, nodes, (0, 0, 0), blob_cells)]
+    filaments = []
+    while len(nodes) < cells:
+        blob = blobs[rng.integers(len(blobs))]
+        x, y, z = blob[rng.integers(len(blob))]
+        dx, dy, dz = NEIGHBOR_OFFSETS[rng.integers(len(NEIGHBOR_OFFSETS))].tolist()
+        chain = [(x + dx * k, y + dy * k, z + dz * k) for k in range(1, filament_length + 1)]
+        # the filament must leave the body and must not run along it
+        if any(n in graph or len(graph.neighbors(n)) > (k == 0) for k, n in enumerate(chain)):
+            continue
+        for n in chain:
+            graph.add(n)
+            nodes.append(n)
+        filaments.extend(chain)
+        blobs.append(grow_blob(rng, graph, nodes, chain[-1], blob_cells))
+    return graph, nodes, filaments
+
+
+def subtree_size(graph, node):
+    size = 0
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        size += 1
+        stack.extend(graph.children[n])
+    return size
+
+
+def run(name, rng, graph, nodes, candidates, deaths, pick_largest=0):
+    alive = set(nodes)
+    victims = []
+    cascade = 0
+    rehung = graph.rehung
+    incremental = 0.0
+    for _ in range(deaths):
+        choices = [n for n in candidates if n in alive]
+        if not choices:
+            break
+        if pick_largest:
+            sample = [choices[i] for i in rng.integers(len(choices), size=pick_largest)]
+            node = max(sample, key=lambda n: subtree_size(graph, n))
+        else:
+            node = choices[rng.integers(len(choices))]
+        victims.append(node)
+        start = time.perf_counter()
+        lost = graph.remove(node)
+        incremental += time.perf_counter() - start
+        alive.discard(node)
+        alive.difference_update(lost)
+        cascade += len(lost)
+
+    # the same deaths, with a full walk over the remaining body after each of them
+    expected = set(nodes)
+    start = time.perf_counter()
+    for node in victims:
+        expected.discard(node)
+        _, lost = BodyGraph.build(list(expected), (0, 0, 0))
+        expected.difference_update(lost)
+    full = time.perf_counter() - start
+    if expected != alive:
+        raise RuntimeError(f"{name}: incremental removal left other cells alive than the full walk.")
+
+    print(f"{name:<10} {len(nodes)} cells, {len(victims)} deaths, {graph.rehung - rehung} cells re-hung, "
+          f"{cascade} cells died with them, {len(alive)} left")
+    print(f"{'':<10} incremental {incremental / len(victims) * 1e6:>9.1f} us per death, "
+          f"full walk {full / len(victims) * 1e6:>9.1f} us per death")
+
+
+def main(cells=5000, deaths=1000):
+    rng = np.random.default_rng(0)
+    graph, nodes, candidates = grow_body(rng, cells)
+    run("surface", rng, graph, nodes, candidates, deaths)
+    graph, nodes, candidates = grow_body(rng, cells)
+    run("inner", rng, graph, nodes, candidates, deaths, pick_largest=16)
+    graph, nodes, candidates = grow_filament_body(rng, cells)
+    run("filaments", rng, graph, nodes, candidates, deaths)
+
+
+if __name__ == "__main__":
+    # arguments: cells, deaths
+    main(*(int(a) for a in sys.argv[1:]))
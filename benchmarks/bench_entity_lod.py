@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from panda3d.core import loadPrcFileData, LVector3
+
+loadPrcFileData("", "window-type offscreen\naudio-library-name null\nload-display p3tinydisplay\nwin-size 640 480")
+
+from direct.showbase.ShowBase import ShowBase
+
+from entity import *
+from entity_lod import *
+from genome import random_genome
+
+
+# Growing populations of entities from random genomes, spread over a large area around the camera, rendered
+# offscreen with and without entity LOD. Reports the mean frame time (cull and draw, software renderer) and how
+# many entities are drawn at each level: with LOD the frame time should stay nearly flat as the population grows.
+def frame_time(base, frames):
+    base.graphicsEngine.renderFrame()
+    start = time.perf_counter()
+    for _ in range(frames):
+        base.graphicsEngine.renderFrame()
+    return (time.perf_counter() - start) / frames
+
+
+def main(max_entities=1600, genes=20, area=300, frames=10):
+    base = ShowBase()
+    base.disableMouse()
+    base.camera.setPos(0, -area / 2, 20)
+    base.camera.lookAt(0, 0, 0)
+    rng = np.random.default_rng(0)
+
+    entities = []
+    lod = EntityLOD(base.render)
+    population = 50
+    while population <= max_entities:
+        while len(entities) < population:
+            pos = LVector3(*rng.uniform((-area / 2, -area / 2, 0), (area / 2, area / 2, 10)))
+            entities.append(Entity.from_genome(random_genome(rng, genes), pos, (0, 0, 0), entity_id=len(entities)))
+
+        # without LOD: every entity with all of its cells
+        lod.root.stash()
+        for entity in entities:
+            entity.node_path.unstash()
+        full = frame_time(base, frames)
+
+        lod.root.unstash()
+        lod.levels.clear()
+        start = time.perf_counter()
+        lod.update(entities, base.camera.getPos(base.render))
+        switch = time.perf_counter() - start
+        # a steady update: hulls are cached, no entity changes its level
+        start = time.perf_counter()
+        lod.update(entities, base.camera.getPos(base.render))
+        update = time.perf_counter() - start
+        with_lod = frame_time(base, frames)
+        cells = sum(len(entity.cells) for entity in entities)
+        print(f"{population:>5} entities {cells:>6} cells: full {full * 1000:6.1f} ms, LOD {with_lod * 1000:5.1f} ms "
+              f"+ {update * 1000:4.1f} ms update ({switch * 1000:.0f} ms switching all), levels {lod.counts}")
+        population *= 2
+
+
+if __name__ == "__main__":
+    # arguments: maximum population, genes per genome, area side, frames per measurement
+    main(*(int(a) for a in sys.argv[1:]))
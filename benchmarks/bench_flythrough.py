@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import numpy as np
+from panda3d.core import loadPrcFileData, LVector3, SceneGraphAnalyzer, StringStream, GeomTriangles, ClockObject
+
+# main.py loads its models and textures relative to the repository, not to this script
+loadPrcFileData("", "window-type offscreen\naudio-library-name null\nload-display p3tinydisplay\n"
+                    f"model-path {repo_dir}")
+
+from genome import random_genome
+from perlin import generate_perlin_noise_2d
+
+launch_dir = os.getcwd()
+from main import VoxelWorld     # changes the working directory to the repository
+
+
+# Replays a camera path through the fixed 100x100 world of main.py (master seed 42) with a fixed population of
+# entities from seeded random genomes, rendered offscreen by tinydisplay. Records for every frame the frame time
+# (split into the update tasks and the render), how many GeomNodes and Geoms lie in the view frustum and how
+# many triangles they hold, and the entity LOD levels; the scene is summarized with SceneGraphAnalyzer
+# (render.analyze()) before and after the flight. Everything goes into one JSON file named after the commit, so
+# two commits can be compared frame by frame.
+# Paths are recorded in main.py with F7, without a path the camera circles the world, from close to the
+# entities out to beyond the point LOD distance and back.
+def default_path(frames, fps, center=(50.0, 50.0, 10.0)):
+    keys = []
+    for i in range(frames + 1):
+        phase = i / frames
+        # the distance to the center rises from 15 to 150 and falls back
+        radius = 15 + 135 * np.sin(np.pi * phase) ** 2
+        angle = 2 * np.pi * phase
+        pos = LVector3(center[0] + radius * np.cos(angle), center[1] + radius * np.sin(angle),
+                       center[2] + 5 + radius * 0.3)
+        heading = np.degrees(np.arctan2(center[1] - pos.y, center[0] - pos.x)) - 90
+        pitch = -np.degrees(np.arctan2(pos.z - center[2], np.hypot(pos.x - center[0], pos.y - center[1])))
+        keys.append([i / fps, pos.x, pos.y, pos.z, heading, pitch, 0.0])
+    return keys
+
+
+def path_pose(keys, t):
+    # position and hpr interpolated linearly between the recorded keys
+    keys = np.asarray(keys, dtype=np.float64)
+    pose = [np.interp(t, keys[:, 0], keys[:, column]) for column in range(1, 7)]
+    return pose[:3], pose[3:]
+
+
+def frustum_counts(app):
+    # what the view-frustum cull keeps: GeomNodes and Geoms whose bounds intersect the frustum
+    frustum = app.camLens.makeBounds()
+    frustum.xform(app.cam.getMat(app.render))
+    nodes = in_view = geoms = triangles = 0
+    for node_path in app.render.findAllMatches("**/+GeomNode"):
+        if node_path.isHidden():
+            continue
+        nodes += 1
+        node = node_path.node()
+        transform = node_path.getMat(app.render)
+        bounds = node.getBounds().makeCopy()
+        bounds.xform(transform)
+        if not frustum.contains(bounds):
+            continue
+        in_view += 1
+        for i in range(node.getNumGeoms()):
+            geom = node.getGeom(i)
+            geom_bounds = geom.getBounds().makeCopy()
+            geom_bounds.xform(transform)
+            if not frustum.contains(geom_bounds):
+                continue
+            geoms += 1
+            triangles += sum(geom.getPrimitive(j).getNumFaces() for j in range(geom.getNumPrimitives())
+                             if isinstance(geom.getPrimitive(j), GeomTriangles))
+    return {"geom_nodes": nodes, "geom_nodes_in_view": in_view, "geoms_drawn": geoms, "triangles_drawn": triangles}
+
+
+def analyze(app):
+    sga = SceneGraphAnalyzer()
+    sga.addNode(app.render.node())
+    text = StringStream()
+    sga.write(text)
+    return {"nodes": sga.getNumNodes(), "instances": sga.getNumInstances(), "geom_nodes": sga.getNumGeomNodes(),
+            "geoms": sga.getNumGeoms(), "vertex_datas": sga.getNumGeomVertexDatas(),
+            "vertex_formats": sga.getNumGeomVertexFormats(), "vertices": sga.getNumVertices(),
+            "triangles": sga.getNumTris(), "points": sga.getNumPoints(), "lines": sga.getNumLines(),
+            "vertex_data_bytes": sga.getVertexDataSize(), "texture_bytes": sga.getTextureBytes(),
+            "text": text.getData().decode()}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                                text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), bool(status.stdout.strip())
+
+
+def summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {"mean": float(values.mean()), "median": float(np.median(values)),
+            "p95": float(np.percentile(values, 95)), "p99": float(np.percentile(values, 99)),
+            "max": float(values.max())}
+
+
+def main(frames=300, entities=200, genes=20, fps=30, width=640, height=480, path=None, output=None, warmup=10):
+    loadPrcFileData("", f"win-size {width} {height}")
+    if not os.path.exists("Perlin/heightmap.npy"):
+        # the same heightmap perlin.py saves
+        np.save("Perlin/heightmap.npy", generate_perlin_noise_2d(256, 256, 0.05))
+
+    app = VoxelWorld(master_seed=42)
+    # a clock advancing exactly 1/fps per frame, so every run simulates and draws the same frames whatever the
+    # speed of the machine
+    clock = ClockObject.getGlobalClock()
+    clock.setMode(ClockObject.MNonRealTime)
+    clock.setFrameRate(fps)
+    rng = np.random.default_rng(0)
+    for _ in range(entities):
+        app.simulation.spawn_entity(LVector3(*rng.uniform((0, 0, 12), (100, 100, 20))),
+                                    genome=random_genome(rng, genes))
+
+    if path is not None:
+        with open(path) as f:
+            keys = json.load(f)["keys"]
+        # recorded paths start at the time recording began
+        keys = [[key[0] - keys[0][0], *key[1:]] for key in keys]
+    else:
+        keys = default_path(frames, fps)
+
+    # the last task before the render (igLoop, sort 50) marks where the update tasks end
+    marks = {}
+    def mark_render(task):
+        marks["render"] = time.perf_counter()
+        return task.cont
+    app.taskMgr.add(mark_render, "mark_render", sort=49)
+
+    for _ in range(warmup):
+        app.taskMgr.step()
+    scene_before = analyze(app)
+
+    records = []
+    for frame in range(frames):
+        pos, hpr = path_pose(keys, frame / fps)
+        app.camera.setPos(app.render, *pos)
+        app.camera.setHpr(app.render, *hpr)
+        start = time.perf_counter()
+        app.taskMgr.step()
+        end = time.perf_counter()
+        record = {"frame": frame, "frame_ms": (end - start) * 1000, "update_ms": (marks["render"] - start) * 1000,
+                  "render_ms": (end - marks["render"]) * 1000, "tick": app.simulation.tick,
+                  "entities": len(app.entities), "cells": sum(len(entity.cells) for entity in app.entities),
+                  "camera": [*pos, *hpr]}
+        record.update(frustum_counts(app))
+        if app.entity_lod is not None:
+            record["lod_levels"] = list(app.entity_lod.counts)
+        records.append(record)
+
+    commit, dirty = git_commit()
+    result = {
+        "commit": commit, "dirty": dirty,
+        "settings": {"frames": frames, "entities": entities, "genes": genes, "fps": fps, "size": [width, height],
+                     "path": path, "renderer": app.win.getGsg().getType().getName()},
+        "summary": {name: summary([record[name] for record in records])
+                    for name in ("frame_ms", "update_ms", "render_ms", "geoms_drawn", "triangles_drawn")},
+        "scene_before": scene_before,
+        "scene_after": analyze(app),
+        "frames": records,
+    }
+    if output is None:
+        output = os.path.join(launch_dir, f"flythrough_{commit or 'unknown'}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=1)
+
+    frame_ms = result["summary"]["frame_ms"]
+    print(f"{frames} frames, {len(app.entities)} entities: frame {frame_ms['mean']:.1f} ms mean, "
+          f"{frame_ms['p95']:.1f} ms p95 (render {result['summary']['render_ms']['mean']:.1f} ms, "
+          f"update {result['summary']['update_ms']['mean']:.1f} ms), "
+          f"{result['summary']['triangles_drawn']['mean']:.0f} triangles drawn per frame")
+    print(f"written to {output}")
+    app.destroy()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offscreen camera flythrough render benchmark")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--entities", type=int, default=200, help="entities spawned from seeded random genomes")
+    parser.add_argument("--genes", type=int, default=20, help="genes per genome")
+    parser.add_argument("--fps", type=int, default=30, help="simulated frame rate of the replay")
+    parser.add_argument("--size", type=int, nargs=2, default=(640, 480), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--path", default=None, help="camera path recorded with F7 in main.py (default: an orbit)")
+    parser.add_argument("--output", default=None, help="JSON file to write (default: flythrough_<commit>.json)")
+    args = parser.parse_args()
+    main(args.frames, args.entities, args.genes, args.fps, *args.size,
+         None if args.path is None else os.path.join(launch_dir, args.path),
+         None if args.output is None else os.path.join(launch_dir, args.output))
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from panda3d.core import LVector3
+
+from entity import *
+from genome import random_genome
+from locomotion import *
+from rng_streams import make_rng
+
+
+# Entities grown from random genomes, their muscles and fins driven by a sine wave with a phase per cell
+# (instead of brains), integrated for a number of ticks. Reports cell updates per second of the batched
+# integrator and how far the bodies travelled.
+def main(entities=200, ticks=300, genome_length=32, tick_dt=1.0 / 30.0):
+    rng = make_rng(0, "bench_locomotion")
+    population = []
+    for entity_id in range(entities):
+        pos = LVector3(*rng.uniform(0, 100, 3))
+        entity = Entity.from_genome(random_genome(rng, genome_length), pos, (0, 0, 0),
+                                    entity_id=entity_id, rng=make_rng(0, "entity", entity_id), headless=True)
+        population.append(entity)
+
+    engine = LocomotionEngine(base_actuator_count)
+    moving = engine.sync(population)
+    cells = int(engine.counts.sum())
+    phases = [rng.uniform(0, 2 * np.pi, len(entity.actuated_cells())) for entity in moving]
+    start_pos = np.array([tuple(entity.entity_pos) for entity in moving])
+    print(f"{len(moving)} of {entities} entities actuated, {cells} cells, {len(engine.springs)} springs")
+
+    integrate = 0.0
+    start = time.perf_counter()
+    for tick in range(ticks):
+        for entity, phase in zip(moving, phases):
+            entity.actuator_commands = np.concatenate([[0.0], np.sin(2 * np.pi * tick * tick_dt + phase)])
+        integrate_start = time.perf_counter()
+        engine.integrate(tick_dt)
+        integrate += time.perf_counter() - integrate_start
+        center = engine.centers(engine.position)
+        for entity, offset in zip(moving, (center - engine.plan_center).tolist()):
+            entity.translate(offset)
+        engine.plan_center = center
+    total = time.perf_counter() - start
+
+    travelled = np.linalg.norm(np.array([tuple(entity.entity_pos) for entity in moving]) - start_pos, axis=1)
+    print(f"integration {integrate / ticks * 1000:.2f} ms per tick, "
+          f"{engine.cell_updates / integrate / 1e6:.2f} M cell updates per second ({substeps} substeps per tick)")
+    print(f"with moving the body plans {total / ticks * 1000:.2f} ms per tick")
+    print(f"travelled in {ticks * tick_dt:.0f} s: mean {travelled.mean():.3f}, max {travelled.max():.3f}, "
+          f"finite: {np.isfinite(engine.position).all()}")
+
+
+if __name__ == "__main__":
+    # arguments: entities, ticks
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from genome import grow_phenotype, random_genome
+from organism_mesher import *
+
+
+# Triangle savings of culling the faces between touching cells, for a dense ball of cells and for bodies grown
+# from random genomes. Then a body grows and loses cells one by one: the incremental OrganismMesh is compared
+# with recomputing face_mask for the whole body after every change, and both must give the same faces.
+def ball(radius):
+    span = np.arange(-2 * radius, 2 * radius + 1)
+    coords = np.stack(np.meshgrid(span, span, span, indexing="ij"), axis=-1).reshape(-1, 3)
+    # the lattice holds the points with an even coordinate sum (axis neighbors are 2 apart, diagonal ones 1+1)
+    coords = coords[(coords.sum(axis=1) % 2 == 0) & (np.linalg.norm(coords, axis=1) <= 2 * radius)]
+    return coords
+
+
+def report(name, coords):
+    mask = face_mask(coords)
+    full = len(coords) * face_count * triangles_per_face
+    triangles = int(mask.sum()) * triangles_per_face
+    print(f"{name:<24} {len(coords):>6} cells {full:>8} -> {triangles:>7} triangles ({1 - triangles / full:.0%} culled)")
+
+
+def main(radius=6, genomes=50, genes=200, changes=2000):
+    rng = np.random.default_rng(0)
+    report("ball", ball(radius))
+    grown = [grow_phenotype(random_genome(rng, genes)).lattice_positions for _ in range(genomes)]
+    report(f"{genomes} random genomes", np.concatenate([c.astype(np.int64) + i * 10_000 for i, c in enumerate(grown)]))
+
+    # cells are added next to random cells of the body and removed at random, the ball is the starting point
+    organism = OrganismMesh()
+    for key in map(tuple, ball(radius).tolist()):
+        organism.add(key, 1)
+    keys = list(organism.row_of)
+    incremental = full = 0.0
+    for i in range(changes):
+        start = time.perf_counter()
+        if i % 2 == 0:
+            x, y, z = keys[rng.integers(len(keys))]
+            dx, dy, dz = FACE_OFFSETS[rng.integers(face_count)].tolist()
+            key = (x + dx, y + dy, z + dz)
+            if key in organism:
+                continue
+            organism.add(key, 1)
+            keys.append(key)
+        else:
+            key = keys.pop(rng.integers(len(keys)))
+            organism.remove(key)
+        incremental += time.perf_counter() - start
+
+        start = time.perf_counter()
+        positions, cell_types, mask = organism.arrays()
+        expected = face_mask(positions)
+        full += time.perf_counter() - start
+        if not np.array_equal(mask, expected):
+            raise RuntimeError(f"Incremental faces differ from the full recomputation after change {i}.")
+
+    stats = organism.stats()
+    print(f"{changes} changes, {stats['cells']} cells left, {stats['culled_share']:.0%} of the triangles culled")
+    print(f"incremental {incremental / changes * 1e6:>9.1f} us per change")
+    print(f"full mask   {full / changes * 1e6:>9.1f} us per change")
+
+
+if __name__ == "__main__":
+    # arguments: radius of the ball (in cells), genomes, genes per genome, changes
+    main(*(int(a) for a in sys.argv[1:]))
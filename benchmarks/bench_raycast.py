@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from occupancy import heightmap_occupancy
+from perlin import generate_perlin_noise_2d
+from raycast import *
+
+
+# Rays from random points above a Perlin heightmap terrain in random directions, cast in one batch against the
+# voxel grid, and against the bounding boxes of a few hundred entities. Reports rays per second and hit shares.
+def main(rays=100_000, entities=500, world_size=100, max_height=10, max_distance=32):
+    rng = np.random.default_rng(0)
+    heights = generate_perlin_noise_2d(world_size, world_size, 0.05)
+    raycaster = VoxelRaycaster(heightmap_occupancy(heights, max_height))
+    origins = rng.uniform((0, 0, max_height // 2), (world_size, world_size, 2 * max_height), (rays, 3))
+    directions = normalize(rng.normal(size=(rays, 3)))
+
+    start = time.perf_counter()
+    distance, block_type = raycaster.cast(origins, directions, max_distance)
+    terrain = time.perf_counter() - start
+    print(f"terrain:  {rays / terrain / 1e6:.2f} M rays per second, {np.isfinite(distance).mean():.0%} hit "
+          f"(grid {raycaster.occupancy.shape}, chunks of {raycaster.chunk_size})")
+
+    box_min = rng.uniform((0, 0, max_height // 2), (world_size, world_size, 2 * max_height), (entities, 3))
+    box_max = box_min + rng.uniform(0.5, 3.0, (entities, 3))
+    start = time.perf_counter()
+    distance, entity_id = cast_boxes(origins, directions, box_min, box_max, np.arange(entities), max_distance)
+    boxes = time.perf_counter() - start
+    print(f"entities: {rays / boxes / 1e6:.2f} M rays per second, {np.isfinite(distance).mean():.0%} hit "
+          f"({entities} boxes)")
+
+
+if __name__ == "__main__":
+    # arguments: rays, entities
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from genome import random_genome
+from occupancy import heightmap_occupancy
+from perlin import generate_perlin_noise_2d
+from region_pool import gil_enabled
+from simulation import *
+
+
+# The same populated simulation (entities from random genomes over a Perlin terrain, with optic cells casting
+# rays and muscles, fins and gliders moving the bodies) run in a single batch and on region pools of growing
+# thread counts. Reports ticks per second, and checks that every run ends in exactly the same state.
+def build(entities, genes, world_size):
+    simulation = Simulation(1)
+    simulation.set_terrain(heightmap_occupancy(generate_perlin_noise_2d(world_size, world_size, 0.05), 10))
+    simulation.create_nutrients((world_size, world_size))
+    rng = np.random.default_rng(0)
+    for _ in range(entities):
+        simulation.spawn_entity(tuple(rng.uniform((0, 0, 12), (world_size, world_size, 20))),
+                                genome=random_genome(rng, genes))
+    return simulation
+
+
+def state(simulation):
+    return (np.array([tuple(entity.entity_pos) for entity in simulation.entities]),
+            np.array([entity.energy for entity in simulation.entities]),
+            np.array([cell.sensor_value for entity in simulation.entities for cell in entity.cells]),
+            simulation.locomotion.velocity.copy())
+
+
+def run(simulation, ticks):
+    simulation.step()
+    start = time.perf_counter()
+    for _ in range(ticks):
+        simulation.step()
+    return ticks / (time.perf_counter() - start)
+
+
+def main(entities=400, ticks=30, max_threads=4, genes=20, world_size=200, region_size=32):
+    print(f"{os.cpu_count()} cores, {'GIL enabled' if gil_enabled() else 'free-threaded build'}")
+    simulation = build(entities, genes, world_size)
+    serial = run(simulation, ticks)
+    reference = state(simulation)
+    print(f"single batch:   {serial:6.1f} ticks per second")
+
+    threads = 1
+    while threads <= max_threads:
+        simulation = build(entities, genes, world_size)
+        simulation.set_workers(threads, region_size)
+        rate = run(simulation, ticks)
+        same = all(np.array_equal(a, b) for a, b in zip(state(simulation), reference))
+        print(f"{threads} thread(s):    {rate:6.1f} ticks per second ({rate / serial:.2f}x), "
+              f"{'identical to' if same else 'DIFFERENT from'} the single batch")
+        simulation.region_pool.close()
+        threads *= 2
+
+
+if __name__ == "__main__":
+    # arguments: entities, ticks, maximum threads, genes per genome, world size, region size
+    main(*(int(a) for a in sys.argv[1:]))
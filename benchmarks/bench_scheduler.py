@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from scheduler import *
+
+
+# Schedules per-cell timers (division, aging, death, ...) spread over ten minutes of simulation time,
+# cancels a share of them and runs the queue tick by tick, as Simulation.step does.
+def main(events=1_000_000, cancel_share=0.1, tick_dt=1.0 / 30.0, seconds=600.0):
+    rng = np.random.default_rng(0)
+    event_types = ("divide", "age", "die", "release_energy")
+    times = rng.uniform(0, seconds, events)
+    types = rng.integers(0, len(event_types), events)
+    targets = rng.integers(0, events // 10, events)
+
+    # memory per pending event, measured on a sample since tracing slows down the timed runs
+    tracemalloc.start()
+    sample = EventScheduler()
+    sample.schedule_many(times[:100_000], "age", targets[:100_000])
+    per_event = tracemalloc.get_traced_memory()[0] / 100_000
+    tracemalloc.stop()
+    del sample
+
+    scheduler = EventScheduler()
+    start = time.perf_counter()
+    entries = []
+    for code, event_type in enumerate(event_types):
+        chosen = types == code
+        entries += scheduler.schedule_many(times[chosen], event_type, targets[chosen])
+    bulk = time.perf_counter() - start
+
+    # single pushes into the full heap
+    start = time.perf_counter()
+    for time_, target in zip(rng.uniform(0, seconds, 100_000).tolist(), range(100_000)):
+        scheduler.schedule(time_, "age", target)
+    single = (time.perf_counter() - start) / 100_000
+
+    start = time.perf_counter()
+    cancelled = rng.choice(len(entries), int(len(entries) * cancel_share), replace=False)
+    for i in cancelled.tolist():
+        scheduler.cancel(entries[i])
+    cancel = (time.perf_counter() - start) / max(len(cancelled), 1)
+
+    batches = []
+    handlers = {event_type: (lambda times, targets, payloads: batches.append(len(targets)))
+                for event_type in event_types}
+    start = time.perf_counter()
+    tick = 0
+    while len(scheduler):
+        tick += 1
+        scheduler.run_until(tick * tick_dt, handlers)
+    run = time.perf_counter() - start
+
+    print(f"{events} events, {per_event:.0f} bytes per pending event ({per_event * events / 2**20:.0f} MB)")
+    print(f"bulk scheduling   {bulk * 1e9 / events:>8.0f} ns per event")
+    print(f"single scheduling {single * 1e9:>8.0f} ns per event")
+    print(f"cancelling        {cancel * 1e9:>8.0f} ns per event")
+    print(f"running           {run * 1e9 / scheduler.processed:>8.0f} ns per event, {tick} ticks, "
+          f"{len(batches)} batches of {np.mean(batches):.0f} events")
+
+
+if __name__ == "__main__":
+    # arguments: number of events
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from occupancy import heightmap_occupancy
+from perlin import generate_perlin_noise_2d
+from shared_world import *
+
+
+# Workers compute the highest solid voxel of every terrain column, each one for its own range of rows.
+# Pickled: every job carries the whole occupancy grid (what a worker needing the terrain would get today).
+# Shared: every job carries the block handles, reads the grid zero-copy and writes its rows in place.
+# No Panda3D in here, spawned workers re-import this module.
+
+
+def _ceilings(occupancy):
+    return np.where(occupancy.any(axis=2), occupancy.shape[2] - 1 - np.argmax(occupancy[:, :, ::-1], axis=2), -1)
+
+
+def pickled_job(job):
+    occupancy, start, stop = job
+    return _ceilings(occupancy[start:stop])
+
+
+def shared_job(job):
+    handles, sequence, start, stop = job
+    world = attach_world(handles)
+    if world["occupancy"].changed_since(sequence):
+        raise RuntimeError("The occupancy changed while the job ran.")
+    # disjoint rows per job, so workers write in place without locking
+    world["ceilings"].view(writable=True)[start:stop] = _ceilings(world["occupancy"].view()[start:stop])
+    return stop - start
+
+
+def main(size=512, max_height=64, workers=None, repeats=5):
+    workers = workers or os.cpu_count() or 1
+    occupancy = heightmap_occupancy(generate_perlin_noise_2d(size, size, 0.02), max_height)
+    regions = split_rows(size, workers * 4)
+    print(f"occupancy {occupancy.shape}, {occupancy.nbytes / 2**20:.1f} MB, {workers} workers, {len(regions)} jobs")
+
+    world = SharedWorld()
+    world.share("occupancy", occupancy)
+    ceilings = world.allocate("ceilings", (size, size), np.int64)
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers) as pool:
+        # one warm-up round each, so process start-up and first attachment are not counted
+        pool.map(pickled_job, [(occupancy, *regions[0])] * workers)
+        pool.map(shared_job, [(world.handles(), world["occupancy"].sequence, *regions[0])] * workers)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            pickled = np.concatenate(pool.map(pickled_job, [(occupancy, a, b) for a, b in regions]))
+        pickled_time = (time.perf_counter() - start) / repeats
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            ceilings.begin_write()
+            pool.map(shared_job, [(world.handles(), world["occupancy"].sequence, a, b) for a, b in regions])
+            ceilings.end_write()
+        shared_time = (time.perf_counter() - start) / repeats
+
+    pickled_bytes = len(pickle.dumps((occupancy, *regions[0])))
+    shared_bytes = len(pickle.dumps((world.handles(), 0, *regions[0])))
+    print(f"{'pickled':<10}{pickled_time * 1000:>9.1f} ms per round {pickled_bytes:>12} bytes per job")
+    print(f"{'shared':<10}{shared_time * 1000:>9.1f} ms per round {shared_bytes:>12} bytes per job")
+    print(f"results equal: {np.array_equal(pickled.reshape(size, size), ceilings.view())}")
+    world.close()
+
+
+if __name__ == "__main__":
+    # arguments: world size, max height, workers
+    main(*(int(a) for a in sys.argv[1:]))
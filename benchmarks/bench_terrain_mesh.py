@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from world_geometry import *
+from perlin import generate_perlin_noise_2d
+
+
+def heightmap_voxel_map(h_data, size, max_height, voxel):
+    # same fill as the voxel-map path of VoxelMesh.generate_base_terrain
+    voxel_map = {}
+    for x in range(size):
+        for y in range(size):
+            for z in range(int(h_data[x, y] * max_height) + 1):
+                voxel_map[(x, y, z)] = voxel
+    return voxel_map
+
+
+def legacy_mesh(voxel_map, voxel):
+    mesh = VoxelMesh(voxel)
+    start = time.perf_counter()
+    for (x, y, z), voxel_obj in voxel_map.items():
+        voxel_obj.generate_embedded(x, y, z, mesh.vertex, mesh.normal, mesh.texcoord, mesh.tris, mesh.vdata, voxel_map)
+    mesh.tris.closePrimitive()
+    elapsed = time.perf_counter() - start
+    return elapsed, mesh.vdata.getNumRows(), mesh.vdata.getArray(0).getDataSizeBytes()
+
+
+def vectorized_mesh(voxel_map, voxel, ambient_occlusion, skylight):
+    mesh = VoxelMesh(voxel, ambient_occlusion, skylight)
+    mesh.voxel_map = voxel_map
+    start = time.perf_counter()
+    node = mesh.mesh_voxel_map()
+    elapsed = time.perf_counter() - start
+    vdata = node.getGeom(0).getVertexData()
+    return elapsed, mesh.build_stats, vdata.getArray(0).getDataSizeBytes()
+
+
+def heightfield_mesh(h_data, size, max_height, voxel, ambient_occlusion):
+    start = time.perf_counter()
+    terrain = HeightfieldTerrain.from_heightmap(h_data, size, size, max_height)
+    mesh = VoxelMesh(voxel, ambient_occlusion)
+    node = mesh.build_node(terrain.mesh(voxel.texture_coords, ambient_occlusion))
+    elapsed = time.perf_counter() - start
+    return elapsed, terrain.storage_bytes(), node.getGeom(0).getVertexData().getArray(0).getDataSizeBytes()
+
+
+def main(size=100, max_height=10):
+    voxel = Voxel((1, 4))
+    h_data = generate_perlin_noise_2d(size, size, 0.05)
+    start = time.perf_counter()
+    voxel_map = heightmap_voxel_map(h_data, size, max_height, voxel)
+    fill = time.perf_counter() - start
+    print(f"{len(voxel_map)} voxels ({size}x{size}, max height {max_height})")
+    print(f"{'voxel-map fill':<28}{fill * 1000:>9.1f} ms {voxel_map_bytes(voxel_map) / 2**20:>17.2f} MB storage")
+    for ao in (False, True):
+        elapsed, storage, size_bytes = heightfield_mesh(h_data, size, max_height, voxel, ao)
+        print(f"{'heightfield' + (', AO' if ao else ''):<28}{elapsed * 1000:>9.1f} ms {storage / 2**20:>17.2f} MB storage"
+              f" {size_bytes / 2**20:>7.2f} MB vertices (fill + mesh)")
+
+    elapsed, rows, size_bytes = legacy_mesh(voxel_map, voxel)
+    print(f"{'legacy per-voxel':<28}{elapsed * 1000:>9.1f} ms {rows:>8} vertices {size_bytes / 2**20:>7.2f} MB")
+
+    base = None
+    for label, ao, sky in (("vectorized, unlit", False, False), ("vectorized, AO", True, False),
+                           ("vectorized, AO + skylight", True, True)):
+        elapsed, stats, size_bytes = vectorized_mesh(voxel_map, voxel, ao, sky)
+        print(f"{label:<28}{elapsed * 1000:>9.1f} ms {stats['faces'] * 4:>8} vertices {size_bytes / 2**20:>7.2f} MB"
+              f"   lighting {stats['light_seconds'] * 1000:.1f} ms")
+        if base is None:
+            base = (elapsed, size_bytes)
+        else:
+            print(f"{'':<28}extra build time {(elapsed - base[0]) * 1000:+.1f} ms, "
+                  f"extra vertex bytes {size_bytes - base[1]:+d} ({size_bytes / base[1] - 1:+.0%})")
+
+
+if __name__ == "__main__":
+    # arguments: world size, max height
+    main(*(int(a) for a in sys.argv[1:]))
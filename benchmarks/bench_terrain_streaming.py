@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from terrain_streaming import *
+
+
+# A camera flying in a straight line across the unbounded terrain, the streamer loading and meshing chunks
+# around it (without a renderer, mesh sizes are the vertex and index arrays). Reports update time and
+# resident memory per stretch of the flight: both should stay flat however far the camera gets.
+# A voxel edited at the start is evicted with its chunk and must come back from disk on the way home.
+def main(distance=4000, speed=4, budget_mb=8, stretches=5):
+    save_dir = tempfile.mkdtemp()
+    streamer = ChunkStreamer(load_radius=3.0, unload_radius=4.5, max_bytes=int(budget_mb * 2**20), save_dir=save_dir)
+    streamer.set_voxel(3, 3, 40, True)
+
+    def update(position):
+        streamer.update(position)
+        streamer.unloaded.clear()
+        for chunk in streamer.dirty_chunks():
+            arrays = streamer.mesh(chunk)
+            chunk.mesh_bytes = arrays["stats"]["vertex_bytes"] + arrays["index"].nbytes
+
+    steps = distance // speed
+    times = np.zeros(steps)
+    resident = np.zeros(steps)
+    for i in range(steps):
+        start = time.perf_counter()
+        update((3 + i * speed, 3 + i * speed * 0.3, 30))
+        times[i] = time.perf_counter() - start
+        resident[i] = streamer.bytes_used()
+
+    print(f"flew {distance} voxels in {steps} updates, {streamer.loads} chunk loads, {streamer.evictions} evictions, "
+          f"{streamer.saves} saves, {len(streamer.chunks)} chunks resident")
+    for stretch, (t, r) in enumerate(zip(np.array_split(times, stretches), np.array_split(resident, stretches))):
+        print(f"stretch {stretch}: update median {np.median(t) * 1000:6.2f} ms, 99th percentile "
+              f"{np.percentile(t, 99) * 1000:6.2f} ms, resident {r.mean() / 2**20:5.2f} MB (max {r.max() / 2**20:.2f})")
+
+    for _ in range(200):
+        update((3, 3, 30))
+    print(f"edited voxel after returning: {streamer.chunks[(0, 0)].overrides}")
+
+
+if __name__ == "__main__":
+    # arguments: distance, speed (voxels per update), budget in MB
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from panda3d.core import loadPrcFileData
+
+from world_geometry import *
+from perlin import generate_perlin_noise_2d
+
+
+def build(arrays, texture_coords, compact):
+    start = time.perf_counter()
+    if compact:
+        node, origin = build_compact_terrain_node(arrays, texture_coords)
+    else:
+        node, origin = build_terrain_node(arrays), LVector3(0, 0, 0)
+    elapsed = time.perf_counter() - start
+    vdata = node.getGeom(0).getVertexData()
+    return node, origin, elapsed, vdata.getArray(0).getDataSizeBytes(), vdata.getFormat().getArray(0).getStride()
+
+
+def open_offscreen():
+    # the compact format needs shaders, tinydisplay has none; returns None without a GL renderer
+    loadPrcFileData("", "window-type offscreen\naudio-library-name null\nload-display p3headlessgl\n"
+                        f"win-size 256 256\nmodel-path {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}")
+    try:
+        from direct.showbase.ShowBase import ShowBase
+        base = ShowBase()
+    except Exception:
+        return None
+    if base.win is None or not base.win.getGsg().getSupportsBasicShaders():
+        return None
+    base.disableMouse()
+    base.camera.setPos(-20, -20, 60)
+    base.camera.lookAt(50, 50, 0)
+    return base
+
+
+def upload_time(base, node, origin, compact, frames=5):
+    # first frame with the node (vertex upload and draw) minus the mean of the frames after it
+    node_path = base.render.attachNewNode(node)
+    node_path.setPos(origin)
+    if compact:
+        node_path.setShader(load_compact_terrain_shader())
+        node_path.setShaderInput("sun_direction", LVector3(-0.5, 0.5, -0.707))
+        node_path.setShaderInput("sun_color", LVector3(1, 1, 1))
+        node_path.setShaderInput("ambient_color", LVector3(0.3, 0.3, 0.3))
+    start = time.perf_counter()
+    base.graphicsEngine.renderFrame()
+    base.graphicsEngine.syncFrame()
+    first = time.perf_counter() - start
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        base.graphicsEngine.renderFrame()
+        base.graphicsEngine.syncFrame()
+        times.append(time.perf_counter() - start)
+    node_path.removeNode()
+    return first - float(np.mean(times))
+
+
+def main(size=100, max_height=10):
+    voxel = Voxel((1, 4))
+    h_data = generate_perlin_noise_2d(size, size, 0.05)
+    terrain = HeightfieldTerrain.from_heightmap(h_data, size, size, max_height)
+    arrays = terrain.mesh(voxel.texture_coords, ambient_occlusion=True)
+    print(f"{len(arrays['vertex'])} vertices, {len(arrays['index']) // 3} triangles ({size}x{size}, max height {max_height})")
+
+    base = open_offscreen()
+    if base is None:
+        print("no renderer with shader support, upload times are not measured")
+    for label, compact in (("standard (float32, colors)", False), ("compact (uint8, shader)", True)):
+        node, origin, elapsed, size_bytes, stride = build(arrays, voxel.texture_coords, compact)
+        upload = f"{upload_time(base, node, origin, compact) * 1000:>8.1f} ms upload" if base is not None else "n/a"
+        print(f"{label:<28}{stride:>3} bytes/vertex {size_bytes / 2**20:>7.2f} MB"
+              f" {elapsed * 1000:>8.1f} ms build   {upload}")
+
+
+if __name__ == "__main__":
+    # arguments: world size, max height
+    main(*(int(a) for a in sys.argv[1:]))
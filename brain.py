@@ -0,0 +1,180 @@
+import logging
+
+import numpy as np
+import torch
+
+from common import *
+
+logging_setup()
+logger_brain = logging.getLogger(__name__)
+
+
+# A small two-layer controller network (inputs -> tanh hidden layer -> tanh outputs).
+# The shape of every controller depends on the body it controls, so controllers of
+# different entities usually have different numbers of inputs, hidden units and outputs.
+class BrainController:
+
+    def __init__(self, w1, b1, w2, b2):
+        self.w1 = torch.as_tensor(w1, dtype=torch.float32)    # (hidden, inputs)
+        self.b1 = torch.as_tensor(b1, dtype=torch.float32)    # (hidden,)
+        self.w2 = torch.as_tensor(w2, dtype=torch.float32)    # (outputs, hidden)
+        self.b2 = torch.as_tensor(b2, dtype=torch.float32)    # (outputs,)
+
+        if self.w1.shape[0] != self.b1.shape[0] or self.w2.shape != (self.b2.shape[0], self.w1.shape[0]):
+            raise ValueError("Controller weight shapes do not match.")
+
+    @property
+    def n_inputs(self):
+        return self.w1.shape[1]
+
+    @property
+    def n_hidden(self):
+        return self.w1.shape[0]
+
+    @property
+    def n_outputs(self):
+        return self.w2.shape[0]
+
+    @staticmethod
+    def parameter_count(n_inputs, n_hidden, n_outputs):
+        return n_hidden * n_inputs + n_hidden + n_outputs * n_hidden + n_outputs
+
+    @classmethod
+    def from_vector(cls, n_inputs, n_hidden, n_outputs, weights):
+        # builds a controller from a flat weight vector, for example one taken from a genome
+        weights = np.asarray(weights, dtype=np.float32)
+        if len(weights) != cls.parameter_count(n_inputs, n_hidden, n_outputs):
+            raise ValueError("Argument 'weights' has the wrong length for the given shape.")
+
+        parts = np.split(weights, np.cumsum([
+            n_hidden * n_inputs, n_hidden, n_outputs * n_hidden]))
+        return cls(
+            parts[0].reshape(n_hidden, n_inputs), parts[1],
+            parts[2].reshape(n_outputs, n_hidden), parts[3])
+
+    @classmethod
+    def for_entity(cls, entity, generator=None):
+        # random controller shaped after the body of an entity:
+        # one input per sensor, one output per actuated cell and more hidden units for more neural cells
+        n_inputs, n_hidden, n_outputs = entity.brain_shape()
+        return cls.random(n_inputs, n_hidden, n_outputs, generator)
+
+    @classmethod
+    def random(cls, n_inputs, n_hidden, n_outputs, generator=None, scale=0.5):
+        count = cls.parameter_count(n_inputs, n_hidden, n_outputs)
+        weights = torch.randn(count, generator=generator) * scale
+        return cls.from_vector(n_inputs, n_hidden, n_outputs, weights.numpy())
+
+    def resized(self, n_inputs, n_hidden, n_outputs, generator=None, scale=0.5):
+        # controller of a new shape, for a body which grew or lost cells
+        # the weights between inputs, hidden units and outputs both shapes have are kept, the new ones are random
+        resized = BrainController.random(n_inputs, n_hidden, n_outputs, generator, scale)
+        i = min(n_inputs, self.n_inputs)
+        h = min(n_hidden, self.n_hidden)
+        o = min(n_outputs, self.n_outputs)
+        resized.w1[:h, :i] = self.w1[:h, :i]
+        resized.b1[:h] = self.b1[:h]
+        resized.w2[:o, :h] = self.w2[:o, :h]
+        resized.b2[:o] = self.b2[:o]
+        return resized
+
+    def forward(self, inputs):
+        # unbatched reference path, only used for checking the batched evaluator
+        x = torch.as_tensor(inputs, dtype=torch.float32)
+        hidden = torch.tanh(self.w1 @ x + self.b1)
+        return torch.tanh(self.w2 @ hidden + self.b2)
+
+
+# Evaluates the controllers of all entities in one batched forward pass.
+# The weights of all controllers are zero-padded to the largest shape and stacked,
+# so a padded hidden unit computes tanh(0) = 0 and contributes nothing to the outputs.
+# The stacked tensors are only rebuilt when controllers are added or removed.
+class BrainEvaluator:
+
+    def __init__(self, num_threads=None):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self.controllers = {}       # key (usually the entity) -> BrainController
+        self.keys = []
+        self.dirty = True
+
+        self.w1 = self.b1 = self.w2 = self.b2 = None
+        self.n_inputs = np.empty(0, dtype=np.int64)
+        self.n_outputs = np.empty(0, dtype=np.int64)
+        self.output_mask = None
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def set_controller(self, key, controller):
+        self.controllers[key] = controller
+        self.dirty = True
+
+    def remove_controller(self, key):
+        if self.controllers.pop(key, None) is not None:
+            self.dirty = True
+
+    def _stack(self):
+        self.keys = list(self.controllers)
+        controllers = [self.controllers[k] for k in self.keys]
+        batch = len(controllers)
+
+        max_in = max((c.n_inputs for c in controllers), default=0)
+        max_hidden = max((c.n_hidden for c in controllers), default=0)
+        max_out = max((c.n_outputs for c in controllers), default=0)
+
+        self.w1 = torch.zeros(batch, max_hidden, max_in)
+        self.b1 = torch.zeros(batch, max_hidden)
+        self.w2 = torch.zeros(batch, max_out, max_hidden)
+        self.b2 = torch.zeros(batch, max_out)
+        for i, c in enumerate(controllers):
+            self.w1[i, :c.n_hidden, :c.n_inputs] = c.w1
+            self.b1[i, :c.n_hidden] = c.b1
+            self.w2[i, :c.n_outputs, :c.n_hidden] = c.w2
+            self.b2[i, :c.n_outputs] = c.b2
+
+        self.n_inputs = np.array([c.n_inputs for c in controllers], dtype=np.int64)
+        self.n_outputs = np.array([c.n_outputs for c in controllers], dtype=np.int64)
+        self.output_mask = torch.arange(max_out)[None, :] < torch.as_tensor(self.n_outputs)[:, None]
+        self.dirty = False
+
+        logger_brain.debug(f"Stacked {batch} controllers, padded shape ({max_in}, {max_hidden}, {max_out}).")
+
+    def gather_inputs(self, sensor_vectors):
+        # packs the sensor vectors of all controllers into one zero-padded (batch, max_inputs) array
+        if self.dirty:
+            self._stack()
+
+        inputs = np.zeros((len(self.keys), self.w1.shape[2]), dtype=np.float32)
+        for i, vector in enumerate(sensor_vectors):
+            n = min(len(vector), self.n_inputs[i])
+            inputs[i, :n] = vector[:n]
+        return inputs
+
+    def forward(self, inputs):
+        # inputs: (batch, max_inputs), rows ordered like self.keys
+        if self.dirty:
+            self._stack()
+
+        with torch.inference_mode():
+            x = torch.as_tensor(inputs, dtype=torch.float32)
+            hidden = torch.tanh(torch.baddbmm(self.b1.unsqueeze(2), self.w1, x.unsqueeze(2)))
+            outputs = torch.tanh(torch.baddbmm(self.b2.unsqueeze(2), self.w2, hidden)).squeeze(2)
+            return outputs.masked_fill(~self.output_mask, 0.0)
+
+    def step(self):
+        # gathers the sensors of all entities with a controller, runs every brain at once
+        # and scatters the results back to the entities as actuator commands
+        if self.dirty:
+            self._stack()
+        if not self.keys:
+            return None
+
+        entities = self.keys
+        inputs = self.gather_inputs(entity.sensor_inputs() for entity in entities)
+        outputs = self.forward(inputs).numpy()
+
+        for i, entity in enumerate(entities):
+            entity.apply_actuators(outputs[i, :self.n_outputs[i]])
+        return outputs
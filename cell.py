@@ -1,11 +1,18 @@
 import math
+import numpy as np
 from panda3d.core import (
     GeomVertexFormat, GeomVertexData, Geom, 
     GeomVertexWriter, GeomTriangles, GeomNode, 
-    LVector3, LColor, NodePath
+    LVector3, LColor, NodePath,
+    GeomVertexArrayFormat, InternalName
 )
 
 from common import *
+from cell_types import *
+from lattice import *
+from organism_mesher import *
+from node_pool import *
+from memory_tracker import geom_node_bytes, node_overhead_bytes
 
 logging_setup()
 logger_cell = logging.getLogger(__name__)
@@ -33,70 +40,189 @@ possible_neighbor_positions = {
         LVector3(0, -small_step, small_step)}
 
 
+# vertex format for batched cell meshes: position, normal and a per-vertex color,
+# so many cells of different types fit into one Geom
+_batch_array_format = GeomVertexArrayFormat()
+_batch_array_format.addColumn(InternalName.getVertex(), 3, Geom.NT_float32, Geom.C_point)
+_batch_array_format.addColumn(InternalName.getNormal(), 3, Geom.NT_float32, Geom.C_normal)
+_batch_array_format.addColumn(InternalName.getColor(), 4, Geom.NT_uint8, Geom.C_color)
+batch_vertex_format = GeomVertexFormat.registerFormat(GeomVertexFormat(_batch_array_format))
+
+batch_vertex_dtype = np.dtype({
+    "names": ["vertex", "normal", "color"],
+    "formats": [(np.float32, 3), (np.float32, 3), (np.uint8, 4)],
+    "offsets": [_batch_array_format.getColumn(name).getStart() for name in ("vertex", "normal", "color")],
+    "itemsize": _batch_array_format.getStride()})
+
+
+def build_cell_batch_mesh(positions, cell_types, width=0.5, name="cell_batch", face_mask=None):
+    # builds a single GeomNode for many cells at once, vectorized over all cells
+    # positions: (N, 3) cell centers relative to the node, cell_types: (N,) cell type ids
+    # face_mask: optional (N, 12) bool array, only faces marked True are emitted
+    positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    cell_types = np.asarray(cell_types, dtype=np.int64)
+    template_vertices, template_normals = rhombic_template(width)
+
+    if face_mask is None:
+        face_mask = np.ones((len(positions), len(rhombic_faces)), dtype=bool)
+    cell_ids, face_ids = np.nonzero(face_mask)
+
+    corner = np.arange(4)
+    vertex_ids = (face_ids[:, None] * 4 + corner[None, :]).reshape(-1)
+    vertex_cells = np.repeat(cell_ids, 4)
+
+    rgba = (np.array(CELL_TYPE_RGBA) * 255).round().astype(np.uint8)
+    vertices = np.empty(len(vertex_ids), dtype=batch_vertex_dtype)
+    vertices["vertex"] = template_vertices[vertex_ids] + positions[vertex_cells]
+    vertices["normal"] = template_normals[vertex_ids]
+    vertices["color"] = rgba[cell_types[vertex_cells]]
+
+    vdata = GeomVertexData(name, batch_vertex_format, Geom.UHStatic)
+    vdata.uncleanSetNumRows(len(vertices))
+    memoryview(vdata.modifyArray(0)).cast('B')[:] = vertices.tobytes()
+
+    # Two triangles for every diamond
+    starts = np.arange(len(face_ids), dtype=np.uint32) * 4
+    indices = (starts[:, None] + np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)).reshape(-1)
+
+    tris = GeomTriangles(Geom.UHStatic)
+    tris.setIndexType(Geom.NT_uint32)
+    index_array = tris.modifyVertices()
+    index_array.uncleanSetNumRows(len(indices))
+    memoryview(index_array).cast('B')[:] = indices.tobytes()
+
+    geom = Geom(vdata)
+    geom.addPrimitive(tris)
+    node = GeomNode(name)
+    node.addGeom(geom)
+    return node
+
+
+def build_organism_node(organism, width=0.5, name="organism"):
+    # one GeomNode for the cells of an OrganismMesh (organism_mesher.py), faces hidden between cells are left out
+    lattice_positions, cell_types, mask = organism.arrays()
+    return build_cell_batch_mesh(from_lattice(lattice_positions, width), cell_types, width, name, face_mask=mask)
+
+
+# every cell node references the same Geom (one per cell width), only position, rotation and color differ
+_shared_cell_nodes = {}
+_neighbor_offsets = {}
+
+all_neighbors_free = (1 << neighbor_count) - 1
+
+
+def shared_cell_node(width=0.5):
+    node = _shared_cell_nodes.get(width)
+    if node is None:
+        node = Cell.generate_rhombic_dodecahedron(LVector3(0, 0, 0), width).node()
+        _shared_cell_nodes[width] = node
+    return node
+
+
+def neighbor_offsets(width=0.5):
+    # the 18 neighbor positions around a cell in world units, in lattice direction order
+    offsets = _neighbor_offsets.get(width)
+    if offsets is None:
+        offsets = [LVector3(*(c * width / 4 for c in offset)) for offset in NEIGHBOR_OFFSETS.tolist()]
+        _neighbor_offsets[width] = offsets
+    return offsets
+
+
+def cell_geometry_bytes(extra_nodes=()):
+    # shared cell Geoms, pooled cell and entity nodes and extra GeomNodes (for example batched phenotype meshes)
+    seen = set()
+    total = sum(geom_node_bytes(node, seen) for node in _shared_cell_nodes.values())
+    total += sum(geom_node_bytes(node, seen) for node in extra_nodes)
+    total += (node_pool.in_use + node_pool.free_count()) * node_overhead_bytes
+    return total
+
+
 # Class for creating position, geometry and color
+# Cells use __slots__ instead of a per-instance __dict__, organisms consist of many small cells.
+# The scene-graph node is only created when the cell is rendered, so headless cells are plain data.
 class Cell:
-    def __init__(self, pos, hpr, hex_color="#ffb226", geometry_type="rhombic_dodecahedron", width=0.5):
+    __slots__ = ("pos", "hpr", "width", "free_neighbor_mask", "color", "node_path", "sensor_value")
+
+    # entry of the cell-type registry (cell_types.py), set by every subclass
+    cell_type = CELL_TYPES[cell_type_id("Base")]
+
+    def __init__(self, pos, hpr, hex_color=None, geometry_type="rhombic_dodecahedron", width=0.5):
        
         if geometry_type != 'rhombic_dodecahedron':
             raise TypeError(f"Argument 'geometry_type' must be 'rhombic_dodecahedron'.")
         
         self.pos = LVector3(pos)
+        self.hpr = hpr
         self.width = width
 
-        step = width/2                                                      
-        small_step = step/2
+        # Bit d is set while the neighbor position in lattice direction d (see lattice.py) is free
+        self.free_neighbor_mask = all_neighbors_free
 
-        # A dictionary of positions around the cell
-        # "True" means that the position is currently free for another cell
-        
-        self.free_neighbor_positions = [LVector3(0, step, 0),                        
-                                    LVector3(0, 0, step),                        
-                                    LVector3(step, 0, 0),                        
-                                    LVector3(0, -step, 0),                       
-                                    LVector3(0, 0, -step),                       
-                                    LVector3(-step, 0, 0),                       
-                                    LVector3(0, small_step, small_step),
-                                    LVector3(small_step, small_step, 0),
-                                    LVector3(small_step, 0, small_step),
-                                    LVector3(0, -small_step, -small_step),
-                                    LVector3(-small_step, -small_step, 0),
-                                    LVector3(-small_step, 0, -small_step),
-                                    LVector3(small_step, -small_step, 0),
-                                    LVector3(-small_step, small_step, 0),
-                                    LVector3(small_step, 0, -small_step),
-                                    LVector3(-small_step, 0, small_step),
-                                    LVector3(0, small_step, -small_step),
-                                    LVector3(0, -small_step, small_step)]
-              
-        
-        self.width = width       
+        # Colors come pre-parsed from the registry, only an explicitly given color is parsed here
+        self.color = self.cell_type.rgba if hex_color is None else hex_to_rgba_tuple(hex_color)
+
+        self.node_path = None
+        self.sensor_value = 0.0
+
+    @property
+    def gravity(self):
+        return self.cell_type.gravity
+
+    @property
+    def free_neighbor_positions(self):
+        # offsets of all free neighbor positions, relative to the cell
+        offsets = neighbor_offsets(self.width)
+        return [offsets[d] for d in self.free_directions()]
+
+    def free_directions(self):
+        mask = self.free_neighbor_mask
+        return [d for d in range(neighbor_count) if mask >> d & 1]
+
+    def neighbor_offset(self, direction):
+        return neighbor_offsets(self.width)[direction]
+
+    def occupy_neighbor(self, direction):
+        self.free_neighbor_mask &= ~(1 << direction)
+
+    def release_neighbor(self, direction):
+        self.free_neighbor_mask |= 1 << direction
+
+    def _new_node_path(self):
+        node = GeomNode('rhombic_cell')
+        node.addGeomsFrom(shared_cell_node(self.width))
+        return NodePath(node)
 
-        if geometry_type == "rhombic_dodecahedron":
-            self.node_path = self.generate_rhombic_dodecahedron(self.pos, self.width)
-        else:
-            raise ValueError(f"Unsupported geometry: {geometry_type}")
+    def create_node_path(self):
+        # cell nodes are recycled through the node pool, they only differ in position, rotation and color
+        node_path = node_pool.acquire(("cell", self.width), self._new_node_path)
 
         # Set Position and Rotation
-        self.node_path.setPos(pos)
-        self.node_path.setHpr(hpr)
- 
-        # Apply Color
-        self.set_hex_color(hex_color)
-        
-        # Apply gravity
-        self.gravity = False
+        node_path.setPos(self.pos)
+        node_path.setHpr(self.hpr)
 
-    def render_cell(self):    
-        self.node_path.reparentTo(render)
+        # Apply Color
+        node_path.setColor(*self.color)
+        return node_path
+
+    def render_cell(self, parent=None):    
+        if self.node_path is None:
+            self.node_path = self.create_node_path()
+        self.node_path.reparentTo(render if parent is None else parent)
+
+    def release_node(self):
+        # hands the scene-graph node back to the pool, for example when the cell dies
+        if self.node_path is not None:
+            node_pool.release(("cell", self.width), self.node_path)
+            self.node_path = None
        
     def set_hex_color(self, hex_str):
-        hex_str = hex_str.lstrip('#')
-        r, g, b = tuple(int(hex_str[i:i+2], 16) for i in (0, 2, 4))
-        # Normalize to 0.0 - 1.0
-        self.node_path.setColor(r/255, g/255, b/255, 1.0)
+        # Normalized to 0.0 - 1.0
+        self.color = hex_to_rgba_tuple(hex_str)
+        if self.node_path is not None:
+            self.node_path.setColor(*self.color)
 
-
-    def generate_rhombic_dodecahedron(self, pos, total_width=1.0):
+    @staticmethod
+    def generate_rhombic_dodecahedron(pos, total_width=1.0):
         # s is the 'unit' size. Tips are at 2s.
         s = total_width / 4.0
         
@@ -138,23 +264,8 @@ class Cell:
             tris.addVertices(start, start + 2, start + 3)
 
         # 3. Define the 12 Diamond Faces
-        # Top Cap (Connected to +Z tip: index 12)
-        add_face(12, 0, 10, 4) # Top-Front (+Y)
-        add_face(12, 4,  9, 6) # Top-Left (-X)
-        add_face(12, 6, 11, 2) # Top-Back (-Y)
-        add_face(12, 2,  8, 0) # Top-Right (+X)
-
-        # Bottom Cap (Connected to -Z tip: index 13)
-        add_face(5, 10, 1, 13) # Bottom-Front (+Y)
-        add_face(7, 9, 5, 13) # Bottom-Left (-X)
-        add_face(3, 11, 7, 13) # Bottom-Back (-Y)
-        add_face(1, 8, 3, 13) # Bottom-Right (+X)
-
-        # Middle Ring (Side connectors)
-        add_face(1, 10, 0, 8)  # Side +X/+Y
-        add_face(5, 9, 4, 10)  # Side +Y/-X
-        add_face(7, 11, 6, 9) # Side -X/-Y
-        add_face(3, 8, 2, 11)  # Side -Y/+X
+        for face in rhombic_faces:
+            add_face(*face)
 
         # 4. Finalize
         geom = Geom(vdata)
@@ -164,148 +275,94 @@ class Cell:
         return NodePath(node)
 
 
-
 class BaseCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#ffb226", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color="#ffb226", geometry_type="rhombic_dodecahedron", width=0.5)
-        
-        logger_cell.info("------------- Generating Base-Cell -------------")
-        
-                
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Base")]
 
 
 class BoneCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#bebebe", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type)
-     
-        logger_cell.info("------------- Generating Bone-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Bone")]
 
 
 class GliderCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#c84708", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Glider-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Glider")]
 
 
 class MuscleCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#c80808", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Muscle-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Muscle")]
 
 
 class FinCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#af7202", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Fin-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Fin")]
 
 
 class HardCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#1f1f1f", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Base-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Hard")]
 
 
 class OpticCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#486bff", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Optic-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Optic")]
+
 
 class FoodIngestionCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#d94c4c", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color="#ffb226", geometry_type="rhombic_dodecahedron", width=0.5)
-     
-        logger_cell.info("------------- Generating Food-Ingestion-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("FoodIngestionCell")]
 
 
 class GastricCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#d95730", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color="#ffb226", geometry_type="rhombic_dodecahedron", width=0.5)
-     
-        logger_cell.info("------------- Generating Gastric-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Gastric")]
 
 
 class ExcretionCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#d95730", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Excretion-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Excretion")]
 
 
 class EnergyStorageCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#cea476", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Energy-Storage-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("EnergyStorage")]
 
 
 class NeuralCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#1ad4e3", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Base-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Neural")]
+
 
 class PhotosyntheticCell(Cell):
-    def __init__(self, pos, hpr, hex_color="#168e20", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-     
-        logger_cell.info("------------- Generating Photosynthetic-Cell -------------")
-        
-            
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("Photosynthetic")]
+
 
 class PlantNodeCell(PhotosyntheticCell):
-    def __init__(self, pos, hpr, hex_color="#115a17", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-                  
-        logger_cell.info("------------- Generating Plant-Node-Cell -------------")
-        
-           
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("PlantNode")]
 
 
 class PlantLeafCell(PhotosyntheticCell):
-    def __init__(self, pos, hpr, hex_color="#17af24", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-             
-        logger_cell.info("------------- Generating Plant-Node-Cell -------------")
-        
-          
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("PlantLeafCell")]
 
 
 class PlantRootCell(PhotosyntheticCell):
-    def __init__(self, pos, hpr, hex_color="#593912", geometry_type="rhombic_dodecahedron", width=0.5):
-        super().__init__(pos, hpr, hex_color, geometry_type, width)
-             
-        logger_cell.info("------------- Generating Plant-Node-Cell -------------")
-               
-        self.gravity = False
-
+    __slots__ = ()
+    cell_type = CELL_TYPES[cell_type_id("PlantRoot")]
 
 
+# cell classes by type id, the single factory below creates every kind of cell from them
+cell_class_by_id = [None] * cell_type_count
+for _cls in (BaseCell, BoneCell, GliderCell, MuscleCell, FinCell, HardCell, OpticCell,
+             FoodIngestionCell, GastricCell, ExcretionCell, EnergyStorageCell, NeuralCell,
+             PhotosyntheticCell, PlantNodeCell, PlantLeafCell, PlantRootCell):
+    cell_class_by_id[_cls.cell_type.type_id] = _cls
 
 
+def create_cell(cell_type, pos, hpr=(0, 0, 0), width=0.5):
+    # cell_type: type id, type name or CellType of the registry
+    return cell_class_by_id[resolve_cell_type(cell_type).type_id](pos, hpr, width=width)
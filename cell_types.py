@@ -0,0 +1,81 @@
+# Registry of cell types, indexed by small integer ids shared by genomes, phenotypes and entities.
+# Colors are parsed once here instead of once per cell, and the behaviour flags replace
+# type checks on strings or classes wherever systems only need to know what a cell does.
+# This module must stay free of Panda3D, it is imported by headless evolution workers.
+# The names are the type strings accepted by Entity.add_cell.
+
+
+def hex_to_rgba_tuple(hex_str):
+    hex_str = hex_str.lstrip('#')
+    r, g, b = tuple(int(hex_str[i:i+2], 16) / 255.0 for i in (0, 2, 4))
+    return (r, g, b, 1.0)
+
+
+class CellType:
+    __slots__ = ("type_id", "name", "hex_color", "rgba", "photosynthetic", "actuated", "sensor", "neural", "gravity")
+
+    def __init__(self, type_id, name, hex_color, photosynthetic=False, actuated=False,
+                 sensor=False, neural=False, gravity=False):
+        self.type_id = type_id
+        self.name = name
+        self.hex_color = hex_color
+        self.rgba = hex_to_rgba_tuple(hex_color)
+        self.photosynthetic = photosynthetic     # gains energy from light
+        self.actuated = actuated                 # driven by a brain output (muscles, fins, gliders)
+        self.sensor = sensor                     # feeds a brain input
+        self.neural = neural                     # adds hidden units to the brain
+        self.gravity = gravity
+
+    def __repr__(self):
+        return f"CellType({self.type_id}, '{self.name}')"
+
+
+cell_type_table = [
+    # (name, hex color, behaviour)
+    ("Base", "#ffb226", {}),
+    ("Bone", "#bebebe", {}),
+    ("EnergyStorage", "#cea476", {}),
+    ("Excretion", "#d95730", {}),
+    ("Glider", "#c84708", {"actuated": True}),
+    ("Fin", "#af7202", {"actuated": True}),
+    ("FoodIngestionCell", "#d94c4c", {}),
+    ("Gastric", "#d95730", {}),
+    ("Hard", "#1f1f1f", {}),
+    ("Muscle", "#c80808", {"actuated": True}),
+    ("Neural", "#1ad4e3", {"neural": True}),
+    ("Optic", "#486bff", {"sensor": True}),
+    ("Photosynthetic", "#168e20", {"photosynthetic": True}),
+    ("PlantLeafCell", "#17af24", {"photosynthetic": True}),
+    ("PlantRoot", "#593912", {"photosynthetic": True}),
+    ("PlantNode", "#115a17", {"photosynthetic": True}),
+]
+
+CELL_TYPES = tuple(
+    CellType(type_id, name, hex_color, **behaviour)
+    for type_id, (name, hex_color, behaviour) in enumerate(cell_type_table))
+
+CELL_TYPE_NAMES = tuple(cell_type.name for cell_type in CELL_TYPES)
+CELL_TYPE_IDS = {name: type_id for type_id, name in enumerate(CELL_TYPE_NAMES)}
+CELL_TYPE_RGBA = tuple(cell_type.rgba for cell_type in CELL_TYPES)
+cell_type_count = len(CELL_TYPES)
+
+
+def cell_type_id(name):
+    try:
+        return CELL_TYPE_IDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown cell type '{name}'.") from None
+
+
+def resolve_cell_type(cell_type):
+    # accepts a type id, a type name or a CellType and returns the CellType
+    if isinstance(cell_type, CellType):
+        return cell_type
+    if isinstance(cell_type, str):
+        return CELL_TYPES[cell_type_id(cell_type)]
+    return CELL_TYPES[int(cell_type)]
+
+
+def type_ids_with(flag):
+    # ids of all cell types with a behaviour flag set, for example type_ids_with("photosynthetic")
+    return [cell_type.type_id for cell_type in CELL_TYPES if getattr(cell_type, flag)]
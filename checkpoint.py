@@ -0,0 +1,162 @@
+import json
+import logging
+
+import numpy as np
+import torch
+
+from common import *
+from cell_types import *
+from rng_streams import *
+from entity import *
+from brain import *
+from nutrients import *
+from scheduler import *
+
+logging_setup()
+logger_checkpoint = logging.getLogger(__name__)
+
+checkpoint_version = 2
+
+
+# Checkpoints hold the complete state of a Simulation in one compressed .npz file.
+# Per-cell and per-entity data is stored as flat typed columns (cells of all entities concatenated,
+# with per-entity counts), small scalars and random generator states go into a JSON header.
+# Loading a checkpoint and stepping on gives exactly the same results as never having stopped.
+# The terrain is not stored, only the edits made to it (Simulation.terrain_edits).
+
+
+def _concat(arrays, dtype):
+    arrays = [np.asarray(a, dtype=dtype).reshape(-1) for a in arrays]
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    data = np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+    return data, lengths
+
+
+def _split(data, lengths):
+    return np.split(data, np.cumsum(lengths)[:-1]) if len(lengths) else []
+
+
+def _controller_vector(controller):
+    return torch.cat([controller.w1.reshape(-1), controller.b1, controller.w2.reshape(-1), controller.b2]).numpy()
+
+
+def save_checkpoint(simulation, path):
+    states = [entity.get_state() for entity in simulation.entities]
+
+    header = {
+        "version": checkpoint_version,
+        "master_seed": simulation.master_seed,
+        "tick": simulation.tick,
+        "tick_dt": simulation.tick_dt,
+        "accumulator": simulation.accumulator,
+        "next_entity_id": simulation.next_entity_id,
+        "entity_rngs": [rng_state(state["rng"]) for state in states],
+        "controller_order": [entity.entity_id for entity in simulation.brains.controllers],
+        "nutrients": None,
+    }
+
+    header["events"], event_arrays = simulation.events.get_state()
+
+    nutrient_arrays = {}
+    if simulation.nutrients is not None:
+        header["nutrients"], nutrient_arrays = simulation.nutrients.get_state()
+
+    cell_types, cell_counts = _concat(
+        [[cell_type_id(name) for name in state["cell_types"]] for state in states], np.uint8)
+    cell_positions, _ = _concat([state["cell_positions"] for state in states], np.float64)
+    free_masks, _ = _concat([state["free_masks"] for state in states], np.uint32)
+    actuators, actuator_counts = _concat([state["actuator_commands"] for state in states], np.float32)
+    genomes, genome_lengths = _concat(
+        [np.frombuffer(state["genome"] or b"", dtype=np.uint8) for state in states], np.uint8)
+
+    controllers = [simulation.brains.controllers.get(entity) for entity in simulation.entities]
+    brain_shapes = np.array(
+        [(c.n_inputs, c.n_hidden, c.n_outputs) if c is not None else (0, 0, 0) for c in controllers],
+        dtype=np.int32).reshape(-1, 3)
+    brain_weights, _ = _concat([_controller_vector(c) for c in controllers if c is not None], np.float32)
+    terrain_edit_coords, terrain_edit_solid = simulation.terrain_edit_arrays()
+
+    np.savez_compressed(
+        path,
+        header=np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8),
+        entity_ids=np.array([state["entity_id"] for state in states], dtype=np.int64),
+        entity_pos=np.array([state["pos"] for state in states], dtype=np.float64).reshape(-1, 3),
+        entity_hpr=np.array([state["hpr"] for state in states], dtype=np.float64).reshape(-1, 3),
+        energy=np.array([state["energy"] for state in states], dtype=np.float64),
+        has_genome=np.array([state["genome"] is not None for state in states], dtype=bool),
+        cell_counts=cell_counts, cell_types=cell_types,
+        cell_positions=cell_positions, free_masks=free_masks,
+        actuator_counts=actuator_counts, actuators=actuators,
+        genome_lengths=genome_lengths, genomes=genomes,
+        brain_shapes=brain_shapes, brain_weights=brain_weights,
+        terrain_edit_coords=terrain_edit_coords, terrain_edit_solid=terrain_edit_solid,
+        **nutrient_arrays, **event_arrays, **simulation.locomotion.get_state())
+
+    logger_checkpoint.info(f"Saved checkpoint at tick {simulation.tick} with {len(states)} entities to {path}.")
+    return path
+
+
+def load_checkpoint(path, headless=True):
+    from simulation import Simulation
+
+    with np.load(path) as data:
+        data = dict(data)
+    header = json.loads(data["header"].tobytes().decode("utf-8"))
+    if header["version"] != checkpoint_version:
+        raise ValueError(f"Unsupported checkpoint version {header['version']}.")
+
+    simulation = Simulation(header["master_seed"], header["tick_dt"], headless)
+    simulation.tick = header["tick"]
+    simulation.time = simulation.tick * simulation.tick_dt
+    simulation.accumulator = header["accumulator"]
+    simulation.next_entity_id = header["next_entity_id"]
+
+    if header.get("nutrients") is not None:
+        simulation.nutrients = NutrientField.from_state(header["nutrients"], data)
+
+    cell_types = _split(data["cell_types"], data["cell_counts"])
+    cell_positions = _split(data["cell_positions"], data["cell_counts"] * 3)
+    free_masks = _split(data["free_masks"], data["cell_counts"])
+    actuators = _split(data["actuators"], data["actuator_counts"])
+    genomes = _split(data["genomes"], data["genome_lengths"])
+
+    weight_counts = [BrainController.parameter_count(*shape) if shape[0] else 0 for shape in data["brain_shapes"]]
+    brain_weights = _split(data["brain_weights"], np.array([n for n in weight_counts if n], dtype=np.int64))
+    brain_weights = iter(brain_weights)
+
+    controllers = {}
+    for i, entity_id in enumerate(data["entity_ids"]):
+        state = {
+            "entity_id": int(entity_id),
+            "pos": tuple(data["entity_pos"][i]),
+            "hpr": tuple(data["entity_hpr"][i]),
+            "energy": float(data["energy"][i]),
+            "actuator_commands": actuators[i],
+            "genome": genomes[i].tobytes() if data["has_genome"][i] else None,
+            "cell_types": [CELL_TYPE_NAMES[t] for t in cell_types[i]],
+            "cell_positions": cell_positions[i].reshape(-1, 3),
+            "free_masks": free_masks[i],
+            "rng": restore_rng(header["entity_rngs"][i]),
+        }
+        entity = Entity.from_state(state, headless)
+        simulation.entities.append(entity)
+
+        if weight_counts[i]:
+            controllers[entity.entity_id] = (entity, BrainController.from_vector(
+                *data["brain_shapes"][i], next(brain_weights)))
+
+    # controllers are re-registered in their original order, so the batched brain tensors are identical
+    for entity_id in header["controller_order"]:
+        simulation.brains.set_controller(*controllers[entity_id])
+
+    simulation.events = EventScheduler.from_state(header["events"], data)
+    for entry in simulation.events.pending("grow"):
+        simulation.growth_events[entry[3]] = entry
+    simulation.locomotion.set_state(simulation.entities, data)
+
+    # the terrain is generated by whoever loads the run, set_terrain applies these edits to it
+    for key, value in zip(map(tuple, data["terrain_edit_coords"].tolist()), data["terrain_edit_solid"].tolist()):
+        simulation.terrain_edits[key] = value
+
+    logger_checkpoint.info(f"Loaded checkpoint at tick {simulation.tick} with {len(simulation.entities)} entities.")
+    return simulation
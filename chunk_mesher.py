@@ -0,0 +1,205 @@
+import time
+
+import numpy as np
+
+
+# Vectorized meshing of voxel occupancy grids into vertex arrays, one quad per visible voxel face.
+# Works on a grid padded by one voxel on every side: the padding holds the neighbors of the meshed region
+# (neighboring chunks, or empty space), so faces at the border are culled exactly like inner faces.
+# Optionally bakes ambient occlusion and skylight into a per-vertex color, which costs no shading at render time.
+# This module must stay free of Panda3D, it is used by headless workers; world_geometry.py turns the arrays into Geoms.
+
+
+# faces in the order and corner layout of Voxel.generate_embedded: bottom, top, front, back, left, right
+FACE_NORMALS = np.array([(0, 0, -1), (0, 0, 1), (0, -1, 0), (0, 1, 0), (-1, 0, 0), (1, 0, 0)], dtype=np.int64)
+FACE_CORNERS = np.array([
+    [(0, 0, 0), (0, 1, 0), (1, 1, 0), (1, 0, 0)],
+    [(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)],
+    [(0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1)],
+    [(1, 1, 0), (0, 1, 0), (0, 1, 1), (1, 1, 1)],
+    [(0, 1, 0), (0, 0, 0), (0, 0, 1), (0, 1, 1)],
+    [(1, 0, 0), (1, 1, 0), (1, 1, 1), (1, 0, 1)]], dtype=np.int64)
+
+
+def _ao_offsets():
+    # for every face corner the two side voxels and the diagonal voxel in the layer in front of the face
+    offsets = np.zeros((6, 4, 3, 3), dtype=np.int64)
+    for f, normal in enumerate(FACE_NORMALS):
+        a, b = np.flatnonzero(normal == 0)
+        for c, corner in enumerate(FACE_CORNERS[f]):
+            side_a = normal.copy()
+            side_a[a] += 2 * corner[a] - 1
+            side_b = normal.copy()
+            side_b[b] += 2 * corner[b] - 1
+            offsets[f, c] = side_a, side_b, side_a + side_b - normal
+    return offsets
+
+
+AO_OFFSETS = _ao_offsets()
+
+# brightness of a corner by the number of occluding voxels around it (0, 1, 2, 3)
+ao_levels = np.array([1.0, 0.82, 0.65, 0.45], dtype=np.float32)
+# brightness of faces whose air voxel is covered from the sky
+skylight_shade = 0.6
+
+
+def tile_uvs(texture_coords, atlas_res=90.0, tile_full_res=18.0, inner_res=16.0, padding=1):
+    # the 4 corner UVs of an atlas tile, computed like Voxel.generate_embedded
+    pixel_u = texture_coords[0] * tile_full_res
+    pixel_v = texture_coords[1] * tile_full_res
+    u_start = (pixel_u + padding + 0.5) / atlas_res
+    v_start = (pixel_v + padding + 0.5) / atlas_res
+    u_end = (pixel_u + padding + inner_res - 0.7) / atlas_res
+    v_end = (pixel_v + padding + inner_res - 0.7) / atlas_res
+    return np.array([(u_start, v_start), (u_start, v_end), (u_end, v_end), (u_end, v_start)], dtype=np.float32)
+
+
+def pad_occupancy(grid, border=None):
+    # grid padded by one voxel, filled from 'border' (a padded grid of the surroundings) or empty
+    padded = np.zeros(np.add(grid.shape, 2), dtype=bool)
+    if border is not None:
+        padded[...] = border
+    padded[1:-1, 1:-1, 1:-1] = grid
+    return padded
+
+
+def extract_faces(padded):
+    # voxel coordinates (inside the padding) and face index of every visible face
+    size = np.subtract(padded.shape, 2)
+    inner = padded[1:-1, 1:-1, 1:-1]
+    coords = []
+    faces = []
+    for f, (nx, ny, nz) in enumerate(FACE_NORMALS):
+        neighbor = padded[1 + nx:1 + nx + size[0], 1 + ny:1 + ny + size[1], 1 + nz:1 + nz + size[2]]
+        visible = np.argwhere(inner & ~neighbor)
+        coords.append(visible)
+        faces.append(np.full(len(visible), f, dtype=np.int64))
+    return np.concatenate(coords), np.concatenate(faces)
+
+
+def grid_lookup(padded):
+    # solid(coords) for a padded grid, coords (..., 3) relative to the region inside the padding
+    def solid(coords):
+        return padded[coords[..., 0] + 1, coords[..., 1] + 1, coords[..., 2] + 1]
+    return solid
+
+
+def grid_sky_lookup(padded):
+    # covered(coords): True where a solid voxel is anywhere above, within the padded grid
+    above = np.logical_or.accumulate(padded[:, :, ::-1], axis=2)[:, :, ::-1]
+    covered = np.zeros_like(padded)
+    covered[:, :, :-1] = above[:, :, 1:]
+    return grid_lookup(covered)
+
+
+def corner_occlusion(solid, coords, faces):
+    # number of occluding voxels (0-3) at the 4 corners of every face, shape (F, 4)
+    # two occupied sides fully occlude the corner whatever the diagonal is
+    occluded = solid(coords[:, None, None, :] + AO_OFFSETS[faces])                # (F, 4, 3)
+    count = occluded.sum(axis=2)
+    return np.where(occluded[..., 0] & occluded[..., 1], 3, count)
+
+
+def mesh_faces(coords, faces, solid=None, covered=None, texture_coords=(4, 0), origin=(0, 0, 0),
+               ambient_occlusion=True, skylight=False, face_time=0.0):
+    # vertex and index arrays of explicit faces: voxel coords (F, 3) and face indices (F,)
+    # solid(coords) and covered(coords) look up neighbors for ambient occlusion and skylight
+    # returns a dict with vertex, normal, texcoord (float32), color (uint8 RGBA or None), index (uint32)
+    # and 'stats' with face count, vertex bytes and the time spent on faces and on lighting
+    start = time.perf_counter()
+    n_faces = len(faces)
+
+    vertex = (coords[:, None, :] + FACE_CORNERS[faces] + np.asarray(origin)).reshape(-1, 3).astype(np.float32)
+    normal = np.repeat(FACE_NORMALS[faces], 4, axis=0).astype(np.float32)
+    texcoord = np.tile(tile_uvs(texture_coords), (n_faces, 1))
+
+    # two triangles per quad
+    quad = np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)
+    flipped = np.array([1, 2, 3, 1, 3, 0], dtype=np.uint32)
+    face_time += time.perf_counter() - start
+
+    start = time.perf_counter()
+    color = None
+    pattern = np.broadcast_to(quad, (n_faces, 6))
+    if ambient_occlusion or skylight:
+        brightness = np.ones((n_faces, 4), dtype=np.float32)
+        if ambient_occlusion:
+            occlusion = corner_occlusion(solid, coords, faces)
+            brightness = ao_levels[occlusion]
+            # split each quad along the diagonal between its darker corners, otherwise a single dark corner
+            # bleeds across half of the face depending on the triangle order
+            flip = occlusion[:, 0] + occlusion[:, 2] < occlusion[:, 1] + occlusion[:, 3]
+            pattern = np.where(flip[:, None], flipped, quad)
+        if skylight:
+            air = coords + FACE_NORMALS[faces]
+            brightness = brightness * np.where(covered(air), skylight_shade, 1.0)[:, None]
+
+        color = np.empty((n_faces * 4, 4), dtype=np.uint8)
+        color[:, :3] = np.rint(brightness.reshape(-1, 1) * 255)
+        color[:, 3] = 255
+    light_time = time.perf_counter() - start
+
+    index = (np.arange(n_faces, dtype=np.uint32)[:, None] * 4 + pattern).reshape(-1)
+
+    vertex_bytes = vertex.nbytes + normal.nbytes + texcoord.nbytes + (color.nbytes if color is not None else 0)
+    return {
+        "vertex": vertex, "normal": normal, "texcoord": texcoord, "color": color, "index": index,
+        "stats": {
+            "faces": n_faces,
+            "vertex_bytes": vertex_bytes,
+            "color_bytes": color.nbytes if color is not None else 0,
+            "face_seconds": face_time,
+            "light_seconds": light_time,
+        },
+    }
+
+
+def mesh_arrays(padded, texture_coords=(4, 0), origin=(0, 0, 0), ambient_occlusion=True, skylight=False):
+    # vertex and index arrays of the region inside a padded occupancy grid, see mesh_faces
+    start = time.perf_counter()
+    coords, faces = extract_faces(padded)
+    face_time = time.perf_counter() - start
+    return mesh_faces(coords, faces, grid_lookup(padded), grid_sky_lookup(padded) if skylight else None,
+                      texture_coords, origin, ambient_occlusion, skylight, face_time)
+
+
+def merge_arrays(parts):
+    # concatenates the results of several mesh_faces calls into one set of arrays
+    parts = [part for part in parts if part["stats"]["faces"]]
+    if not parts:
+        return mesh_faces(np.empty((0, 3), dtype=np.int64), np.empty(0, dtype=np.int64), ambient_occlusion=False)
+    offsets = np.cumsum([0] + [len(part["vertex"]) for part in parts[:-1]])
+    merged = {name: np.concatenate([part[name] for part in parts]) for name in ("vertex", "normal", "texcoord")}
+    merged["color"] = None if parts[0]["color"] is None else np.concatenate([part["color"] for part in parts])
+    merged["index"] = np.concatenate([part["index"] + np.uint32(offset) for part, offset in zip(parts, offsets)])
+    merged["stats"] = {key: sum(part["stats"][key] for part in parts) for key in parts[0]["stats"]}
+    return merged
+
+
+# Compact vertex layout, 8 bytes instead of 32 (36 with baked lighting):
+#   position  uint8 x, y, z relative to the mesh origin, uint8 face index (FACE_NORMALS)
+#   attribute uint8 atlas tile x, tile y, corner index (tile_uvs order), baked brightness
+# A shader decodes normal and UV from the indices (see Shaders/compact_terrain.vert).
+compact_vertex_dtype = np.dtype([("position", np.uint8, 4), ("attribute", np.uint8, 4)])
+
+
+def compact_vertices(arrays, origin, texture_coords):
+    # packs the arrays of mesh_faces into the compact layout, positions relative to 'origin'
+    # raises ValueError if the mesh does not fit into 255 voxels along an axis
+    local = np.rint(arrays["vertex"] - np.asarray(origin, dtype=np.float32)).astype(np.int64)
+    if len(local) and (local.min() < 0 or local.max() > 255):
+        raise ValueError("Mesh is too large for the compact vertex format.")
+
+    # every normal is one axis direction, FACE_NORMALS order is -z, +z, -y, +y, -x, +x
+    normals = arrays["normal"].astype(np.int64)
+    axis = np.argmax(np.abs(normals), axis=1)
+    face = np.array([4, 2, 0])[axis] + (normals[np.arange(len(normals)), axis] > 0)
+
+    vertices = np.empty(len(local), dtype=compact_vertex_dtype)
+    vertices["position"][:, :3] = local
+    vertices["position"][:, 3] = face
+    vertices["attribute"][:, 0] = texture_coords[0]
+    vertices["attribute"][:, 1] = texture_coords[1]
+    vertices["attribute"][:, 2] = np.arange(len(local)) % 4
+    vertices["attribute"][:, 3] = 255 if arrays["color"] is None else arrays["color"][:, 0]
+    return vertices
@@ -0,0 +1,135 @@
+import logging
+from collections import deque
+
+from common import *
+from lattice import *
+
+logging_setup()
+logger_connectivity = logging.getLogger(__name__)
+
+
+# Connectivity of a body: which cells are still joined to the root (the BaseCell) through lattice neighbors.
+# Nodes are integer lattice coordinates (tuples). A spanning tree rooted at the root is kept with parent and
+# child links, every tree edge joins two lattice neighbors.
+# - Adding a node hangs it below its shallowest neighbor, which keeps the tree flat.
+# - Removing a leaf of the tree cannot disconnect anything and costs O(1), the common case for cells
+#   on the surface of a body.
+# - Removing an inner node only touches its subtree: every node of the subtree looks for a neighbor outside
+#   of it which is still attached, the subtree is re-hung from there breadth first, and whatever cannot be
+#   reached is returned as disconnected. The cost is O(subtree size), never O(body size) unless the root dies.
+# This module must stay free of Panda3D, it is used by headless workers.
+
+_offsets = [tuple(offset) for offset in NEIGHBOR_OFFSETS.tolist()]
+
+
+def lattice_neighbors(node):
+    x, y, z = node
+    return [(x + dx, y + dy, z + dz) for dx, dy, dz in _offsets]
+
+
+class BodyGraph:
+
+    def __init__(self, root):
+        self.root = root
+        self.parent = {root: None}
+        self.children = {root: set()}
+        self.depth = {root: 0}
+        self.rehung = 0             # nodes moved to a new parent by remove(), for profiling
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __contains__(self, node):
+        return node in self.parent
+
+    def neighbors(self, node):
+        # lattice neighbors of a node which are part of the body
+        return [n for n in lattice_neighbors(node) if n in self.parent]
+
+    def add(self, node):
+        # attaches a node to the body, it must be a lattice neighbor of a node of the body
+        if node in self.parent:
+            raise ValueError(f"Node {node} is already part of the body.")
+        neighbors = self.neighbors(node)
+        if not neighbors:
+            raise ValueError(f"Node {node} does not touch the body.")
+        parent = min(neighbors, key=self.depth.__getitem__)
+        self._link(node, parent)
+
+    def _link(self, node, parent):
+        self.parent[node] = parent
+        self.children[node] = set()
+        self.children[parent].add(node)
+        self.depth[node] = self.depth[parent] + 1
+
+    def _unlink(self, node):
+        del self.parent[node]
+        del self.children[node]
+        del self.depth[node]
+
+    def remove(self, node):
+        # removes a node, returns the nodes which lost their connection to the root (they are removed as well)
+        parent = self.parent[node]
+        orphans = self.children[node]
+        self._unlink(node)
+        if parent is not None:
+            self.children[parent].discard(node)
+        if node == self.root:
+            lost = list(self.parent)
+            self.parent, self.children, self.depth = {}, {}, {}
+            return lost
+        if not orphans:
+            return []
+
+        # the subtree below the removed node, detached from the tree
+        subtree = []
+        stack = list(orphans)
+        while stack:
+            n = stack.pop()
+            subtree.append(n)
+            stack.extend(self.children[n])
+        detached = set(subtree)
+        for n in subtree:
+            self.children[n] = set()
+
+        # nodes of the subtree touching the attached rest of the body hang from it again,
+        # the remaining nodes are reached breadth first through the subtree
+        queue = deque()
+        for n in subtree:
+            outside = [m for m in lattice_neighbors(n) if m in self.parent and m not in detached]
+            if outside:
+                queue.append(n)
+                self.parent[n] = min(outside, key=self.depth.__getitem__)
+        for n in queue:
+            detached.discard(n)
+            self.children[self.parent[n]].add(n)
+            self.depth[n] = self.depth[self.parent[n]] + 1
+        while queue:
+            n = queue.popleft()
+            for m in lattice_neighbors(n):
+                if m in detached:
+                    detached.discard(m)
+                    self._link(m, n)
+                    queue.append(m)
+
+        self.rehung += len(subtree) - len(detached)
+        lost = [n for n in subtree if n in detached]
+        for n in lost:
+            self._unlink(n)
+        return lost
+
+    @classmethod
+    def build(cls, nodes, root):
+        # graph of a whole body at once (for example a restored checkpoint), returns (graph, unreachable nodes)
+        graph = cls(root)
+        pending = set(nodes)
+        pending.discard(root)
+        queue = deque([root])
+        while queue:
+            n = queue.popleft()
+            for m in lattice_neighbors(n):
+                if m in pending:
+                    pending.discard(m)
+                    graph._link(m, n)
+                    queue.append(m)
+        return graph, [n for n in nodes if n in pending]
@@ -1,6 +1,6 @@
 import math
 
-from random import choice
+import numpy as np
 import panda3d
 from panda3d.core import (
     GeomVertexFormat, GeomVertexData, Geom,
@@ -10,94 +10,255 @@ from panda3d.core import (
 
 from common import *
 from cell import *
+from lattice import *
+from node_pool import *
+from connectivity import *
 
 logging_setup()
 logger_entity = logging.getLogger(__name__)
 
 
+# sensors every entity has: bias, energy, number of cells, height
+base_sensor_count = 4
+# actuators every entity has: growth drive
+base_actuator_count = 1
+# every neural cell adds this many hidden units to the entity's brain
+hidden_units_per_neural_cell = 4
+
+
+# seconds of simulation time between two growth steps of an entity
+growth_interval = 10.0
+
 
 class Entity:
 
-    def __init__(self, entity_pos, entity_hpr):
+    def __init__(self, entity_pos, entity_hpr, entity_id=0, rng=None, headless=False):
 
         self.entity_pos = entity_pos
         self.entity_hpr = entity_hpr
+        self.entity_id = entity_id
         self.speed = 1.0
+        self.energy = 1.0
+        self.genome = None
+
+        # every entity draws its random numbers from its own stream (see rng_streams.py),
+        # so results do not depend on the order in which entities are updated
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        # counts changes of the body, systems caching per-cell data (sunlight shadows, ...) compare it
+        self.body_version = 0
+        # counts moves of the whole entity (see locomotion.py), the body itself stays the same
+        self.move_version = 0
+
+        # headless entities keep their cells out of the scene graph (simulation server, evolution)
+        self.headless = headless
+
+        # latest outputs of the entity's brain, written by BrainEvaluator
+        self.actuator_commands = np.zeros(base_actuator_count, dtype=np.float32)
 
         # generating base-cell and cell-index for the entity
         self.base_cell = BaseCell(pos=self.entity_pos, hpr = self.entity_hpr)     
         self.cells = [self.base_cell]
 
-        # execute a function every second
-        base.taskMgr.doMethodLater(10.0, self.update_entity, "add_cell")
-            
-        for obj in self.cells:
-            obj.render_cell()
+        # cells by lattice coordinates relative to entity_pos, and which of them are still joined to the base cell
+        self.cell_at = {(0, 0, 0): self.base_cell}
+        self.body_graph = BodyGraph((0, 0, 0))
+
+        # root node of the entity, all cell nodes hang below it
+        self.node_path = None
+        if not self.headless:
+            self.node_path = node_pool.acquire("entity", lambda: NodePath("entity"))
+            self.node_path.setName(f"entity_{self.entity_id}")
+            self.node_path.reparentTo(render)
+            for obj in self.cells:
+                obj.render_cell(self.node_path)
+
+    @classmethod
+    def from_genome(cls, genome, entity_pos, entity_hpr, cache=None, **entity_args):
+        # grows an entity deterministically from a compact genome (see genome.py)
+        from genome import phenotype_cache
+        phenotype = (cache or phenotype_cache).get(genome)
 
-    def update_entity(self, task):
-        self.add_cell(self.base_cell, "EnergyStorage")
-        return task.cont
+        entity = cls(entity_pos, entity_hpr, **entity_args)
+        entity.genome = genome
+        entity.phenotype = phenotype
+
+        offsets = phenotype.positions()
+        for i in range(1, len(phenotype)):
+            contact_cell = entity.cells[phenotype.parents[i]]
+            location = LVector3(*(offsets[i] - offsets[phenotype.parents[i]]))
+            entity.add_cell(contact_cell, CELL_TYPE_NAMES[phenotype.cell_types[i]], specific_location=location)
+        return entity
+
+    def grow(self):
+        # one growth step, Simulation schedules it every growth_interval seconds (see scheduler.py)
+        if self.base_cell not in self.cells:
+            return None
+        return self.add_cell(self.base_cell, "EnergyStorage")
+
+    def lattice_key(self, pos):
+        # lattice coordinates of a position relative to the entity, they do not change when the entity moves
+        offset = pos - self.entity_pos
+        return tuple(to_lattice((offset[0], offset[1], offset[2])).tolist())
 
     def add_cell(self, contact_cell, new_cell_type, specific_location = None):
         # attach a new cell to a contact cell
+        # new_cell_type is a type name or type id of the cell-type registry (cell_types.py)
         # if no specific position is designated, the function will take free neighbor location randomly
-       
-        # check if free_neighbor_positions is empty
-        if contact_cell.free_neighbor_positions:
-   
-
-            if specific_location != None:
-                current_pos = specific_location
-            
-            # if no specific location is given, choose a random position around the cell
-            # remove that position from free_neighbor_positions
-            else:
-                current_pos = choice(contact_cell.free_neighbor_positions)
-                contact_cell.free_neighbor_positions.remove(current_pos)
-
-            match new_cell_type:
-                case "Bone":
-                    new_cell = BoneCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "EnergyStorage":
-                    new_cell = EnergyStorageCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Excretion":
-                    new_cell = ExcretionCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Glider":
-                    new_cell = GliderCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Fin":
-                    new_cell = FinCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "FoodIngestionCell":
-                    new_cell = FoodIngestionCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Gastric":
-                    new_cell = GastricCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Hard":
-                    new_cell = HardCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Muscle":
-                    new_cell = MuscleCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Neural":
-                    new_cell = NeuralCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Optic":
-                    new_cell = OpticCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "Photosynthetic":
-                    new_cell = PhotosyntheticCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "PlantLeafCell":
-                    new_cell = PlantLeafCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "PlantRoot":
-                    new_cell = PlantRootCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                case "PlantNode":
-                    new_cell = PlantNodeCell(pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
-                
-            self.cells.append(new_cell)
-            new_cell.render_cell()
+        free_directions = contact_cell.free_directions()
+
+        # check if the contact cell has any free neighbor position left
+        if not free_directions:
+            return None
+
+        if specific_location != None:
+            current_pos = LVector3(specific_location)
+            direction = direction_of(current_pos, contact_cell.width)
+
+        # if no specific location is given, choose a random position around the cell
         else:
-            pass
-            
+            direction = free_directions[self.rng.integers(len(free_directions))]
+            current_pos = contact_cell.neighbor_offset(direction)
+
+        # mark that position as taken
+        if direction is not None:
+            contact_cell.occupy_neighbor(direction)
+
+        # a position taken by a cell which grew there from another contact cell
+        key = self.lattice_key(contact_cell.pos + current_pos)
+        if key in self.cell_at:
+            return None
+
+        new_cell = create_cell(new_cell_type, pos = (contact_cell.pos + current_pos), hpr = (0,0,0))
+        self.cells.append(new_cell)
+        self.cell_at[key] = new_cell
+        self.body_graph.add(key)
+        self.body_version += 1
+        if not self.headless:
+            new_cell.render_cell(self.node_path)
+        return new_cell
+
+    def sensor_cells(self):
+        return [cell for cell in self.cells if cell.cell_type.sensor]
+
+    def actuated_cells(self):
+        return [cell for cell in self.cells if cell.cell_type.actuated]
+
+    def brain_shape(self):
+        # (inputs, hidden units, outputs) of a brain which fits the current body
+        n_neural = sum(1 for cell in self.cells if cell.cell_type.neural)
+        n_inputs = base_sensor_count + len(self.sensor_cells())
+        n_hidden = hidden_units_per_neural_cell * (1 + n_neural)
+        n_outputs = base_actuator_count + len(self.actuated_cells())
+        return n_inputs, n_hidden, n_outputs
+
+    def sensor_inputs(self):
+        # sensor vector fed into the entity's brain, laid out like brain_shape()
+        optic = [cell.sensor_value for cell in self.sensor_cells()]
+        base_sensors = [1.0, self.energy, len(self.cells) / 100.0, self.entity_pos[2] / 100.0]
+        return np.array(base_sensors + optic, dtype=np.float32)
+
+    def apply_actuators(self, commands):
+        # commands: one value in [-1, 1] per actuator, laid out like brain_shape()
+        self.actuator_commands = np.array(commands, dtype=np.float32)
+
+    def get_state(self):
+        # everything needed to rebuild the entity exactly, used by checkpoint.py
+        return {
+            "entity_id": self.entity_id,
+            "pos": tuple(self.entity_pos),
+            "hpr": tuple(self.entity_hpr),
+            "energy": self.energy,
+            "actuator_commands": self.actuator_commands,
+            "genome": self.genome,
+            "cell_types": [cell.cell_type.name for cell in self.cells],
+            "cell_positions": np.array([tuple(cell.pos) for cell in self.cells], dtype=np.float64),
+            "free_masks": np.array([cell.free_neighbor_mask for cell in self.cells], dtype=np.uint32),
+            "rng": self.rng,
+        }
+
+    @classmethod
+    def from_state(cls, state, headless=False):
+        entity = cls(LVector3(*state["pos"]), state["hpr"], state["entity_id"], state["rng"], headless)
+        entity.energy = state["energy"]
+        entity.actuator_commands = np.array(state["actuator_commands"], dtype=np.float32)
+        entity.genome = state["genome"]
+
+        # the base cell was created by the constructor, all other cells are restored in order
+        for type_name, pos in zip(state["cell_types"][1:], state["cell_positions"][1:]):
+            new_cell = create_cell(type_name, pos=LVector3(*pos), hpr=(0, 0, 0))
+            entity.cells.append(new_cell)
+            if not headless:
+                new_cell.render_cell(entity.node_path)
+
+        for cell, mask in zip(entity.cells, state["free_masks"]):
+            cell.free_neighbor_mask = int(mask)
+
+        entity.cell_at = {entity.lattice_key(cell.pos): cell for cell in entity.cells}
+        entity.body_graph, unreachable = BodyGraph.build(list(entity.cell_at), (0, 0, 0))
+        if unreachable:
+            logger_entity.warning(f"Entity {entity.entity_id}: {len(unreachable)} restored cells are not joined to the base cell.")
+        return entity
+
+    def destroy(self):
+        # removes all cells of the entity from the scene graph, their nodes go back to the pool
+        for cell in self.cells:
+            cell.release_node()
+        self.cells = []
+        if self.node_path is not None:
+            node_pool.release("entity", self.node_path)
+            self.node_path = None
 
     def remove_cell(self, cell_index):
-        pass
+        # removes a cell together with every cell which is no longer joined to the base cell without it
+        # (all of them when the base cell itself dies), frees their positions around the surviving neighbors
+        # and recycles their nodes; returns the removed cells, the given one first
+        cell = self.cells[cell_index]
+        key = self.lattice_key(cell.pos)
+        lost = [key] + self.body_graph.remove(key)
+        removed = [self.cell_at.pop(k) for k in lost]
+        if len(removed) == 1:
+            self.cells.pop(cell_index)
+        else:
+            dead = set(map(id, removed))
+            self.cells = [other for other in self.cells if id(other) not in dead]
+        self.body_version += 1
+
+        for k, dead_cell in zip(lost, removed):
+            dead_cell.release_node()
+            for direction, neighbor in enumerate(lattice_neighbors(k)):
+                other = self.cell_at.get(neighbor)
+                if other is not None:
+                    other.release_neighbor(int(OPPOSITE_DIRECTION[direction]))
+        return removed
+
+
+    def translate(self, offset):
+        # moves the entity with all its cells, their positions relative to each other stay exact
+        offset = LVector3(*offset)
+        self.entity_pos = self.entity_pos + offset
+        for cell in self.cells:
+            cell.pos += offset
+            if cell.node_path is not None:
+                cell.node_path.setPos(cell.pos)
+        self.move_version += 1
+
+
 
+def gather_cell_positions(entities):
+    # flattens the cells of all entities into arrays, so batched systems like the spatial index
+    # can work on every cell at once instead of looping over entity lists
+    # returns positions (N, 3), the index of the owning entity and the index of the cell inside it
+    counts = [len(entity.cells) for entity in entities]
+    total = sum(counts)
 
-    def move_entity(self, move_hpr, speed):
-        # move the base cell and all other cells which are attached to it
-        pass
+    positions = np.empty((total, 3), dtype=np.float64)
+    i = 0
+    for entity in entities:
+        for cell in entity.cells:
+            positions[i] = (cell.pos[0], cell.pos[1], cell.pos[2])
+            i += 1
 
+    entity_index = np.repeat(np.arange(len(entities), dtype=np.int64), counts)
+    cell_index = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    return positions, entity_index, cell_index
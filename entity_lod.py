@@ -0,0 +1,165 @@
+import logging
+
+import numpy as np
+from panda3d.core import GeomVertexFormat, GeomVertexData, Geom, GeomPoints, GeomNode
+
+from common import *
+from cell import *
+from cell_types import *
+from lattice import *
+from memory_tracker import geom_node_bytes
+from organism_mesher import *
+
+logging_setup()
+logger_lod = logging.getLogger(__name__)
+
+
+# Level of detail for whole entities, picked every frame from the distance to the camera:
+#   0  the entity's own cell nodes (one instanced node per cell)
+#   1  beyond hull_distance: one merged low-polygon hull, the body resampled onto a lattice of twice the cell
+#      width (organism_mesher.coarse_body) with the faces between its coarse cells culled, one Geom per entity
+#   2  beyond point_distance: a point in the mean color of the body; all of these entities share a single
+#      point-cloud Geom, rewritten in one copy per update
+# A level only changes once the distance passes its threshold by the hysteresis share, so entities near a
+# threshold do not switch every frame. Hulls and colors are cached per entity and rebuilt when the body changes
+# (Entity.body_version). Hidden cell nodes are stashed, so the cull traversal never visits them.
+
+_point_format = GeomVertexFormat.getV3c4()
+_point_array_format = _point_format.getArray(0)
+point_vertex_dtype = np.dtype({
+    "names": ["vertex", "color"],
+    "formats": [(np.float32, 3), (np.uint8, 4)],
+    "offsets": [_point_array_format.getColumn(name).getStart() for name in ("vertex", "color")],
+    "itemsize": _point_array_format.getStride()})
+
+_type_rgba = (np.array(CELL_TYPE_RGBA) * 255).round().astype(np.uint8)
+
+
+def lod_levels(distances, previous, thresholds, hysteresis=0.1):
+    # new level per entity: one level per threshold passed, with a band of +-hysteresis around each threshold
+    # in which an entity keeps the side it was on
+    levels = np.zeros(len(distances), dtype=np.int64)
+    for level, threshold in enumerate(thresholds, start=1):
+        levels += np.where(previous >= level, distances >= threshold * (1 - hysteresis),
+                           distances > threshold * (1 + hysteresis))
+    return levels
+
+
+def build_hull_node(lattice_positions, cell_types, width=0.5, factor=2, name="hull"):
+    coarse, coarse_types = coarse_body(lattice_positions, cell_types, factor)
+    return build_cell_batch_mesh(from_lattice(coarse, width * factor), coarse_types, width * factor, name,
+                                 face_mask=face_mask(coarse))
+
+
+class EntityLOD:
+
+    def __init__(self, parent, hull_distance=40.0, point_distance=120.0, hysteresis=0.1, point_size=3, width=0.5):
+        if point_distance < hull_distance:
+            raise ValueError("Argument 'point_distance' must not be smaller than 'hull_distance'.")
+        self.thresholds = (hull_distance, point_distance)
+        self.hysteresis = hysteresis
+        self.width = width
+        self.root = parent.attachNewNode("entity_lod")
+
+        self.levels = {}            # entity -> current level
+        self.hulls = {}             # entity -> (body_version, NodePath)
+        self.colors = {}            # entity -> (body_version, rgba uint8)
+        self.counts = [0, 0, 0]     # entities per level at the last update
+        self.hull_builds = 0
+
+        # one point per far entity, the vertex count changes with the number of far entities
+        self.point_data = GeomVertexData("entity_points", _point_format, Geom.UHDynamic)
+        self.points = GeomPoints(Geom.UHDynamic)
+        geom = Geom(self.point_data)
+        geom.addPrimitive(self.points)
+        node = GeomNode("entity_points")
+        node.addGeom(geom)
+        self.points_np = self.root.attachNewNode(node)
+        self.points_np.setRenderModeThickness(point_size)
+        self.points_np.setLightOff()
+
+    def _hull(self, entity):
+        cached = self.hulls.get(entity)
+        if cached is not None and cached[0] == entity.body_version:
+            return cached[1]
+        if cached is not None:
+            cached[1].removeNode()
+        keys = list(entity.cell_at)
+        types = [entity.cell_at[key].cell_type.type_id for key in keys]
+        hull = self.root.attachNewNode(build_hull_node(keys, types, self.width,
+                                                       name=f"hull_{entity.entity_id}"))
+        self.hulls[entity] = (entity.body_version, hull)
+        self.hull_builds += 1
+        return hull
+
+    def _color(self, entity):
+        cached = self.colors.get(entity)
+        if cached is not None and cached[0] == entity.body_version:
+            return cached[1]
+        types = [cell.cell_type.type_id for cell in entity.cells]
+        color = _type_rgba[types].mean(axis=0).round().astype(np.uint8) if types else _type_rgba[0]
+        self.colors[entity] = (entity.body_version, color)
+        return color
+
+    def _drop_hull(self, entity):
+        cached = self.hulls.pop(entity, None)
+        if cached is not None:
+            cached[1].removeNode()
+
+    def update(self, entities, camera_pos):
+        # picks the level of every entity and updates hulls and the point cloud
+        # entities which are gone since the last update release their hulls
+        present = set(entities)
+        for entity in [e for e in self.levels if e not in present]:
+            self._drop_hull(entity)
+            self.colors.pop(entity, None)
+            del self.levels[entity]
+
+        positions = np.array([tuple(entity.entity_pos) for entity in entities], dtype=np.float64).reshape(-1, 3)
+        distances = np.linalg.norm(positions - np.asarray(tuple(camera_pos), dtype=np.float64), axis=1)
+        previous = np.array([self.levels.get(entity, 0) for entity in entities], dtype=np.int64)
+        levels = lod_levels(distances, previous, self.thresholds, self.hysteresis)
+
+        # only entities which changed their level switch nodes, hulls follow their entity every update
+        for i in np.flatnonzero(levels != previous).tolist():
+            entity, level = entities[i], int(levels[i])
+            if entity.node_path is not None:
+                if level == 0:
+                    entity.node_path.unstash()
+                else:
+                    entity.node_path.stash()
+            if level != 1 and entity in self.hulls:
+                self.hulls[entity][1].stash()
+        far = []
+        for entity, level in zip(entities, levels.tolist()):
+            self.levels[entity] = level
+            if level == 1:
+                hull = self._hull(entity)
+                hull.unstash()
+                hull.setPos(entity.entity_pos)
+            elif level == 2:
+                far.append(entity)
+
+        self._write_points(far)
+        self.counts = np.bincount(levels, minlength=3).tolist()
+
+    def _write_points(self, far):
+        vertices = np.empty(len(far), dtype=point_vertex_dtype)
+        if far:
+            vertices["vertex"] = [tuple(entity.entity_pos) for entity in far]
+            vertices["color"] = [self._color(entity) for entity in far]
+        self.point_data.uncleanSetNumRows(len(far))
+        if far:
+            memoryview(self.point_data.modifyArray(0)).cast('B')[:] = vertices.tobytes()
+        self.points.clearVertices()
+        if far:
+            self.points.addConsecutiveVertices(0, len(far))
+
+    def geometry_bytes(self):
+        seen = set()
+        total = sum(geom_node_bytes(hull.node(), seen) for version, hull in self.hulls.values())
+        return total + geom_node_bytes(self.points_np.node(), seen)
+
+    def stats(self):
+        return {"full": self.counts[0], "hull": self.counts[1], "point": self.counts[2],
+                "hulls_cached": len(self.hulls), "hull_builds": self.hull_builds}
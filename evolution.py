@@ -0,0 +1,257 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+from common import *
+from genome import phenotype_fitness
+
+logging_setup()
+logger_evolution = logging.getLogger(__name__)
+
+
+# This module must stay importable without Panda3D:
+# every worker process of the pool imports it, and workers never open a window.
+# Run the evolution from here ("python evolution.py"), not from main.py,
+# because spawned workers re-import the main module of the parent process.
+
+
+def _init_worker():
+    # workers must not load the engine, which would also drag a window along in main.py
+    if "panda3d" in sys.modules or "direct" in sys.modules:
+        raise RuntimeError("Evolution workers must not import Panda3D. Start the run from evolution.py.")
+
+
+def _evaluate(job):
+    fitness_fn, genome = job
+    return fitness_fn(genome)
+
+
+def mutate(genome, rng, rate=0.01):
+    # flips random bits, at least one per genome
+    data = np.frombuffer(genome, dtype=np.uint8).copy()
+    n_bits = len(data) * 8
+    n_flips = max(1, rng.binomial(n_bits, rate))
+    bits = rng.choice(n_bits, size=n_flips, replace=False)
+    np.bitwise_xor.at(data, bits // 8, (1 << (bits % 8)).astype(np.uint8))
+    return data.tobytes()
+
+
+def crossover(genome_a, genome_b, rng):
+    # one-point crossover, the child keeps the length of the first parent
+    length = min(len(genome_a), len(genome_b))
+    if length < 2:
+        return genome_a
+    cut = int(rng.integers(1, length))
+    return genome_a[:cut] + genome_b[cut:len(genome_a)]
+
+
+class Island:
+
+    def __init__(self, genomes):
+        self.genomes = list(genomes)
+        self.fitness = np.full(len(self.genomes), -np.inf)
+
+    def best(self):
+        i = int(np.argmax(self.fitness))
+        return self.genomes[i], float(self.fitness[i])
+
+
+# Distributes fitness evaluation across a local process pool.
+# With more than one island, every island evolves on its own and the best genomes
+# migrate to the next island (ring topology) every 'migration_interval' generations.
+# Evaluations of all islands are submitted to the pool together, so islands never idle the workers.
+class EvolutionRunner:
+
+    def __init__(self, fitness_fn=phenotype_fitness, population_size=256, genome_length=96,
+                 workers=None, islands=1, migration_interval=10, migration_size=2,
+                 tournament_size=3, mutation_rate=0.01, elite=1, seed=0,
+                 initial_genomes=None, mutate_fn=mutate, crossover_fn=crossover):
+
+        if islands < 1 or population_size < islands:
+            raise ValueError("Every island needs at least one genome.")
+
+        self.fitness_fn = fitness_fn
+        self.workers = workers or os.cpu_count() or 1
+        self.migration_interval = migration_interval
+        self.migration_size = migration_size
+        self.tournament_size = tournament_size
+        self.mutation_rate = mutation_rate
+        self.elite = elite
+        self.mutate_fn = mutate_fn
+        self.crossover_fn = crossover_fn
+        self.rng = np.random.default_rng(seed)
+
+        if initial_genomes is None:
+            initial_genomes = [self.rng.bytes(genome_length) for _ in range(population_size)]
+        per_island = np.array_split(np.arange(len(initial_genomes)), islands)
+        self.islands = [Island([initial_genomes[i] for i in idx]) for idx in per_island]
+
+        self.generation = 0
+        self.evaluations = 0
+        self.eval_seconds = 0.0
+        self.history = []       # (generation, best fitness, mean fitness) per generation
+        self.pool = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self.pool is None and self.workers > 1:
+            # 'spawn' gives clean workers which do not inherit anything the parent imported
+            context = multiprocessing.get_context("spawn")
+            self.pool = context.Pool(self.workers, initializer=_init_worker)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def evaluate(self, genomes):
+        # evaluates every distinct genome once, clones share the result
+        unique = list(dict.fromkeys(genomes))
+        jobs = [(self.fitness_fn, genome) for genome in unique]
+
+        start = time.perf_counter()
+        if self.pool is None:
+            scores = [_evaluate(job) for job in jobs]
+        else:
+            chunksize = max(1, len(jobs) // (self.workers * 4))
+            scores = self.pool.map(_evaluate, jobs, chunksize=chunksize)
+        self.eval_seconds += time.perf_counter() - start
+        self.evaluations += len(jobs)
+
+        lookup = dict(zip(unique, scores))
+        return np.array([lookup[genome] for genome in genomes], dtype=np.float64)
+
+    def _evaluate_islands(self):
+        genomes = [genome for island in self.islands for genome in island.genomes]
+        scores = self.evaluate(genomes)
+        start = 0
+        for island in self.islands:
+            island.fitness = scores[start:start + len(island.genomes)]
+            start += len(island.genomes)
+
+    def _select(self, island):
+        contenders = self.rng.integers(0, len(island.genomes), self.tournament_size)
+        return island.genomes[contenders[np.argmax(island.fitness[contenders])]]
+
+    def _breed(self, island):
+        order = np.argsort(island.fitness)[::-1]
+        children = [island.genomes[i] for i in order[:self.elite]]
+        while len(children) < len(island.genomes):
+            child = self.crossover_fn(self._select(island), self._select(island), self.rng)
+            children.append(self.mutate_fn(child, self.rng, self.mutation_rate))
+        island.genomes = children
+
+    def _migrate(self):
+        # the best genomes of every island replace the worst ones of the next island
+        if len(self.islands) < 2:
+            return
+        emigrants = []
+        for island in self.islands:
+            order = np.argsort(island.fitness)[::-1][:self.migration_size]
+            emigrants.append([(island.genomes[i], island.fitness[i]) for i in order])
+
+        for i, island in enumerate(self.islands):
+            incoming = emigrants[i - 1]
+            worst = np.argsort(island.fitness)[:len(incoming)]
+            for slot, (genome, fitness) in zip(worst, incoming):
+                island.genomes[slot] = genome
+                island.fitness[slot] = fitness
+
+    def step(self):
+        # evaluates the current generation and breeds the next one
+        self._evaluate_islands()
+
+        all_fitness = np.concatenate([island.fitness for island in self.islands])
+        self.history.append((self.generation, float(all_fitness.max()), float(all_fitness.mean())))
+
+        self.generation += 1
+        if self.migration_interval and self.generation % self.migration_interval == 0:
+            self._migrate()
+
+        for island in self.islands:
+            self._breed(island)
+
+    def run(self, generations):
+        self.start()
+        start = time.perf_counter()
+        for _ in range(generations):
+            self.step()
+            logger_evolution.debug(f"Generation {self.history[-1][0]}: best {self.history[-1][1]:.3f}")
+        elapsed = time.perf_counter() - start
+        return self.report(generations, elapsed)
+
+    def best(self):
+        return max((island.best() for island in self.islands), key=lambda entry: entry[1])
+
+    def report(self, generations, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        return {
+            "workers": self.workers,
+            "islands": len(self.islands),
+            "generations": generations,
+            "seconds": elapsed,
+            "generations_per_hour": generations * 3600.0 / elapsed,
+            "evaluations_per_second": self.evaluations / elapsed,
+            "best_fitness": self.history[-1][1] if self.history else None,
+        }
+
+
+def measure_scaling(core_counts, generations=5, **runner_args):
+    # runs the same evolution with different numbers of workers and reports the speedup
+    results = []
+    for cores in core_counts:
+        with EvolutionRunner(workers=cores, **runner_args) as runner:
+            # one warm-up generation, so process start-up is not counted
+            runner.step()
+            runner.evaluations = 0
+            results.append(runner.run(generations))
+
+    base = results[0]
+    for result in results:
+        result["speedup"] = result["generations_per_hour"] / base["generations_per_hour"]
+        result["efficiency"] = result["speedup"] / (result["workers"] / base["workers"])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless evolutionary evaluation of genomes.")
+    parser.add_argument("--generations", type=int, default=20)
+    parser.add_argument("--population", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--islands", type=int, default=1)
+    parser.add_argument("--migration-interval", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scaling", action="store_true", help="measure throughput for 1..N workers")
+    args = parser.parse_args()
+
+    runner_args = dict(population_size=args.population, islands=args.islands,
+                       migration_interval=args.migration_interval, seed=args.seed)
+
+    if args.scaling:
+        max_workers = args.workers or os.cpu_count() or 1
+        core_counts = sorted({1, *[2 ** i for i in range(1, max_workers.bit_length())], max_workers})
+        for result in measure_scaling(core_counts, args.generations, **runner_args):
+            print(f"{result['workers']:>3} workers: {result['generations_per_hour']:>12.1f} generations/h, "
+                  f"speedup {result['speedup']:.2f}, efficiency {result['efficiency']:.0%}")
+        return
+
+    with EvolutionRunner(workers=args.workers, **runner_args) as runner:
+        report = runner.run(args.generations)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from common import *
+from lattice import *
+from cell_types import *
+from organism_mesher import face_mask
+
+logging_setup()
+logger_genome = logging.getLogger(__name__)
+
+
+# A genome is a plain bytes object describing a body plan, 3 bytes per gene:
+#   parent_back  which already placed cell the new cell grows from, counted backwards from the newest
+#   direction    lattice direction index (see lattice.NEIGHBOR_OFFSETS), taken modulo 18
+#   cell_type    cell type id (see cell_types.CELL_TYPE_NAMES), mapped onto the non-base types,
+#                only the root of a body is a base cell
+# Every byte string is a valid genome, so evolution can flip bits freely.
+# Trailing bytes which do not fill a whole gene are ignored.
+gene_dtype = np.dtype([("parent_back", np.uint8), ("direction", np.uint8), ("cell_type", np.uint8)])
+gene_size = gene_dtype.itemsize
+
+
+def decode_genes(genome):
+    n_genes = len(genome) // gene_size
+    return np.frombuffer(genome, dtype=gene_dtype, count=n_genes)
+
+
+def encode_genes(parent_back, directions, cell_types):
+    genes = np.empty(len(directions), dtype=gene_dtype)
+    genes["parent_back"] = parent_back
+    genes["direction"] = directions
+    genes["cell_type"] = cell_types
+    return genes.tobytes()
+
+
+def random_genome(rng, n_genes):
+    return encode_genes(
+        rng.integers(0, 8, n_genes),
+        rng.integers(0, neighbor_count, n_genes),
+        rng.integers(0, cell_type_count - 1, n_genes))
+
+
+def genome_hash(genome):
+    return hashlib.blake2b(genome, digest_size=16).hexdigest()
+
+
+# The body grown from a genome: one row per cell, in growth order.
+# Row 0 is always the base cell at the lattice origin.
+class Phenotype:
+
+    def __init__(self, genome_hash, lattice_positions, cell_types, parents):
+        self.genome_hash = genome_hash
+        self.lattice_positions = lattice_positions      # (N, 3) int, relative to the base cell
+        self.cell_types = cell_types                    # (N,) uint8 cell type ids
+        self.parents = parents                          # (N,) int, -1 for the base cell
+        self.mesh_node = None
+
+    def __len__(self):
+        return len(self.cell_types)
+
+    def positions(self, origin=(0.0, 0.0, 0.0), width=cell_width):
+        return from_lattice(self.lattice_positions, width, origin)
+
+    def mesh(self):
+        # one batched GeomNode for the whole body, built on first use and kept with the phenotype,
+        # so every entity grown from the same genome shares it
+        # Panda3D is only imported here, so headless workers can grow phenotypes without it
+        if self.mesh_node is None:
+            from cell import build_cell_batch_mesh
+            self.mesh_node = build_cell_batch_mesh(
+                self.positions(), self.cell_types, name=f"phenotype_{self.genome_hash[:8]}",
+                face_mask=face_mask(self.lattice_positions))
+        return self.mesh_node
+
+
+def grow_phenotype(genome):
+    # deterministic growth: the same genome always grows the same body
+    # if the target position of a gene is occupied, the next free direction of the parent is used,
+    # genes whose parent has no free neighbor left are skipped
+    genes = decode_genes(genome)
+
+    positions = [(0, 0, 0)]
+    cell_types = [cell_type_id("Base")]
+    parents = [-1]
+    occupied = {(0, 0, 0)}
+    offsets = [tuple(int(c) for c in offset) for offset in NEIGHBOR_OFFSETS]
+
+    for parent_back, direction, cell_type in genes.tolist():
+        n = len(positions)
+        parent = n - 1 - (parent_back % n)
+        px, py, pz = positions[parent]
+
+        for attempt in range(neighbor_count):
+            dx, dy, dz = offsets[(direction + attempt) % neighbor_count]
+            target = (px + dx, py + dy, pz + dz)
+            if target not in occupied:
+                occupied.add(target)
+                positions.append(target)
+                cell_types.append(1 + cell_type % (cell_type_count - 1))
+                parents.append(parent)
+                break
+
+    return Phenotype(
+        genome_hash(genome),
+        np.array(positions, dtype=np.int16).reshape(-1, 3),
+        np.array(cell_types, dtype=np.uint8),
+        np.array(parents, dtype=np.int32))
+
+
+# LRU cache of grown phenotypes keyed by genome hash.
+# Clones and repeated evaluations of the same genome skip growth and mesh building.
+class PhenotypeCache:
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, genome):
+        key = genome_hash(genome)
+        phenotype = self.entries.get(key)
+        if phenotype is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return phenotype
+
+        self.misses += 1
+        phenotype = grow_phenotype(genome)
+        self.entries[key] = phenotype
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return phenotype
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def mesh_nodes(self):
+        return [p.mesh_node for p in self.entries.values() if p.mesh_node is not None]
+
+    def drop_meshes(self):
+        # forgets all cached meshes, entities which still show one keep their own reference
+        for phenotype in self.entries.values():
+            phenotype.mesh_node = None
+
+
+phenotype_cache = PhenotypeCache()
+
+
+def phenotype_fitness(genome):
+    # simple body-plan fitness used by evolution.py until organisms are scored in the world:
+    # rewards many cells and photosynthetic cells high above the base cell
+    phenotype = phenotype_cache.get(genome)
+    photosynthetic = np.isin(phenotype.cell_types, type_ids_with("photosynthetic"))
+    height = phenotype.lattice_positions[:, 2].astype(np.float64)
+    return float(len(phenotype) + np.sum(np.maximum(height[photosynthetic], 0)) * 0.1)
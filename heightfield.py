@@ -0,0 +1,189 @@
+import logging
+import sys
+import time
+
+import numpy as np
+
+from common import *
+from chunk_mesher import *
+from spatial_index import pack_cell_keys
+
+logging_setup()
+logger_heightfield = logging.getLogger(__name__)
+
+
+def _expand_columns(columns, lower, upper):
+    # one (x, y, z) row for every z in [lower, upper] of every column
+    counts = np.maximum(upper - lower + 1, 0)
+    rows = np.repeat(np.arange(len(columns)), counts)
+    first = np.cumsum(counts) - counts
+    z = np.arange(counts.sum(), dtype=np.int64) - np.repeat(first, counts) + np.repeat(lower, counts)
+    return np.column_stack([columns[rows], z])
+
+
+# Terrain described by one height per column: column (x, y) is solid from z=0 up to heights[x, y].
+# Only voxels which differ from that (floating forms, drilled holes, ...) are stored explicitly as overrides,
+# so storage and meshing scale with the area of the terrain and not with its volume.
+# Regular columns are meshed directly from height differences: one top and one bottom face per column and
+# wall faces only where a neighbor column is lower. Tiles of columns containing overrides are filled into
+# a small dense grid and meshed by the generic mesher of chunk_mesher.py.
+# This module must stay free of Panda3D, it is used by headless workers.
+class HeightfieldTerrain:
+
+    def __init__(self, heights, tile_size=16):
+        self.heights = np.asarray(heights, dtype=np.int32)     # top solid z per column, -1 for empty columns
+        self.shape = self.heights.shape
+        self.tile_size = tile_size
+        self.overrides = {}     # (x, y, z) -> True for added, False for removed voxels
+        self._override_arrays = None
+        self._ceilings = None
+        # heights with a border of empty columns, so lookups outside the terrain need no extra mask
+        self._padded_heights = np.pad(self.heights, 1, constant_values=-1)
+
+    @classmethod
+    def from_heightmap(cls, h_data, x_size, y_size, max_height, **terrain_args):
+        # same column heights as the voxel fill of VoxelMesh.generate_base_terrain
+        return cls((np.asarray(h_data)[:x_size, :y_size] * max_height).astype(np.int32), **terrain_args)
+
+    def set_voxel(self, x, y, z, solid):
+        # adds or removes a single voxel, stored as an override only if it differs from the column
+        x, y, z = int(x), int(y), int(z)
+        in_column = 0 <= x < self.shape[0] and 0 <= y < self.shape[1] and 0 <= z <= self.heights[x, y]
+        if solid == in_column:
+            self.overrides.pop((x, y, z), None)
+        else:
+            self.overrides[(x, y, z)] = bool(solid)
+        self._override_arrays = None
+
+    def override_arrays(self):
+        # overrides as arrays sorted by packed key, for vectorized lookups
+        if self._override_arrays is None:
+            coords = np.array(list(self.overrides.keys()), dtype=np.int64).reshape(-1, 3)
+            values = np.array(list(self.overrides.values()), dtype=bool)
+            keys = pack_cell_keys(coords)
+            order = np.argsort(keys)
+            self._override_arrays = (coords[order], keys[order], values[order])
+        return self._override_arrays
+
+    def solid(self, coords):
+        # vectorized occupancy lookup for integer voxel coords (..., 3)
+        coords = np.asarray(coords, dtype=np.int64)
+        x = np.clip(coords[..., 0] + 1, 0, self.shape[0] + 1)
+        y = np.clip(coords[..., 1] + 1, 0, self.shape[1] + 1)
+        z = coords[..., 2]
+        result = (z >= 0) & (z <= self._padded_heights[x, y])
+
+        if self.overrides:
+            _, keys, values = self.override_arrays()
+            query = pack_cell_keys(coords)
+            slot = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+            found = keys[slot] == query
+            result = np.where(found, values[slot], result)
+        return result
+
+    def ceilings(self):
+        # highest solid z per column, overrides included
+        ceiling = self.heights.copy()
+        if self.overrides:
+            coords = self.override_arrays()[0]
+            inside = ((coords[:, 0] >= 0) & (coords[:, 0] < self.shape[0]) &
+                      (coords[:, 1] >= 0) & (coords[:, 1] < self.shape[1]))
+            columns = np.unique(coords[inside, :2], axis=0)
+            z = np.arange(max(int(coords[:, 2].max()), int(self.heights.max(initial=-1))) + 1)
+            cells = np.concatenate([np.broadcast_to(columns[:, None, :], (len(columns), len(z), 2)),
+                                    np.broadcast_to(z[None, :, None], (len(columns), len(z), 1))], axis=2)
+            solid = self.solid(cells)
+            ceiling[columns[:, 0], columns[:, 1]] = np.where(solid.any(axis=1),
+                                                             len(z) - 1 - np.argmax(solid[:, ::-1], axis=1), -1)
+        return ceiling
+
+    def covered(self, coords):
+        # True where a solid voxel is anywhere above, for skylight
+        coords = np.asarray(coords, dtype=np.int64)
+        x, y, z = coords[..., 0], coords[..., 1], coords[..., 2]
+        inside = (x >= 0) & (x < self.shape[0]) & (y >= 0) & (y < self.shape[1])
+        ceiling = self._ceilings[np.clip(x, 0, self.shape[0] - 1), np.clip(y, 0, self.shape[1] - 1)]
+        return inside & (z < ceiling)
+
+    def irregular_tiles(self):
+        # (tile x, tile y) of every tile containing overrides
+        if not self.overrides:
+            return np.empty((0, 2), dtype=np.int64)
+        coords = self.override_arrays()[0]
+        inside = ((coords[:, 0] >= 0) & (coords[:, 0] < self.shape[0]) &
+                  (coords[:, 1] >= 0) & (coords[:, 1] < self.shape[1]))
+        if not inside.all():
+            raise ValueError("Overrides outside of the heightfield are not supported.")
+        return np.unique(coords[:, :2] // self.tile_size, axis=0)
+
+    def mesh(self, texture_coords=(4, 0), ambient_occlusion=True, skylight=False):
+        # vertex and index arrays of the whole terrain (see chunk_mesher.mesh_faces)
+        start = time.perf_counter()
+        size_x, size_y = self.shape
+        tiles = self.irregular_tiles()
+        irregular = np.zeros(self.shape, dtype=bool)
+        for tx, ty in tiles:
+            irregular[tx * self.tile_size:(tx + 1) * self.tile_size, ty * self.tile_size:(ty + 1) * self.tile_size] = True
+        self._ceilings = self.ceilings()
+
+        regular = ~irregular & (self.heights >= 0)
+        columns = np.argwhere(regular)
+        tops = self.heights[regular]
+
+        coords = [np.column_stack([columns, tops]), np.column_stack([columns, np.zeros_like(tops)])]
+        faces = [np.full(len(columns), 1), np.full(len(columns), 0)]
+
+        # walls: faces of a column which stick out above its neighbor in the face direction
+        padded = np.pad(self.heights, 1, constant_values=-1)
+        padded_irregular = np.pad(irregular, 1, constant_values=False)
+        for f in (2, 3, 4, 5):
+            dx, dy, _ = FACE_NORMALS[f]
+            neighbor_tops = padded[1 + dx:1 + dx + size_x, 1 + dy:1 + dy + size_y][regular]
+            neighbor_irregular = padded_irregular[1 + dx:1 + dx + size_x, 1 + dy:1 + dy + size_y][regular]
+
+            simple = ~neighbor_irregular
+            walls = _expand_columns(columns[simple], np.maximum(neighbor_tops[simple] + 1, 0), tops[simple])
+            # next to an irregular column the neighbor voxels have to be looked up one by one
+            candidates = _expand_columns(columns[~simple], np.zeros((~simple).sum(), dtype=np.int64), tops[~simple])
+            candidates = candidates[~self.solid(candidates + FACE_NORMALS[f])]
+
+            coords += [walls, candidates]
+            faces += [np.full(len(walls), f), np.full(len(candidates), f)]
+
+        coords = np.concatenate(coords).astype(np.int64)
+        faces = np.concatenate(faces).astype(np.int64)
+        parts = [mesh_faces(coords, faces, self.solid, self.covered, texture_coords, (0, 0, 0),
+                            ambient_occlusion, skylight, time.perf_counter() - start)]
+
+        # tiles with overrides: dense grid of the tile plus a one voxel border, meshed generically
+        for tx, ty in tiles:
+            start = time.perf_counter()
+            x0, y0 = tx * self.tile_size, ty * self.tile_size
+            x1, y1 = min(x0 + self.tile_size, size_x), min(y0 + self.tile_size, size_y)
+            z1 = int(self._ceilings[x0:x1, y0:y1].max()) + 1
+            grid = np.stack(np.meshgrid(np.arange(x0 - 1, x1 + 1), np.arange(y0 - 1, y1 + 1), np.arange(-1, z1 + 1),
+                                        indexing="ij"), axis=-1)
+            tile_padded = self.solid(grid)
+            fill_time = time.perf_counter() - start
+            # the grid reaches one voxel above the highest ceiling of the tile, so skylight stays exact
+            part = mesh_arrays(tile_padded, texture_coords, (x0, y0, 0), ambient_occlusion, skylight)
+            part["stats"]["face_seconds"] += fill_time
+            parts.append(part)
+
+        arrays = merge_arrays(parts)
+        arrays["stats"]["explicit_voxels"] = len(self.overrides)
+        arrays["stats"]["irregular_tiles"] = len(tiles)
+        return arrays
+
+    def occupancy(self):
+        # dense (grid, origin) of the terrain, for systems which need the full volume (sunlight map)
+        ceiling = self.ceilings()
+        grid = np.arange(int(ceiling.max(initial=-1)) + 1)[None, None, :] <= self.heights[:, :, None]
+        for (x, y, z), solid in self.overrides.items():
+            grid[x, y, z] = solid
+        return grid, np.zeros(3, dtype=np.int64)
+
+    def storage_bytes(self):
+        # the height array plus the override dict with its key tuples
+        per_override = sys.getsizeof((0, 0, 0)) if self.overrides else 0
+        return self.heights.nbytes + sys.getsizeof(self.overrides) + len(self.overrides) * per_override
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+# Cells sit on a lattice whose unit is a quarter of the cell width (0.125 for the default width of 0.5).
+# In those units every neighbor position of Cell.free_neighbor_positions has small integer coordinates.
+# The order of NEIGHBOR_OFFSETS is the order of Cell.free_neighbor_positions,
+# so a lattice direction index means the same neighbor everywhere.
+cell_width = 0.5
+lattice_unit = cell_width / 4
+
+NEIGHBOR_OFFSETS = np.array([
+    (0, 2, 0), (0, 0, 2), (2, 0, 0),
+    (0, -2, 0), (0, 0, -2), (-2, 0, 0),
+    (0, 1, 1), (1, 1, 0), (1, 0, 1),
+    (0, -1, -1), (-1, -1, 0), (-1, 0, -1),
+    (1, -1, 0), (-1, 1, 0), (1, 0, -1),
+    (-1, 0, 1), (0, 1, -1), (0, -1, 1)], dtype=np.int64)
+
+neighbor_count = len(NEIGHBOR_OFFSETS)
+
+# OPPOSITE_DIRECTION[d] is the direction pointing back from the neighbor at d
+OPPOSITE_DIRECTION = np.array([
+    int(np.flatnonzero(np.all(NEIGHBOR_OFFSETS == -offset, axis=1))[0]) for offset in NEIGHBOR_OFFSETS
+    ], dtype=np.int64)
+
+
+_direction_lookup = {tuple(offset): d for d, offset in enumerate(NEIGHBOR_OFFSETS.tolist())}
+
+
+def direction_of(offset, width=cell_width):
+    # lattice direction index of a neighbor offset given in world units, None if it is no lattice neighbor
+    key = tuple(int(round(c / (width / 4))) for c in offset)
+    return _direction_lookup.get(key)
+
+
+def to_lattice(positions, width=cell_width):
+    # world positions -> integer lattice coordinates
+    return np.rint(np.asarray(positions, dtype=np.float64) / (width / 4)).astype(np.int64)
+
+
+def from_lattice(coords, width=cell_width, origin=(0.0, 0.0, 0.0)):
+    # integer lattice coordinates -> world positions
+    return np.asarray(coords, dtype=np.float64) * (width / 4) + np.asarray(origin, dtype=np.float64)
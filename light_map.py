@@ -0,0 +1,166 @@
+import logging
+import math
+
+import numpy as np
+
+from common import *
+from occupancy import *
+
+logging_setup()
+logger_light = logging.getLogger(__name__)
+
+
+def light_direction(hpr):
+    # direction a directional light with this heading and pitch shines in (its forward vector, as in Panda3D)
+    h, p = math.radians(hpr[0]), math.radians(hpr[1])
+    return np.array([-math.sin(h) * math.cos(p), math.cos(h) * math.cos(p), math.sin(p)])
+
+
+# Light exposure for the fixed directional light (sun) and the sky above it.
+# Instead of casting a ray per cell, the terrain is sheared into light space: walking from a voxel
+# towards the sun shifts x and y by a fixed amount per z layer, so all voxels on one (rounded) sun ray
+# share one light-space column. Per column only the highest occupied z is kept, and a point is in the
+# sun if it lies above that top. The sky map is the same with vertical columns.
+# Organisms cast shadows as well; they are kept in separate column tops, since they change every growth step.
+# Building the maps is one vectorized sweep over the z layers, a query is two array lookups per point.
+# This module must stay free of Panda3D, it is used by headless workers.
+class SunlightMap:
+
+    def __init__(self, occupancy, origin=(0, 0, 0), light_hpr=(45, -45, 0), direct=1.0, ambient=0.3):
+        self.occupancy = np.array(occupancy, dtype=bool)
+        self.origin = np.asarray(origin, dtype=np.int64)
+        self.direct = direct            # intensity of the sun, like the DirectionalLight color
+        self.ambient = ambient          # intensity of the sky, like the AmbientLight color
+
+        self.direction = light_direction(light_hpr)
+        if self.direction[2] >= 0:
+            raise ValueError("The light has to shine downwards.")
+        # x, y shift per z layer when walking from a voxel towards the light
+        self.shear = self.direction[:2] / self.direction[2]
+
+        size_x, size_y, size_z = self.occupancy.shape
+        shift = self.layer_shift(np.arange(size_z))
+        # column index u = x - shift_x(z) + offset_x, the offsets keep u, v of every grid voxel >= 0
+        self.offset = np.maximum(shift.max(axis=0, initial=0), 0)
+        low = np.minimum(shift.min(axis=0, initial=0), 0)
+        light_shape = (size_x + self.offset[0] - low[0], size_y + self.offset[1] - low[1])
+
+        # highest occupied z per column, -1 for empty columns
+        self.sun_top = np.full(light_shape, -1, dtype=np.int32)
+        self.sky_top = np.full((size_x, size_y), -1, dtype=np.int32)
+        self.organism_sun_top = np.full(light_shape, -1, dtype=np.int32)
+        self.organism_sky_top = np.full((size_x, size_y), -1, dtype=np.int32)
+
+        self.build()
+
+    @classmethod
+    def from_voxel_map(cls, voxel_map, **light_args):
+        occupancy, origin = occupancy_from_voxel_map(voxel_map)
+        return cls(occupancy, origin, **light_args)
+
+    def layer_shift(self, z):
+        return np.rint(np.multiply.outer(np.asarray(z, dtype=np.float64), self.shear)).astype(np.int64)
+
+    def columns(self, local):
+        # light-space column of local voxel coordinates (N, 3)
+        return local[:, :2] - self.layer_shift(local[:, 2]) + self.offset
+
+    def build(self):
+        # sweeps the z layers bottom up, every occupied voxel overwrites the top of its column
+        size_x, size_y, size_z = self.occupancy.shape
+        self.sun_top.fill(-1)
+        for z, (shift_x, shift_y) in enumerate(self.layer_shift(np.arange(size_z))):
+            layer = self.occupancy[:, :, z]
+            if not layer.any():
+                continue
+            u0 = self.offset[0] - shift_x
+            v0 = self.offset[1] - shift_y
+            self.sun_top[u0:u0 + size_x, v0:v0 + size_y][layer] = z
+
+        occupied = self.occupancy.any(axis=2)
+        highest = size_z - 1 - np.argmax(self.occupancy[:, :, ::-1], axis=2)
+        self.sky_top = np.where(occupied, highest, -1).astype(np.int32)
+        logger_light.debug(f"Built sunlight map with {self.sun_top.size} light columns.")
+
+    def _in_grid(self, local):
+        return np.all((local >= 0) & (local < self.occupancy.shape), axis=1)
+
+    def set_voxels(self, coords, solid):
+        # incremental update after voxels were added (solid=True) or removed (solid=False)
+        # only the columns of the changed voxels are touched
+        local = voxel_coords(coords) - self.origin
+        if not self._in_grid(local).all():
+            raise ValueError("Voxel outside of the sunlight map.")
+
+        x, y, z = local.T
+        self.occupancy[x, y, z] = solid
+        u, v = self.columns(local).T
+        if solid:
+            np.maximum.at(self.sun_top, (u, v), z)
+            np.maximum.at(self.sky_top, (x, y), z)
+            return
+
+        # removing the top voxel of a column uncovers whatever is below it
+        exposed = self.sun_top[u, v] == z
+        self._rescan_sun_columns(u[exposed], v[exposed])
+        exposed = self.sky_top[x, y] == z
+        self._rescan_sky_columns(x[exposed], y[exposed])
+
+    def _rescan_sun_columns(self, u, v):
+        if len(u) == 0:
+            return
+        size_x, size_y, size_z = self.occupancy.shape
+        z = np.arange(size_z)
+        shift = self.layer_shift(z)
+        # voxels of every column in every layer, shape (columns, layers)
+        x = u[:, None] + shift[None, :, 0] - self.offset[0]
+        y = v[:, None] + shift[None, :, 1] - self.offset[1]
+        inside = (x >= 0) & (x < size_x) & (y >= 0) & (y < size_y)
+        occupied = np.zeros(x.shape, dtype=bool)
+        occupied[inside] = self.occupancy[x[inside], y[inside], np.broadcast_to(z, x.shape)[inside]]
+        self.sun_top[u, v] = np.where(occupied, z, -1).max(axis=1)
+
+    def _rescan_sky_columns(self, x, y):
+        if len(x) == 0:
+            return
+        column = self.occupancy[x, y, :]
+        size_z = column.shape[1]
+        self.sky_top[x, y] = np.where(column.any(axis=1), size_z - 1 - np.argmax(column[:, ::-1], axis=1), -1)
+
+    def set_organisms(self, positions):
+        # replaces the organism shadow casters, positions (N, 3) of all cells of all entities
+        # rebuilt from scratch, this is one vectorized pass over the cells and only needed when bodies changed
+        self.organism_sun_top.fill(-1)
+        self.organism_sky_top.fill(-1)
+        local = voxel_coords(positions) - self.origin
+        if len(local) == 0:
+            return
+
+        u, v = self.columns(local).T
+        inside = (u >= 0) & (u < self.sun_top.shape[0]) & (v >= 0) & (v < self.sun_top.shape[1])
+        np.maximum.at(self.organism_sun_top, (u[inside], v[inside]), local[inside, 2])
+        x, y, z = local.T
+        inside = (x >= 0) & (x < self.sky_top.shape[0]) & (y >= 0) & (y < self.sky_top.shape[1])
+        np.maximum.at(self.organism_sky_top, (x[inside], y[inside]), z[inside])
+
+    def _lookup(self, top, organism_top, columns, z):
+        # True where something is above z in the column; points outside the map are never shadowed
+        inside = np.all((columns >= 0) & (columns < top.shape), axis=1)
+        shadowed = np.zeros(len(z), dtype=bool)
+        c = columns[inside]
+        # terrain shadows the voxel it fills, an organism cell only what is below it
+        shadowed[inside] = (top[c[:, 0], c[:, 1]] >= z[inside]) | (organism_top[c[:, 0], c[:, 1]] > z[inside])
+        return shadowed
+
+    def exposure(self, positions):
+        # (in_sun, under_sky) boolean arrays for world positions (N, 3)
+        local = voxel_coords(positions) - self.origin
+        z = local[:, 2]
+        in_sun = ~self._lookup(self.sun_top, self.organism_sun_top, self.columns(local), z)
+        under_sky = ~self._lookup(self.sky_top, self.organism_sky_top, local[:, :2], z)
+        return in_sun, under_sky
+
+    def light_at(self, positions):
+        # light intensity at world positions (N, 3): sun where not shadowed plus sky where open to it
+        in_sun, under_sky = self.exposure(positions)
+        return self.direct * in_sun + self.ambient * under_sky
@@ -0,0 +1,318 @@
+import logging
+
+import numpy as np
+
+from common import *
+from lattice import *
+from cell_types import *
+from region_pool import *
+
+logging_setup()
+logger_locomotion = logging.getLogger(__name__)
+
+
+# Soft-body locomotion: every entity with actuated cells (muscles, fins, gliders) is a spring-mass network,
+# one mass per cell and one spring per pair of lattice neighbors, moving through a fluid.
+# - Muscle cells contract (brain output 1) or stretch (-1) the springs they are attached to.
+# - Fin and glider cells are plates: the fluid pushes against the velocity component along their normal
+#   (quadratic drag), which gives thrust when a fin strokes and lift when a glider moves at an angle.
+#   Their brain output spreads (1) or folds (-1) the plate.
+# - Every cell has a small linear drag, so a body at rest stays at rest.
+# All cells of all entities are integrated with semi-implicit Euler in a few substeps per tick, in one block
+# or, with a RegionPool (see region_pool.py), in one block per region on its threads.
+# The lattice body plan of an entity (Cell.pos) is kept rigid: after a step the whole entity is translated
+# by the motion of its center of mass, the deformation itself only lives in this engine.
+# This module must stay free of Panda3D, it is used by headless workers.
+
+spring_stiffness = 200.0           # per unit of mass, stable with the substeps below
+spring_damping = 4.0
+muscle_contraction = 0.2            # share of the rest length a fully activated muscle contracts or stretches
+fluid_drag = 0.2                    # linear drag of every cell
+plate_drag = {"Fin": 6.0, "Glider": 12.0}
+substeps = 4
+
+_actuated_type_ids = np.array(type_ids_with("actuated"), dtype=np.int64)
+_muscle_type_id = cell_type_id("Muscle")
+_plate_coefficients = np.zeros(cell_type_count)
+for _name, _coefficient in plate_drag.items():
+    _plate_coefficients[cell_type_id(_name)] = _coefficient
+
+
+def lattice_springs(coords, entity_index):
+    # (i, j) index pairs of all cells of the same entity which are lattice neighbors, every pair once
+    # coords: (N, 3) lattice coordinates, entity_index: (N,) sorted
+    if len(coords) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    # relative to the minimum of its entity (with a margin for the neighbor offsets) every coordinate fits
+    # into 14 bits, so entity and coordinates pack into one int64 key
+    starts = np.r_[0, np.flatnonzero(np.diff(entity_index)) + 1]
+    minimum = np.minimum.reduceat(coords, starts, axis=0)
+    local = coords - np.repeat(minimum, np.diff(np.r_[starts, len(coords)]), axis=0) + 2
+    if local.max() >= (1 << 14) - 2:
+        raise ValueError("Bodies larger than 2**14 lattice units are not supported.")
+
+    def keys(c):
+        return ((entity_index << 14 | c[:, 0]) << 14 | c[:, 1]) << 14 | c[:, 2]
+
+    own = keys(local)
+    order = np.argsort(own)
+    sorted_keys = own[order]
+    pairs = []
+    # half of the directions is enough, the other half finds the same pairs from the other end
+    for offset in NEIGHBOR_OFFSETS[OPPOSITE_DIRECTION > np.arange(neighbor_count)]:
+        target = keys(local + offset)
+        slot = np.minimum(np.searchsorted(sorted_keys, target), len(sorted_keys) - 1)
+        found = sorted_keys[slot] == target
+        pairs.append(np.column_stack([np.flatnonzero(found), order[slot[found]]]))
+    return np.concatenate(pairs)
+
+
+class SpringBlock:
+    # springs and plates of a subset of the cells (whole entities), integrated on their own: springs never join
+    # two entities, so blocks do not interact and can run concurrently (see region_pool.py). Indices are local to
+    # the block; per cell, forces add up in the same order as in a block of all cells, so results do not depend
+    # on how the cells are split into blocks.
+
+    def __init__(self, cells, position, type_ids, springs):
+        self.cells = cells
+        local = np.full(len(position), -1, dtype=np.int64)
+        local[cells] = np.arange(len(cells))
+        springs = local[springs[local[springs[:, 0]] >= 0]]
+        position = position[cells]
+        type_ids = type_ids[cells]
+
+        self.spring_a, self.spring_b = springs[:, 0], springs[:, 1]
+        self.rest_length = np.linalg.norm(position[self.spring_b] - position[self.spring_a], axis=1)
+        # share of every spring end which is muscle, a spring between two muscles follows their mean activation
+        muscle_a = (type_ids[self.spring_a] == _muscle_type_id).astype(np.float64)
+        muscle_b = (type_ids[self.spring_b] == _muscle_type_id).astype(np.float64)
+        ends = np.maximum(muscle_a + muscle_b, 1)
+        self.muscle_a, self.muscle_b = muscle_a / ends, muscle_b / ends
+        self.neighbor_count = np.bincount(springs.reshape(-1), minlength=len(position))
+
+        self.plates = np.flatnonzero(_plate_coefficients[type_ids] > 0)
+        self.plate_coefficient = _plate_coefficients[type_ids[self.plates]]
+        # the springs from every plate to its neighbors, for the plate normals
+        plate_slot = np.full(len(position), -1)
+        plate_slot[self.plates] = np.arange(len(self.plates))
+        at_a, at_b = plate_slot[self.spring_a] >= 0, plate_slot[self.spring_b] >= 0
+        self.plate_link = np.concatenate([plate_slot[self.spring_a[at_a]], plate_slot[self.spring_b[at_b]]])
+        self.plate_neighbor = np.concatenate([self.spring_b[at_a], self.spring_a[at_b]])
+        self.spring_ends = np.concatenate([self.spring_a, self.spring_b])
+
+    def forces(self, position, velocity, activation):
+        force = -fluid_drag * velocity
+        if len(self.spring_a):
+            delta = position[self.spring_b] - position[self.spring_a]
+            length = np.linalg.norm(delta, axis=1)
+            direction = delta / np.maximum(length, 1e-9)[:, None]
+            contraction = muscle_contraction * (self.muscle_a * activation[self.spring_a]
+                                                + self.muscle_b * activation[self.spring_b])
+            stretch = length - self.rest_length * (1 - contraction)
+            closing = np.einsum("ij,ij->i", velocity[self.spring_b] - velocity[self.spring_a], direction)
+            spring = (spring_stiffness * stretch + spring_damping * closing)[:, None] * direction
+            spring = np.concatenate([spring, -spring])
+            for k in range(3):
+                force[:, k] += np.bincount(self.spring_ends, weights=spring[:, k], minlength=len(position))
+
+        if len(self.plates):
+            # plate normal: away from the mean of the plate's neighbors
+            plates = self.plates
+            neighbors = position[self.plate_neighbor]
+            neighbor_sum = np.column_stack([np.bincount(self.plate_link, weights=neighbors[:, k], minlength=len(plates))
+                                            for k in range(3)])
+            normal = position[plates] - neighbor_sum / np.maximum(self.neighbor_count[plates], 1)[:, None]
+            normal /= np.maximum(np.linalg.norm(normal, axis=1), 1e-9)[:, None]
+            normal_speed = np.einsum("ij,ij->i", velocity[plates], normal)
+            spread = 0.5 * (activation[plates] + 1)
+            force[plates] -= (self.plate_coefficient * spread * np.abs(normal_speed) * normal_speed)[:, None] * normal
+        return force
+
+    def integrate(self, position, velocity, activation, dt):
+        # semi-implicit Euler on the cells of the block, in place on the engine's arrays
+        block_position, block_velocity, block_activation = position[self.cells], velocity[self.cells], activation[self.cells]
+        h = dt / substeps
+        for _ in range(substeps):
+            block_velocity += h * self.forces(block_position, block_velocity, block_activation)
+            block_position += h * block_velocity
+        position[self.cells] = block_position
+        velocity[self.cells] = block_velocity
+
+
+class EntityBody:
+    # the part of the engine's arrays which only depends on the body plan of one entity, built again only
+    # when the body changes (Entity.body_version)
+
+    def __init__(self, entity):
+        self.body_version = entity.body_version
+        self.cells = list(entity.cells)
+        # the undeformed body plan, the rest lengths of the springs are taken from it
+        self.rest_position = np.array([tuple(cell.pos) for cell in self.cells], dtype=np.float64).reshape(-1, 3)
+        self.type_ids = np.fromiter((cell.cell_type.type_id for cell in self.cells), dtype=np.int64,
+                                    count=len(self.cells))
+        self.springs = lattice_springs(to_lattice(self.rest_position), np.zeros(len(self.cells), dtype=np.int64))
+
+
+class LocomotionEngine:
+
+    def __init__(self, actuator_offset=1):
+        # brain outputs before the first actuated cell (Entity: base_actuator_count)
+        self.actuator_offset = actuator_offset
+        self.entities = []
+        self.starts = np.zeros(1, dtype=np.int64)
+        self.position = np.empty((0, 3))
+        self.velocity = np.empty((0, 3))
+        self.bodies = {}            # entity id -> EntityBody
+        self.body_key = None
+        self.actuated = {}          # entity id -> (body version, has actuated cells)
+        self.steps = 0
+        self.cell_updates = 0
+
+    def rebuild(self, entities):
+        # flat arrays of the actuated entities, every entity is one slice of them
+        # only entities whose body changed are built again, the others keep their slice as it was: deformation
+        # and per-cell velocity stay. Cells which survive a body change keep their position and velocity as well,
+        # new cells start on the body plan with the mean velocity of their entity.
+        previous = {entity.entity_id: (self.starts[i], self.starts[i + 1]) for i, entity in enumerate(self.entities)}
+        positions, velocities = [], []
+        for entity in entities:
+            body = self.bodies.get(entity.entity_id)
+            span = previous.get(entity.entity_id)
+            old_position = old_velocity = None
+            if span is not None:
+                old_position, old_velocity = self.position[span[0]:span[1]], self.velocity[span[0]:span[1]]
+
+            if body is not None and body.body_version == entity.body_version and span is not None:
+                positions.append(old_position.copy())
+                velocities.append(old_velocity.copy())
+                continue
+
+            new_body = EntityBody(entity)
+            position = new_body.rest_position.copy()
+            velocity = np.zeros_like(position)
+            if span is not None and len(old_velocity):
+                velocity[:] = old_velocity.mean(axis=0)
+                row = {id(cell): k for k, cell in enumerate(body.cells)}
+                kept = [(k, row[id(cell)]) for k, cell in enumerate(new_body.cells) if id(cell) in row]
+                if kept:
+                    new_rows, old_rows = np.array(kept, dtype=np.int64).T
+                    position[new_rows] = old_position[old_rows]
+                    velocity[new_rows] = old_velocity[old_rows]
+            self.bodies[entity.entity_id] = new_body
+            positions.append(position)
+            velocities.append(velocity)
+
+        ids = {entity.entity_id for entity in entities}
+        self.bodies = {entity_id: body for entity_id, body in self.bodies.items() if entity_id in ids}
+        bodies = [self.bodies[entity.entity_id] for entity in entities]
+
+        self.entities = entities
+        counts = np.array([len(body.cells) for body in bodies], dtype=np.int64)
+        self.counts = counts
+        self.starts = np.zeros(len(entities) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.starts[1:])
+        self.entity_index = np.repeat(np.arange(len(entities), dtype=np.int64), counts)
+        self.position = np.concatenate(positions) if positions else np.empty((0, 3))
+        self.velocity = np.concatenate(velocities) if velocities else np.empty((0, 3))
+        self.type_ids = np.concatenate([body.type_ids for body in bodies]) if bodies else np.empty(0, dtype=np.int64)
+        self.rest_position = np.concatenate([body.rest_position for body in bodies]) if bodies else np.empty((0, 3))
+        self.springs = np.concatenate([body.springs + start for body, start in zip(bodies, self.starts.tolist())]
+                                      + [np.empty((0, 2), dtype=np.int64)])
+
+        # slot of every actuated cell in the concatenated actuator commands of all entities, -1 for the others
+        actuated = np.isin(self.type_ids, _actuated_type_ids)
+        self.actuator_slot = np.where(actuated, np.cumsum(actuated) - 1, -1)
+        self.actuator_counts = np.bincount(self.entity_index[actuated], minlength=len(entities))
+        self.blocks = None
+
+        # where the body plan of every entity was, to translate it by the motion of the center of mass
+        self.plan_center = self.centers(self.position)
+
+    def centers(self, position):
+        sums = np.column_stack([np.bincount(self.entity_index, weights=position[:, k], minlength=len(self.counts))
+                                for k in range(3)])
+        return sums / np.maximum(self.counts, 1)[:, None]
+
+    def activations(self):
+        # brain outputs of the actuated cells in [-1, 1], laid out like Entity.actuated_cells()
+        commands = np.zeros(int(self.actuator_counts.sum()))
+        start = 0
+        for entity, count in zip(self.entities, self.actuator_counts.tolist()):
+            values = entity.actuator_commands[self.actuator_offset:self.actuator_offset + count]
+            commands[start:start + len(values)] = values
+            start += count
+        activation = np.zeros(len(self.position))
+        slots = self.actuator_slot >= 0
+        activation[slots] = commands[self.actuator_slot[slots]]
+        return activation
+
+    def partition(self, pool=None):
+        # one block of all cells, or with a RegionPool one block per strip of regions the entities are in at this
+        # rebuild (entities leaving their region later only make the split less even, not the results different)
+        groups = [np.arange(len(self.entities))] if pool is None else pool.partition(self.plan_center)
+        self.blocks = [SpringBlock(np.flatnonzero(np.isin(self.entity_index, group)), self.rest_position,
+                                   self.type_ids, self.springs) for group in groups]
+        self.block_pool = pool
+
+    def integrate(self, dt, pool=None):
+        # semi-implicit Euler on all cells of all entities, block by block or on the threads of a RegionPool
+        if self.blocks is None or self.block_pool is not pool:
+            self.partition(pool)
+        activation = self.activations()
+
+        def integrate_block(block):
+            block.integrate(self.position, self.velocity, activation, dt)
+
+        if pool is None:
+            for block in self.blocks:
+                integrate_block(block)
+        else:
+            pool.map(integrate_block, self.blocks)
+        self.steps += 1
+        self.cell_updates += len(self.position) * substeps
+
+    def sync(self, entities):
+        # the actuated entities, rebuilding the arrays when one of them appeared, left or changed its body
+        # (see rebuild, only what changed is built again)
+        actuated = {}
+        for entity in entities:
+            cached = self.actuated.get(entity.entity_id)
+            if cached is None or cached[0] != entity.body_version:
+                cached = (entity.body_version, any(cell.cell_type.actuated for cell in entity.cells))
+            actuated[entity.entity_id] = cached
+        self.actuated = actuated
+        moving = [entity for entity in entities if actuated[entity.entity_id][1]]
+        body_key = tuple((entity.entity_id, entity.body_version) for entity in moving)
+        if body_key != self.body_key:
+            self.rebuild(moving)
+            self.body_key = body_key
+        return moving
+
+    def step(self, entities, dt, pool=None):
+        # advances the actuated entities by dt and moves their body plans along, returns the entities which moved
+        moving = self.sync(entities)
+        if not moving:
+            return []
+
+        self.integrate(dt, pool)
+        center = self.centers(self.position)
+        offsets = center - self.plan_center
+        self.plan_center = center
+        for entity, offset in zip(moving, offsets.tolist()):
+            entity.translate(offset)
+        return moving
+
+    def get_state(self):
+        # positions and velocities of every simulated cell, for checkpoint.py
+        return {"locomotion_entity_ids": np.array([entity.entity_id for entity in self.entities], dtype=np.int64),
+                "locomotion_position": self.position.copy(), "locomotion_velocity": self.velocity.copy()}
+
+    def set_state(self, entities, arrays):
+        # restores get_state() after the entities were loaded
+        self.sync(entities)
+        if [entity.entity_id for entity in self.entities] != arrays["locomotion_entity_ids"].tolist():
+            logger_locomotion.warning("Locomotion state does not match the entities, starting at rest.")
+            return
+        self.position[:] = arrays["locomotion_position"]
+        self.velocity[:] = arrays["locomotion_velocity"]
+        self.plan_center = self.centers(self.position)
@@ -1,7 +1,9 @@
+import argparse
+import json
 import logging
 import os
+import time
 from math import cos, sin, pi
-from random import choice
 import numpy as np
 import panda3d
 from direct.showbase.ShowBase import ShowBase
@@ -10,13 +12,23 @@ from panda3d.core import (
     GeomVertexWriter, GeomTriangles, GeomNode, 
     LVector3, LColor, DirectionalLight, AmbientLight, 
     WindowProperties, ClockObject, Loader, loadPrcFileData,
-    SamplerState, Texture
+    SamplerState, Texture, GraphicsWindow
 )
 
 from common import *
 from world_geometry import *
 from cell import *
 from entity import *
+from brain import *
+from simulation import *
+from memory_tracker import *
+from light_map import *
+from sim_protocol import *
+from sim_viewer import *
+from telemetry import *
+from genome import phenotype_cache
+from terrain_streaming import *
+from entity_lod import *
 
 
 """ To Do:
@@ -65,6 +77,10 @@ logger_main.info("-------- Entering main simulation script -------------")
 logger_main.info("------------------------------------------------------")
 
 
+# heading, pitch, roll of the directional light, shared by the scene light and the sunlight map
+sun_hpr = (45, -45, 0)
+
+
 def degToRad(degrees):
     return degrees * (pi / 180.0)
 
@@ -76,7 +92,9 @@ def hex_to_rgba(hex_str):
 
 
 class VoxelWorld(ShowBase):
-    def __init__(self):
+    def __init__(self, master_seed=42, checkpoint=None, memory_log=None, cell_geometry_budget_mb=None,
+                 ambient_occlusion=True, skylight=False, connect=None, compact_vertices=False, terrain_streamer=None,
+                 lod_distances=(40.0, 120.0)):
         super().__init__()   
         self.setFrameRateMeter(True)
         
@@ -94,7 +112,7 @@ class VoxelWorld(ShowBase):
         dlight = DirectionalLight('dlight')
         dlight.setColor((1, 1, 1, 1))
         dlnp = self.render.attachNewNode(dlight)
-        dlnp.setHpr(45, -45, 0) # Hpr = heading, pitch, roll
+        dlnp.setHpr(sun_hpr) # Hpr = heading, pitch, roll
         self.render.setLight(dlnp)
         alight = AmbientLight('alight')
         alight.setColor((0.3, 0.3, 0.3, 1))
@@ -131,7 +149,27 @@ class VoxelWorld(ShowBase):
         voxel_grass4 = Voxel(grass4_texture)
 
 
-        self.generate_world(100, 100, 10, voxel_grass1)       
+        self.terrain_meshes = []
+        # ambient occlusion and skylight are baked into the terrain's vertex colors while meshing
+        self.ambient_occlusion = ambient_occlusion
+        self.skylight = skylight
+        # compact terrain vertices are decoded by a shader, renderers without shaders (tinydisplay) fall back
+        self.compact_vertices = compact_vertices and self.win.getGsg().getSupportsBasicShaders()
+        if compact_vertices and not self.compact_vertices:
+            logger_main.info("Renderer has no shader support, using the standard terrain vertex format.")
+        # area the simulation runs on (sunlight map, raycaster and nutrients); with a ChunkStreamer
+        # (see terrain_streaming.py) the terrain is loaded in chunks around the camera, otherwise this area
+        # is generated once
+        self.world_size = (100, 100)
+        self.streamed_terrain = None
+        if terrain_streamer is not None:
+            self.streamed_terrain = StreamedTerrain(terrain_streamer, self.render, voxel_grass1, self.ambient_occlusion,
+                                                    self.skylight, self.compact_vertices)
+            self.setup_terrain_node(self.streamed_terrain.root, self.compact_vertices)
+            self.streamed_terrain.fill(self.camera.getPos())
+            self.taskMgr.add(self.update_terrain, "update_terrain")
+        else:
+            self.generate_world(*self.world_size, 10, voxel_grass1)       
         
         logger_main.info("------------- World Generation Complete -----------------")
         
@@ -182,50 +220,165 @@ class VoxelWorld(ShowBase):
             cell.render_cell()
 
 
-        # Generating spherical form, entirely depending on the base cell's location
-         
+        # Generating spherical form, entirely depending on the base cell's location:
+        # the base cell and its 18 lattice neighbors as one organism mesh, faces between touching cells are culled
         base_cell4 = BaseCell(pos=LVector3(20, 10, 10), hpr=(0,0,0))
-        base_cell4.render_cell()
-        cell_width = 0.5
-        step = cell_width/2 
-        small_step = step/2
-
-        cell_neighbor_positions = [LVector3(0, step, 0), 
-                                LVector3(0, 0, step),
-                                LVector3(step, 0, 0),
-                                LVector3(0, -step, 0),
-                                LVector3(0, 0, -step),
-                                LVector3(-step, 0, 0),
-                                LVector3(0, small_step, small_step),
-                                LVector3(small_step, small_step, 0),
-                                LVector3(small_step, 0, small_step),
-                                LVector3(0, -small_step, -small_step),
-                                LVector3(-small_step, -small_step, 0),
-                                LVector3(-small_step, 0, -small_step),
-                                LVector3(small_step, -small_step, 0),
-                                LVector3(-small_step, small_step, 0),
-                                LVector3(small_step, 0, -small_step),
-                                LVector3(-small_step, 0, small_step),
-                                LVector3(0, small_step, -small_step),
-                                LVector3(0, -small_step, small_step)]
-
-        for position in cell_neighbor_positions:
-            cell = PhotosyntheticCell(pos=(base_cell4.pos + position), hpr=(0,0,0)) 
-            cell.render_cell()
+        sphere = OrganismMesh()
+        sphere.add((0, 0, 0), base_cell4.cell_type.type_id)
+        for offset in NEIGHBOR_OFFSETS.tolist():
+            sphere.add(tuple(offset), cell_type_id("Photosynthetic"))
+        self.sphere_np = self.render.attachNewNode(build_organism_node(sphere, base_cell4.width, "sphere"))
+        self.sphere_np.setPos(base_cell4.pos)
+        stats = sphere.stats()
+        logger_main.info(f"Sphere organism: {stats['triangles']} triangles for {stats['cells']} cells, "
+                         f"{stats['culled_triangles']} hidden triangles culled ({stats['culled_share']:.0%}).")
 
         print("--------------- Generating Entities ----------------")
 
-        entity1 = Entity(entity_pos = LVector3(5, 3, 10), entity_hpr = (0,0,0))
-                
+        # entities live in the simulation, which runs in fixed ticks derived from one master seed
+        # with 'connect' the simulation runs in its own process (sim_server.py) and this window only views it
+        self.simulation = None
+        self.remote = None
+        if connect is not None:
+            host, _, port = connect.partition(":")
+            self.remote = RemoteView(SimulationClient(host or "127.0.0.1", int(port or default_port)), self.render,
+                                     on_voxels=self.apply_terrain_edits)
+            self.entities = []
+            self.taskMgr.add(self.update_remote, "update_remote")
+        else:
+            if checkpoint is not None:
+                self.simulation = Simulation.load_checkpoint(checkpoint, headless=False)
+            else:
+                self.simulation = Simulation(master_seed, headless=False)
+                entity1 = self.simulation.spawn_entity(entity_pos = LVector3(5, 3, 10), entity_hpr = (0,0,0))
+            self.entities = self.simulation.entities
+
+            # photosynthetic cells gain energy from the sunlight map of the terrain, shadows are precomputed per light column,
+            # optic cells see the terrain through a raycaster sharing the same occupancy grid
+            if self.streamed_terrain is not None:
+                terrain_occupancy = self.streamed_terrain.streamer.region_occupancy(0, 0, *self.world_size)
+            else:
+                terrain_occupancy = self.terrain_meshes[0].occupancy()
+            self.simulation.set_terrain(*terrain_occupancy, light_hpr=sun_hpr)
+            # terrain edits of a resumed run are drawn as well, and so are the edits the simulation makes from now on
+            if self.simulation.terrain_edits:
+                self.apply_terrain_edits(*self.simulation.terrain_edit_arrays())
+            self.simulation.voxel_changes = []
+
+            # nutrients diffuse over the terrain from scattered sources, FoodIngestion cells eat from them
+            if self.simulation.nutrients is None:
+                self.simulation.create_nutrients(self.world_size)
+            self.taskMgr.add(self.update_simulation, "update_simulation")
+            self.accept("f5", self.save_checkpoint)
+
+        # distant entities are drawn as merged hulls and, further away, as points of one shared point cloud
+        self.entity_lod = None
+        if lod_distances is not None and self.simulation is not None:
+            self.entity_lod = EntityLOD(self.render, *lod_distances)
+            self.taskMgr.add(self.update_entity_lod, "update_entity_lod")
+
+        # memory accounting per subsystem, F6 prints a report
+        self.setup_memory_tracker(memory_log, cell_geometry_budget_mb)
+
+    def update_terrain(self, task):
+        # loads chunks the camera (moved by update_camera) approaches and unloads those it left behind
+        self.streamed_terrain.update(self.camera.getPos())
+        return task.cont
+
+    def update_simulation(self, task):
+        # runs the simulation ticks due in this frame, then draws the terrain edits they made
+        self.simulation.advance(globalClock.getDt())
+        for coords, solid in self.simulation.take_voxel_changes():
+            self.apply_terrain_edits(coords, solid)
+        return task.cont
+
+    def update_entity_lod(self, task):
+        self.entity_lod.update(self.entities, self.camera.getPos(self.render))
+        return task.cont
+
+    def update_remote(self, task):
+        # applies the deltas streamed by the simulation process, interpolating between its ticks
+        self.remote.update(globalClock.getDt())
+        if not self.remote.client.connected:
+            logger_main.info("Simulation server closed the connection.")
+            return task.done
+        return task.cont
+
+    def save_checkpoint(self):
+        self.simulation.save_checkpoint(f"checkpoint_{self.simulation.tick}.npz")
+
+    def setup_memory_tracker(self, memory_log, cell_geometry_budget_mb):
+        self.memory = MemoryTracker()
+        self.memory.register("terrain_storage",
+                             lambda: sum(mesh.storage_bytes() for mesh in self.terrain_meshes))
+        self.memory.register("terrain_buffers",
+                             lambda: sum(geom_node_bytes(mesh.node) for mesh in self.terrain_meshes if mesh.node))
+        self.memory.register("cell_geometry", lambda: cell_geometry_bytes(phenotype_cache.mesh_nodes()))
+        self.memory.register("entity_data", lambda: entity_bytes(self.entities))
+        if self.entity_lod is not None:
+            self.memory.register("entity_lod", self.entity_lod.geometry_bytes)
+        if self.streamed_terrain is not None:
+            streamer = self.streamed_terrain.streamer
+            self.memory.register("terrain_chunks", streamer.bytes_used)
+            if streamer.max_bytes is not None:
+                self.memory.set_budget("terrain_chunks", streamer.max_bytes, streamer.evict_bytes)
+            # the streamer asks the tracker before it loads a chunk
+            streamer.allow = lambda extra_bytes: self.memory.allow("terrain_chunks", extra_bytes)
+
+        if cell_geometry_budget_mb is not None:
+            # only free pooled nodes and cached phenotype meshes can go, the geometry of living cells stays;
+            # the tracker reports when that is not enough to meet the budget
+            def evict_cell_geometry(excess_bytes):
+                node_pool.trim(0)
+                phenotype_cache.drop_meshes()
+            self.memory.set_budget("cell_geometry", cell_geometry_budget_mb * 2**20, evict_cell_geometry)
+
+        # budgets are enforced whether or not the counters are exported
+        if self.memory.budgets:
+            self.memory.start_budget_checks(interval=1.0, task_mgr=self.taskMgr)
+        if memory_log is not None:
+            self.memory.start_export(memory_log, interval=10.0, task_mgr=self.taskMgr)
+
+        self.accept("f6", self.print_memory_report)
+
+    def print_memory_report(self):
+        print(self.memory.format_report())
 
     def generate_world(self, x, y, max_height, voxel_object):
-        voxel_mesh = VoxelMesh(voxel_object)
+        voxel_mesh = VoxelMesh(voxel_object, self.ambient_occlusion, self.skylight, compact=self.compact_vertices)
+        self.terrain_meshes.append(voxel_mesh)
 
         # generating voxels inside a mesh
         terrain_node = voxel_mesh.generate_base_terrain(x, y, max_height) 
-        terrain_np = self.render.attachNewNode(terrain_node)
-        terrain_np.setPos(0,0,0)
+        self.terrain_np = self.render.attachNewNode(terrain_node)
+        self.terrain_np.setPos(voxel_mesh.node_origin)
+        self.setup_terrain_node(self.terrain_np, voxel_mesh.compact)
+
+    def apply_terrain_edits(self, coords, solid):
+        # terrain edits of the simulation or of its server: streamed chunks touched by them are meshed again
+        # by the next terrain update, the fixed terrain is meshed again at once
+        if self.streamed_terrain is not None:
+            for (x, y, z), value in zip(coords.tolist(), solid.tolist()):
+                self.streamed_terrain.set_voxel(x, y, z, value)
+            return
+        voxel_mesh = self.terrain_meshes[0]
+        node = voxel_mesh.set_voxels(coords, solid)
+        # the geoms are swapped in place, so texture and shader of the terrain node stay
+        terrain_node = self.terrain_np.node()
+        terrain_node.removeAllGeoms()
+        terrain_node.addGeomsFrom(node)
+        self.terrain_np.setPos(voxel_mesh.node_origin)
+        if not voxel_mesh.compact:
+            self.terrain_np.clearShader()
+
+    def setup_terrain_node(self, terrain_np, compact):
         terrain_np.setTexture(base.texture_atlas)
+        if compact:
+            # the shader replaces the fixed-function lights, so it gets the same light setup
+            terrain_np.setShader(load_compact_terrain_shader())
+            terrain_np.setShaderInput("sun_direction", LVector3(*light_direction(sun_hpr)))
+            terrain_np.setShaderInput("sun_color", LVector3(1, 1, 1))
+            terrain_np.setShaderInput("ambient_color", LVector3(0.3, 0.3, 0.3))
 
             
     def setup_controls(self):
@@ -256,6 +409,10 @@ class VoxelWorld(ShowBase):
         self.accept("lshift", self.update_key_map, ["down", True])
         self.accept("lshift-up", self.update_key_map, ["down", False])
 
+        # F7 starts and stops recording the camera path, to be replayed by benchmarks/bench_flythrough.py
+        self.camera_path = None
+        self.accept("f7", self.toggle_camera_recording)
+
         self.accept("wheel_up", self.increase_camera_speed)    
         self.accept("wheel_down", self.decrease_camera_speed) 
         
@@ -271,6 +428,10 @@ class VoxelWorld(ShowBase):
         self.camera_move_speed = self.camera_move_speed / 1.5
         
     def capture_mouse(self):
+        # offscreen buffers (benchmarks/bench_flythrough.py) have no pointer to capture
+        if not isinstance(self.win, GraphicsWindow):
+            self.camera_swing_activated = False
+            return
         self.camera_swing_activated = True
         
         md = self.win.getPointer(0)   # get mouse cursor position relative to the game window
@@ -285,11 +446,32 @@ class VoxelWorld(ShowBase):
 
     def release_mouse(self):
         self.camera_swing_activated = False
+        if not isinstance(self.win, GraphicsWindow):
+            return
         properties = WindowProperties()
         properties.setCursorHidden(False) #cursor will not be shown
         properties.setMouseMode(WindowProperties.M_absolute) #cursor will be held in the middle of the image
         self.win.requestProperties(properties)
         
+    def toggle_camera_recording(self):
+        if self.camera_path is None:
+            self.camera_path = []
+            self.taskMgr.add(self.record_camera, "record_camera")
+            logger_main.info("Recording the camera path.")
+            return
+        self.taskMgr.remove("record_camera")
+        file_name = f"camera_path_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        with open(file_name, "w") as f:
+            json.dump({"keys": self.camera_path}, f)
+        logger_main.info(f"Saved {len(self.camera_path)} camera keys to {file_name}.")
+        self.camera_path = None
+
+    def record_camera(self, task):
+        # one key per frame: [time, x, y, z, h, p, r]
+        self.camera_path.append([round(task.time, 4), *(round(v, 4) for v in self.camera.getPos(self.render)),
+                                 *(round(v, 3) for v in self.camera.getHpr(self.render))])
+        return task.cont
+
     def setup_camera(self, x, y, z):
         self.disableMouse()     # disables standart mouse navigation
         self.camera.setPos(x, y, z)
@@ -375,5 +557,45 @@ class VoxelWorld(ShowBase):
         return task.cont  
 
 
-app = VoxelWorld()
-app.run()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Voxel Evolution Simulation")
+    parser.add_argument("--seed", type=int, default=42, help="master seed of the run")
+    parser.add_argument("--resume", default=None, help="checkpoint file (.npz) to resume from")
+    parser.add_argument("--memory-log", default=None, help="append memory counters to this JSON-lines file")
+    parser.add_argument("--cell-geometry-budget-mb", type=float, default=None)
+    parser.add_argument("--no-ambient-occlusion", action="store_true", help="do not bake ambient occlusion into the terrain")
+    parser.add_argument("--connect", default=None, metavar="HOST:PORT",
+                        help="view a simulation running in sim_server.py instead of simulating in this process")
+    parser.add_argument("--compact-vertices", action="store_true",
+                        help="8-byte terrain vertices decoded by a shader (falls back without shader support)")
+    parser.add_argument("--skylight", action="store_true", help="darken terrain faces covered from the sky")
+    parser.add_argument("--telemetry", default=None, metavar="DIR", help="write population telemetry into this directory")
+    parser.add_argument("--telemetry-interval", type=float, default=1.0, help="seconds of simulation time between samples")
+    parser.add_argument("--stream-terrain", action="store_true",
+                        help="load the (unbounded) terrain in chunks around the camera instead of a fixed area")
+    parser.add_argument("--chunk-size", type=int, default=32, help="columns per side of a streamed terrain chunk")
+    parser.add_argument("--load-radius", type=float, default=3.0, help="chunks within this many chunks are loaded")
+    parser.add_argument("--unload-radius", type=float, default=5.0, help="chunks beyond this many chunks are unloaded")
+    parser.add_argument("--terrain-budget-mb", type=float, default=None, help="memory cap of the streamed terrain")
+    parser.add_argument("--terrain-dir", default=None, help="directory modified terrain chunks are saved to")
+    parser.add_argument("--lod-distances", type=float, nargs=2, default=(40.0, 120.0), metavar=("HULL", "POINT"),
+                        help="camera distances beyond which entities are drawn as merged hulls and as points")
+    parser.add_argument("--no-lod", action="store_true", help="draw every entity with all of its cells at any distance")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="run ray casting and locomotion per spatial region on this many threads")
+    args = parser.parse_args()
+
+    terrain_streamer = None
+    if args.stream_terrain:
+        terrain_streamer = ChunkStreamer(chunk_size=args.chunk_size, load_radius=args.load_radius,
+                                         unload_radius=args.unload_radius, save_dir=args.terrain_dir,
+                                         max_bytes=None if args.terrain_budget_mb is None else int(args.terrain_budget_mb * 2**20))
+
+    app = VoxelWorld(args.seed, args.resume, args.memory_log, args.cell_geometry_budget_mb,
+                     not args.no_ambient_occlusion, args.skylight, args.connect,
+                     args.compact_vertices, terrain_streamer, None if args.no_lod else tuple(args.lod_distances))
+    if args.threads is not None and app.simulation is not None:
+        app.simulation.set_workers(args.threads)
+    if args.telemetry is not None and app.simulation is not None:
+        app.simulation.telemetry = TelemetrySink(args.telemetry, args.telemetry_interval)
+    app.run()
@@ -0,0 +1,202 @@
+import json
+import logging
+import sys
+import threading
+import time
+
+from common import *
+
+logging_setup()
+logger_memory = logging.getLogger(__name__)
+
+
+# rough size of the C++ side of one GeomNode + NodePath pair without its Geom data
+node_overhead_bytes = 512
+
+
+def geom_node_bytes(node, seen=None):
+    # bytes of vertex and index data of all Geoms of a GeomNode
+    # Geoms shared between several nodes are only counted once when the same 'seen' set is passed
+    total = 0
+    for i in range(node.getNumGeoms()):
+        geom = node.getGeom(i)
+        if seen is not None:
+            if geom in seen:
+                continue
+            seen.add(geom)
+
+        vdata = geom.getVertexData()
+        for j in range(vdata.getNumArrays()):
+            total += vdata.getArray(j).getDataSizeBytes()
+        for j in range(geom.getNumPrimitives()):
+            vertices = geom.getPrimitive(j).getVertices()
+            if vertices is not None:
+                total += vertices.getDataSizeBytes()
+    return total
+
+
+def voxel_map_bytes(voxel_map):
+    # the dict itself plus one (x, y, z) key tuple per voxel, the Voxel values are shared objects
+    if not voxel_map:
+        return sys.getsizeof(voxel_map)
+    key = next(iter(voxel_map))
+    per_key = sys.getsizeof(key) + sum(sys.getsizeof(c) for c in key if not -5 <= c <= 256)
+    return sys.getsizeof(voxel_map) + len(voxel_map) * per_key
+
+
+def entity_bytes(entities):
+    # Python-side size of entities and their cells, without scene-graph nodes
+    total = 0
+    for entity in entities:
+        total += sys.getsizeof(entity) + sys.getsizeof(entity.__dict__) + sys.getsizeof(entity.cells)
+        total += entity.actuator_commands.nbytes
+        for cell in entity.cells:
+            total += sys.getsizeof(cell) + sys.getsizeof(cell.pos)
+    return total
+
+
+class Budget:
+
+    def __init__(self, max_bytes, evict=None):
+        self.max_bytes = max_bytes
+        # evict(excess_bytes) frees memory of the subsystem, returns the number of bytes it freed (or None)
+        self.evict = evict
+        self.exceeded = 0
+        # True while the subsystem stays over budget even after eviction
+        self.unmet = False
+
+
+# Accounts memory per subsystem (terrain storage, terrain GPU-side buffers, cell geometry, entity data, ...).
+# Every subsystem registers a function measuring its current size in bytes.
+# Budgets can be set per subsystem: when a budget is exceeded its eviction callback is called,
+# a budget which eviction cannot meet is reported, and allow() tells loaders whether a new allocation (for example a terrain chunk) still fits.
+class MemoryTracker:
+
+    def __init__(self):
+        self.subsystems = {}        # name -> measure function returning bytes
+        self.budgets = {}           # name -> Budget
+        self.export_file = None
+        self.periodic = {}          # name -> (task manager, stop event, thread) of a periodic export or check
+
+    def register(self, name, measure):
+        self.subsystems[name] = measure
+
+    def unregister(self, name):
+        self.subsystems.pop(name, None)
+        self.budgets.pop(name, None)
+
+    def set_budget(self, name, max_bytes, evict=None):
+        self.budgets[name] = Budget(max_bytes, evict)
+
+    def measure(self, name):
+        return int(self.subsystems[name]())
+
+    def report(self):
+        # bytes per subsystem and the total of all of them
+        report = {name: self.measure(name) for name in self.subsystems}
+        report["total"] = sum(report.values())
+        return report
+
+    def format_report(self, report=None):
+        report = self.report() if report is None else report
+        lines = []
+        for name, used in report.items():
+            line = f"{name:<24}{used / 2**20:>10.2f} MB"
+            budget = self.budgets.get(name)
+            if budget is not None:
+                line += f"   ({used / budget.max_bytes:.0%} of {budget.max_bytes / 2**20:.0f} MB budget)"
+                if budget.unmet:
+                    line += "   cannot be met"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def allow(self, name, extra_bytes):
+        # True if 'extra_bytes' more still fit into the budget of a subsystem (always True without budget)
+        budget = self.budgets.get(name)
+        if budget is None:
+            return True
+        if self.measure(name) + extra_bytes <= budget.max_bytes:
+            return True
+        logger_memory.info(f"Refused {extra_bytes} bytes for '{name}', budget of {budget.max_bytes} bytes is full.")
+        return False
+
+    def check_budgets(self):
+        # calls the eviction callback of every subsystem which exceeds its budget
+        # and measures again, eviction can only free what the subsystem no longer uses
+        # returns the names of the subsystems which were over budget
+        over = []
+        for name, budget in self.budgets.items():
+            used = self.measure(name)
+            if used <= budget.max_bytes:
+                if budget.unmet:
+                    logger_memory.info(f"'{name}' is within its budget of {budget.max_bytes} bytes again.")
+                budget.unmet = False
+                continue
+            over.append(name)
+            budget.exceeded += 1
+            if budget.evict is not None:
+                budget.evict(used - budget.max_bytes)
+                used = self.measure(name)
+            unmet = used > budget.max_bytes
+            # reported once when the budget can no longer be met, not on every check
+            if unmet and not budget.unmet:
+                logger_memory.warning(f"Budget of '{name}' cannot be met: {used} bytes are in use after eviction, "
+                                      f"budget is {budget.max_bytes} bytes.")
+            budget.unmet = unmet
+        return over
+
+    def export(self):
+        # appends one JSON line with a time stamp and all counters to the export file
+        report = self.report()
+        if self.export_file is not None:
+            self.export_file.write(json.dumps({"time": time.time(), **report}) + "\n")
+            self.export_file.flush()
+        return report
+
+    def _start_periodic(self, name, interval, fn, task_mgr=None):
+        # calls fn() every 'interval' seconds
+        # with a Panda3D task manager this runs as a task on the main thread, otherwise on a daemon thread
+        self._stop_periodic(name)
+        if task_mgr is not None:
+            def task(task):
+                fn()
+                return task.again
+            task_mgr.doMethodLater(interval, task, name)
+            self.periodic[name] = (task_mgr, None, None)
+            return
+
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                fn()
+        thread = threading.Thread(target=loop, name=name, daemon=True)
+        thread.start()
+        self.periodic[name] = (None, stop, thread)
+
+    def _stop_periodic(self, name):
+        task_mgr, stop, thread = self.periodic.pop(name, (None, None, None))
+        if task_mgr is not None:
+            task_mgr.remove(name)
+        if stop is not None:
+            stop.set()
+            thread.join()
+
+    def start_export(self, path, interval=10.0, task_mgr=None):
+        # exports the counters every 'interval' seconds
+        self.stop_export()
+        self.export_file = open(path, "a")
+        self._start_periodic("memory_export", interval, self.export, task_mgr)
+
+    def stop_export(self):
+        self._stop_periodic("memory_export")
+        if self.export_file is not None:
+            self.export_file.close()
+            self.export_file = None
+
+    def start_budget_checks(self, interval=1.0, task_mgr=None):
+        # enforces the budgets every 'interval' seconds, independent of the export
+        self._start_periodic("memory_budgets", interval, self.check_budgets, task_mgr)
+
+    def stop_budget_checks(self):
+        self._stop_periodic("memory_budgets")
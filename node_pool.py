@@ -0,0 +1,84 @@
+import logging
+
+from panda3d.core import NodePath
+
+from common import *
+
+logging_setup()
+logger_pool = logging.getLogger(__name__)
+
+
+# Recycles scene-graph nodes of cells and entities.
+# Under evolution, cells and organisms are born and die constantly, so instead of letting every
+# dead cell free its GeomNode and NodePath and every new cell allocate them again, released nodes
+# are detached and kept in per-key free lists (the key is for example the cell width).
+# Free lists never grow beyond 'high_water' nodes, trim() shrinks them on demand.
+class NodePathPool:
+
+    def __init__(self, high_water=4096):
+        self.high_water = high_water
+        self.free = {}      # key -> list of detached NodePaths
+
+        self.hits = 0
+        self.misses = 0         # every miss allocates a new node
+        self.releases = 0
+        self.discarded = 0      # released nodes which did not fit below the high-water mark
+        self.in_use = 0
+
+    def acquire(self, key, factory):
+        # returns a recycled node for 'key', or a new one made by factory()
+        self.in_use += 1
+        free = self.free.get(key)
+        if free:
+            self.hits += 1
+            return free.pop()
+
+        self.misses += 1
+        return factory()
+
+    def release(self, key, node_path):
+        # takes a node back, the caller must not use it afterwards
+        self.in_use -= 1
+        self.releases += 1
+        node_path.detachNode()
+
+        free = self.free.setdefault(key, [])
+        if len(free) < self.high_water:
+            free.append(node_path)
+        else:
+            self.discarded += 1
+            node_path.removeNode()
+
+    def free_count(self):
+        return sum(len(free) for free in self.free.values())
+
+    def trim(self, keep=None):
+        # drops free nodes until at most 'keep' (default: half the high-water mark) are left per key
+        keep = self.high_water // 2 if keep is None else keep
+        trimmed = 0
+        for free in self.free.values():
+            while len(free) > keep:
+                free.pop().removeNode()
+                trimmed += 1
+        if trimmed:
+            logger_pool.debug(f"Trimmed {trimmed} pooled nodes.")
+        return trimmed
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "allocations": self.misses,
+            "hit_rate": self.hit_rate(),
+            "releases": self.releases,
+            "discarded": self.discarded,
+            "in_use": self.in_use,
+            "free": self.free_count(),
+        }
+
+
+# shared by all cells and entities
+node_pool = NodePathPool()
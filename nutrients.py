@@ -0,0 +1,197 @@
+import logging
+
+import numpy as np
+
+from common import *
+from occupancy import *
+
+logging_setup()
+logger_nutrients = logging.getLogger(__name__)
+
+
+# Nutrient (food) concentration on a grid aligned with the terrain voxels, 2D (x, y) or 3D (x, y, z).
+# Sources and sinks are a per-voxel rate field, diffusion is an explicit Laplacian stencil with
+# zero-flux borders. The grid is split into chunks and only chunks which still change are stepped:
+# a chunk goes to sleep when its largest change per step falls below 'sleep_threshold' and it has no
+# source or sink, and wakes up again when a neighbor is active, or when organisms eat from or excrete into it.
+# Organisms read and change the field with batched gather (sample) and scatter (consume, deposit) calls.
+# This module must stay free of Panda3D, it is used by headless workers.
+class NutrientField:
+
+    def __init__(self, shape, origin=None, chunk_size=16, diffusion=None, decay=0.0, tick_interval=0.5,
+                 sleep_threshold=1e-5, initial=0.0):
+        self.shape = tuple(int(s) for s in shape)
+        self.ndim = len(self.shape)
+        if self.ndim not in (2, 3):
+            raise ValueError("A nutrient field is 2D or 3D.")
+        # explicit diffusion is only stable below this rate, by default 80% of it (0.2 in 2D)
+        if diffusion is None:
+            diffusion = 0.8 / (2 * self.ndim)
+        if not 0 <= diffusion <= 1.0 / (2 * self.ndim):
+            raise ValueError(f"Argument 'diffusion' must be in [0, {1.0 / (2 * self.ndim)}].")
+
+        self.origin = np.zeros(self.ndim, dtype=np.int64) if origin is None else np.asarray(origin, dtype=np.int64)
+        self.chunk_size = chunk_size
+        self.diffusion = diffusion      # fraction exchanged with every neighbor per step
+        self.decay = decay              # fraction lost per step
+        self.tick_interval = tick_interval
+        self.sleep_threshold = sleep_threshold
+        self.accumulator = 0.0
+
+        self.values = np.full(self.shape, initial, dtype=np.float32)
+        self.rates = np.zeros(self.shape, dtype=np.float32)      # added per step, negative for sinks
+
+        self.chunk_shape = tuple(-(-s // chunk_size) for s in self.shape)
+        self.active = np.ones(self.chunk_shape, dtype=bool)
+        self.steps = 0
+        self.chunk_updates = 0
+
+    def _local(self, positions):
+        # world positions -> local grid indices, and which of them are inside the grid
+        local = voxel_coords(positions)[:, :self.ndim] - self.origin
+        inside = np.all((local >= 0) & (local < self.shape), axis=1)
+        return local, inside
+
+    def _wake(self, local):
+        chunks = local // self.chunk_size
+        self.active[tuple(chunks.T)] = True
+
+    def set_rates(self, positions, rates):
+        # sources (rate > 0) and sinks (rate < 0) in nutrients per step at world positions
+        local, inside = self._local(positions)
+        local = local[inside]
+        self.rates[tuple(local.T)] = np.broadcast_to(np.asarray(rates, dtype=np.float32), inside.shape)[inside]
+        self._wake(local)
+
+    def scatter_sources(self, rng, count, rate):
+        # 'count' random sources of equal rate, drawn from the given generator
+        local = np.stack([rng.integers(0, s, count) for s in self.shape], axis=1)
+        self.set_rates(local + self.origin, rate)
+
+    def sample(self, positions):
+        # nutrient concentration at world positions (N, 3), 0 outside the grid
+        local, inside = self._local(positions)
+        result = np.zeros(len(local), dtype=np.float32)
+        result[inside] = self.values[tuple(local[inside].T)]
+        return result
+
+    def consume(self, positions, amounts):
+        # takes up to 'amounts' at world positions and returns what was actually taken
+        # consumers of the same voxel share what is there in proportion to what they asked for
+        local, inside = self._local(positions)
+        amounts = np.broadcast_to(np.asarray(amounts, dtype=np.float32), inside.shape)
+        taken = np.zeros(len(local), dtype=np.float32)
+        if not inside.any():
+            return taken
+
+        flat = np.ravel_multi_index(tuple(local[inside].T), self.shape)
+        cells, slot = np.unique(flat, return_inverse=True)
+        requested = np.bincount(slot, weights=amounts[inside], minlength=len(cells))
+        available = self.values.reshape(-1)[cells]
+        share = np.divide(available, requested, out=np.zeros_like(available), where=requested > 0)
+        share = np.minimum(share, 1.0)
+
+        taken[inside] = amounts[inside] * share[slot]
+        self.values.reshape(-1)[cells] = available - requested * share
+        self._wake(local[inside])
+        return taken
+
+    def deposit(self, positions, amounts):
+        # adds nutrients at world positions (excretion, dead cells)
+        local, inside = self._local(positions)
+        amounts = np.broadcast_to(np.asarray(amounts, dtype=np.float32), inside.shape)
+        np.add.at(self.values, tuple(local[inside].T), amounts[inside])
+        self._wake(local[inside])
+
+    def advance(self, dt):
+        # runs as many steps as 'tick_interval' fit into the accumulated simulation time
+        self.accumulator += dt
+        steps = 0
+        while self.accumulator >= self.tick_interval:
+            self.accumulator -= self.tick_interval
+            self.step()
+            steps += 1
+        return steps
+
+    def _chunk_slices(self, chunk):
+        # slices of a chunk and of the chunk with a one voxel halo (clipped at the borders)
+        inner = []
+        halo = []
+        for c, s in zip(chunk, self.shape):
+            lo = c * self.chunk_size
+            hi = min(lo + self.chunk_size, s)
+            inner.append(slice(lo, hi))
+            halo.append(slice(max(lo - 1, 0), min(hi + 1, s)))
+        return tuple(inner), tuple(halo)
+
+    def _with_neighbors(self, active):
+        # active chunks and their face neighbors
+        grown = active.copy()
+        for axis in range(self.ndim):
+            lower = [slice(None)] * self.ndim
+            upper = [slice(None)] * self.ndim
+            lower[axis] = slice(0, -1)
+            upper[axis] = slice(1, None)
+            grown[tuple(upper)] |= active[tuple(lower)]
+            grown[tuple(lower)] |= active[tuple(upper)]
+        return grown
+
+    def step(self):
+        # one diffusion step of the active chunks and their neighbors, so whatever flows out of an active
+        # chunk arrives in its neighbor in the same step; all deltas are computed from the old values first,
+        # so the result does not depend on the order of the chunks
+        chunks = np.argwhere(self._with_neighbors(self.active))
+        deltas = []
+        for chunk in chunks:
+            inner, halo = self._chunk_slices(chunk)
+            # edge padding where the halo was clipped gives zero flux across the border of the world
+            pad = [(int(i.start == h.start), int(i.stop == h.stop)) for i, h in zip(inner, halo)]
+            block = np.pad(self.values[halo], pad, mode="edge")
+
+            center = block[(slice(1, -1),) * self.ndim]
+            laplacian = -2 * self.ndim * center
+            for axis in range(self.ndim):
+                lower = [slice(1, -1)] * self.ndim
+                upper = [slice(1, -1)] * self.ndim
+                lower[axis] = slice(0, -2)
+                upper[axis] = slice(2, None)
+                laplacian = laplacian + block[tuple(lower)] + block[tuple(upper)]
+
+            delta = self.diffusion * laplacian - self.decay * center + self.rates[inner]
+            deltas.append((inner, delta))
+
+        self.active[...] = False
+        for chunk, (inner, delta) in zip(chunks, deltas):
+            values = self.values[inner]
+            values += delta
+            # sinks can not take more than there is
+            np.maximum(values, 0.0, out=values)
+            if np.abs(delta).max() >= self.sleep_threshold or self.rates[inner].any():
+                self.active[tuple(chunk)] = True
+
+        self.steps += 1
+        self.chunk_updates += len(chunks)
+        return len(chunks)
+
+    def total(self):
+        return float(self.values.sum(dtype=np.float64))
+
+    def get_state(self):
+        # parameters for the checkpoint header and arrays for its columns
+        header = {
+            "shape": self.shape, "origin": self.origin.tolist(), "chunk_size": self.chunk_size,
+            "diffusion": self.diffusion, "decay": self.decay, "tick_interval": self.tick_interval,
+            "sleep_threshold": self.sleep_threshold, "accumulator": self.accumulator, "steps": self.steps,
+        }
+        return header, {"nutrient_values": self.values, "nutrient_rates": self.rates, "nutrient_active": self.active}
+
+    @classmethod
+    def from_state(cls, header, arrays):
+        field = cls(header["shape"], header["origin"], header["chunk_size"], header["diffusion"], header["decay"],
+                    header["tick_interval"], header["sleep_threshold"])
+        field.accumulator = header["accumulator"]
+        field.steps = header["steps"]
+        field.values[...] = arrays["nutrient_values"]
+        field.rates[...] = arrays["nutrient_rates"]
+        field.active[...] = arrays["nutrient_active"]
+        return field
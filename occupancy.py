@@ -0,0 +1,32 @@
+import numpy as np
+
+
+# Dense boolean occupancy of the terrain, the form batched systems (light, ...) work on.
+# A voxel at integer coordinates (x, y, z) fills the unit cube [x, x+1] x [y, y+1] x [z, z+1],
+# so the voxel containing a world position is its floor.
+# This module must stay free of Panda3D, it is used by headless workers.
+
+
+def occupancy_from_voxel_map(voxel_map):
+    # voxel map {(x, y, z): Voxel} -> (grid, origin), grid[x, y, z] is voxel origin + (x, y, z)
+    if not voxel_map:
+        return np.zeros((0, 0, 0), dtype=bool), np.zeros(3, dtype=np.int64)
+
+    coords = np.array(list(voxel_map.keys()), dtype=np.int64).reshape(-1, 3)
+    origin = coords.min(axis=0)
+    grid = np.zeros(coords.max(axis=0) - origin + 1, dtype=bool)
+    grid[tuple((coords - origin).T)] = True
+    return grid, origin
+
+
+def voxel_coords(positions):
+    # world positions (N, 3), or (N, 2) for 2D grids -> integer coordinates of the voxels containing them
+    positions = np.asarray(positions, dtype=np.float64)
+    return np.floor(positions).astype(np.int64).reshape(-1, positions.shape[-1])
+
+
+def heightmap_occupancy(heights, max_height):
+    # dense occupancy of a heightmap terrain filled like VoxelMesh.generate_base_terrain,
+    # every column (x, y) is solid from z=0 up to int(heights[x, y] * max_height)
+    column_tops = (np.asarray(heights) * max_height).astype(np.int64)
+    return np.arange(column_tops.max(initial=0) + 1)[None, None, :] <= column_tops[:, :, None]
@@ -0,0 +1,172 @@
+import numpy as np
+
+from lattice import *
+
+
+# Meshing of multi-cell bodies: faces shared by two touching cells are never visible and are left out,
+# like Voxel.generate_embedded leaves out faces between voxels.
+# Every diamond face of the rhombic dodecahedron points at one of the 12 diagonal lattice neighbors, and a cell
+# there contains the whole face (the face center is the neighbor's center), so the face is culled exactly when
+# that neighbor exists. The 6 axis neighbors only touch the tips and never hide a whole face.
+# OrganismMesh keeps the culled faces of a growing and shrinking body up to date: adding or removing a cell
+# only looks at its 12 diagonal neighbors. The masks go into cell.build_cell_batch_mesh.
+# This module must stay free of Panda3D, it is used by headless workers.
+
+
+# The 12 diamond faces of the rhombic dodecahedron, as indices into its 14 vertices
+# (cube corners 0-7, tips 8-13, see Cell.generate_rhombic_dodecahedron)
+rhombic_faces = [
+        # Top Cap (Connected to +Z tip: index 12)
+        (12, 0, 10, 4), (12, 4, 9, 6), (12, 6, 11, 2), (12, 2, 8, 0),
+        # Bottom Cap (Connected to -Z tip: index 13)
+        (5, 10, 1, 13), (7, 9, 5, 13), (3, 11, 7, 13), (1, 8, 3, 13),
+        # Middle Ring (Side connectors)
+        (1, 10, 0, 8), (5, 9, 4, 10), (7, 11, 6, 9), (3, 8, 2, 11)]
+
+face_count = len(rhombic_faces)
+triangles_per_face = 2
+
+
+def rhombic_vertices(total_width=0.5):
+    # s is the 'unit' size. Tips are at 2s.
+    s = total_width / 4.0
+    return np.array([
+        # Cube (0-7)
+        (s, s, s), (s, s, -s), (s, -s, s), (s, -s, -s),
+        (-s, s, s), (-s, s, -s), (-s, -s, s), (-s, -s, -s),
+        # Octahedron / Tips (8-13)
+        (2*s, 0, 0), (-2*s, 0, 0),
+        (0, 2*s, 0), (0, -2*s, 0),
+        (0, 0, 2*s), (0, 0, -2*s)], dtype=np.float32)
+
+
+def rhombic_template(total_width=0.5):
+    # vertices (48, 3) and flat normals (48, 3) of one cell, 4 vertices per face, centered on the origin
+    corners = rhombic_vertices(total_width)[np.array(rhombic_faces)]         # (12, 4, 3)
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    return corners.reshape(-1, 3), np.repeat(normals, 4, axis=0).astype(np.float32)
+
+
+# in lattice units (a cell of width 4) the face centers are the diagonal neighbor offsets
+FACE_OFFSETS = np.rint(rhombic_vertices(4.0)[np.array(rhombic_faces)].mean(axis=1)).astype(np.int64)
+FACE_DIRECTIONS = np.array([direction_of(offset, 4.0) for offset in FACE_OFFSETS.tolist()], dtype=np.int64)
+# OPPOSITE_FACE[f] is the face of the neighbor behind face f which touches it
+OPPOSITE_FACE = np.array([
+    int(np.flatnonzero(FACE_DIRECTIONS == OPPOSITE_DIRECTION[d])[0]) for d in FACE_DIRECTIONS], dtype=np.int64)
+
+_face_offsets = [tuple(offset) for offset in FACE_OFFSETS.tolist()]
+
+
+def face_mask(lattice_positions):
+    # (N, 12) bool, True for the faces of a body which are not covered by a neighbor cell
+    # lattice_positions: (N, 3) integer lattice coordinates of all cells of one body
+    coords = np.asarray(lattice_positions, dtype=np.int64).reshape(-1, 3)
+    if len(coords) == 0:
+        return np.zeros((0, face_count), dtype=bool)
+    # relative to the minimum (with a margin for the offsets) every coordinate fits into 20 bits
+    local = coords - coords.min(axis=0) + 1
+
+    def keys(c):
+        return (c[:, 0] << 20 | c[:, 1]) << 20 | c[:, 2]
+
+    own = keys(local)
+    mask = np.empty((len(coords), face_count), dtype=bool)
+    for f, offset in enumerate(FACE_OFFSETS):
+        mask[:, f] = ~np.isin(keys(local + offset), own)
+    return mask
+
+
+def coarse_body(lattice_positions, cell_types, factor=2):
+    # a low-polygon stand-in for a body: its cells resampled onto the lattice scaled by 'factor', so one coarse
+    # cell of 'factor' times the width covers several cells; returns coarse lattice positions (scaled units)
+    # and the type of the first cell falling into each coarse cell (the base cell keeps its own)
+    scaled = np.asarray(lattice_positions, dtype=np.float64).reshape(-1, 3) / factor
+    coarse = np.rint(scaled)
+    # the lattice holds the points with an even coordinate sum, odd points move along the axis rounded most
+    odd = coarse.sum(axis=1) % 2 == 1
+    error = scaled[odd] - coarse[odd]
+    axis = np.argmax(np.abs(error), axis=1)
+    rows = np.flatnonzero(odd)
+    coarse[rows, axis] += np.where(error[np.arange(len(rows)), axis] >= 0, 1, -1)
+    coarse, first = np.unique(coarse.astype(np.int64), axis=0, return_index=True)
+    order = np.argsort(first)
+    return coarse[order], np.asarray(cell_types)[first[order]]
+
+
+class OrganismMesh:
+
+    def __init__(self, capacity=16):
+        self.row_of = {}                                            # lattice coordinates -> row
+        self.positions = np.zeros((capacity, 3), dtype=np.int64)
+        self.cell_types = np.zeros(capacity, dtype=np.uint8)
+        self.mask = np.zeros((capacity, face_count), dtype=bool)    # visible faces per row
+        self.count = 0
+        self.version = 0                                            # counts changes, a renderer compares it
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return key in self.row_of
+
+    def _grow(self):
+        capacity = 2 * len(self.positions)
+        self.positions = np.resize(self.positions, (capacity, 3))
+        self.cell_types = np.resize(self.cell_types, capacity)
+        self.mask = np.resize(self.mask, (capacity, face_count))
+
+    def add(self, key, cell_type):
+        # adds a cell at lattice coordinates 'key', hides the faces it shares with its diagonal neighbors
+        if key in self.row_of:
+            raise ValueError(f"There is already a cell at {key}.")
+        if self.count == len(self.positions):
+            self._grow()
+        row = self.count
+        self.positions[row] = key
+        self.cell_types[row] = cell_type
+        self.mask[row] = True
+        x, y, z = key
+        for f, (dx, dy, dz) in enumerate(_face_offsets):
+            other = self.row_of.get((x + dx, y + dy, z + dz))
+            if other is not None:
+                self.mask[row, f] = False
+                self.mask[other, OPPOSITE_FACE[f]] = False
+        self.row_of[key] = row
+        self.count += 1
+        self.version += 1
+
+    def remove(self, key):
+        # removes the cell at 'key', the faces of its neighbors behind it become visible again
+        row = self.row_of.pop(key)
+        x, y, z = key
+        for f, (dx, dy, dz) in enumerate(_face_offsets):
+            other = self.row_of.get((x + dx, y + dy, z + dz))
+            if other is not None:
+                self.mask[other, OPPOSITE_FACE[f]] = True
+
+        # the last row fills the gap
+        last = self.count - 1
+        if row != last:
+            self.positions[row] = self.positions[last]
+            self.cell_types[row] = self.cell_types[last]
+            self.mask[row] = self.mask[last]
+            self.row_of[tuple(self.positions[row].tolist())] = row
+        self.count -= 1
+        self.version += 1
+
+    def arrays(self):
+        # lattice positions, cell types and visible faces of all cells (views, valid until the next change)
+        n = self.count
+        return self.positions[:n], self.cell_types[:n], self.mask[:n]
+
+    def stats(self):
+        faces = int(self.mask[:self.count].sum())
+        full = self.count * face_count
+        return {
+            "cells": self.count,
+            "faces": faces,
+            "triangles": faces * triangles_per_face,
+            "culled_triangles": (full - faces) * triangles_per_face,
+            "culled_share": (full - faces) / full if full else 0.0,
+        }
@@ -1,5 +1,11 @@
 import numpy as np
-import matplotlib.pyplot as plt
+
+from rng_streams import *
+
+# gradients are generated in square blocks of lattice points, every block from its own random stream,
+# so any part of the world can be generated alone and still match its neighbors exactly
+gradient_block = 16
+
 
 def fade(t):
     """Smoothing function: 6t^5 - 15t^4 + 10t^3"""
@@ -9,13 +15,58 @@ def lerp(a, b, x):
     """Linear interpolation"""
     return a + x * (b - a)
 
+def lattice_gradients(seed, x0, y0, w, h):
+    """Unit gradient vectors of the lattice points [x0, x0 + w) x [y0, y0 + h)"""
+    gradients = np.empty((w, h, 2))
+    for bx in range(x0 // gradient_block, (x0 + w - 1) // gradient_block + 1):
+        for by in range(y0 // gradient_block, (y0 + h - 1) // gradient_block + 1):
+            # use angles to ensure unit length
+            rng = make_rng(seed, "terrain", bx, by)
+            angles = 2 * np.pi * rng.random((gradient_block, gradient_block))
+
+            # overlap of this block with the requested area, in lattice coordinates
+            lx0, ly0 = max(x0, bx * gradient_block), max(y0, by * gradient_block)
+            lx1, ly1 = min(x0 + w, (bx + 1) * gradient_block), min(y0 + h, (by + 1) * gradient_block)
+            block = angles[lx0 - bx * gradient_block:lx1 - bx * gradient_block,
+                           ly0 - by * gradient_block:ly1 - by * gradient_block]
+            gradients[lx0 - x0:lx1 - x0, ly0 - y0:ly1 - y0] = np.stack((np.cos(block), np.sin(block)), axis=-1)
+    return gradients
+
+def perlin_chunk(seed, x0, y0, width, height, scale):
+    """Noise in [0, 1] for the world cells [x0, x0 + width) x [y0, y0 + height)"""
+    # position of every world cell in lattice coordinates, 'scale' lattice cells per world cell
+    xs = (x0 + np.arange(width)) * scale
+    ys = (y0 + np.arange(height)) * scale
+    ix = np.floor(xs).astype(np.int64)
+    iy = np.floor(ys).astype(np.int64)
+    fx = (xs - ix)[:, None]
+    fy = (ys - iy)[None, :]
+
+    gx0, gy0 = int(ix.min()), int(iy.min())
+    gradients = lattice_gradients(seed, gx0, gy0, int(ix.max()) - gx0 + 2, int(iy.max()) - gy0 + 2)
+    ix = (ix - gx0)[:, None]
+    iy = (iy - gy0)[None, :]
+
+    def corner(dx, dy):
+        g = gradients[ix + dx, iy + dy]
+        return g[..., 0] * (fx - dx) + g[..., 1] * (fy - dy)
+
+    u, v = fade(fx), fade(fy)
+    noise = lerp(lerp(corner(0, 0), corner(1, 0), u), lerp(corner(0, 1), corner(1, 1), u), v)
+
+    # 2D Perlin noise lies within +/- sqrt(0.5), a fixed mapping keeps chunks consistent with each other
+    return np.clip(0.5 + noise * np.sqrt(0.5), 0.0, 1.0)
+
 def generate_perlin_noise_2d(width, height, scale, seed=42):
-    np.random.seed(seed)
+    return perlin_chunk(seed, 0, 0, width, height, scale)
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
 
-    # Create grid of random generated vectors
-    # use angles to ensure unit length
+    heightmap = generate_perlin_noise_2d(256, 256, 0.05)
+    np.save("Perlin/heightmap.npy", heightmap)
 
-    grid_w = int(width * scale)
-    grid_h = int(height * scale)
-    angles = 2 * np.pi * np.random.rand(grid_w, grid_h) # create random vectors
-    gradients = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+    plt.imshow(heightmap.T, origin="lower", cmap="terrain")
+    plt.colorbar()
+    plt.savefig("Perlin/world_preview.png")
@@ -0,0 +1,208 @@
+import logging
+
+import numpy as np
+
+from common import *
+from occupancy import *
+from spatial_index import SpatialHashGrid, pack_cell_keys
+
+logging_setup()
+logger_raycast = logging.getLogger(__name__)
+
+
+# Batched ray queries against the terrain and against entity bounds, for vision (OpticCell) and similar sensors.
+# Terrain rays walk the dense occupancy grid with 3D-DDA (Amanatides & Woo), all rays of a query advance
+# together, one voxel per iteration. The grid is divided into chunks, and a ray in a chunk without any solid
+# voxel jumps straight to where it leaves the chunk, so rays crossing open air cost a few iterations only.
+# Entity rays are slab tests against axis-aligned boxes, with a hashed grid over the box centers as broadphase.
+# Distances are in world units along the (normalized) ray directions, inf for rays which hit nothing.
+# This module must stay free of Panda3D, it is used by headless workers.
+
+# length of the ray pieces the entity broadphase looks up boxes for
+segment_length = 8.0
+
+
+def normalize(directions):
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    return directions / np.maximum(np.linalg.norm(directions, axis=1), 1e-12)[:, None]
+
+
+def slab_intersection(origins, directions, box_min, box_max):
+    # (t_enter, t_exit) of rays and boxes, one box per ray; the ray misses the box where t_enter > t_exit
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1.0 / directions
+        t1 = (box_min - origins) * inverse
+        t2 = (box_max - origins) * inverse
+    # an axis the ray runs parallel to either contains the ray (no limit) or excludes it
+    parallel = directions == 0
+    inside = (origins >= box_min) & (origins <= box_max)
+    near = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t1, t2))
+    far = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t1, t2))
+    return near.max(axis=1), far.min(axis=1)
+
+
+class VoxelRaycaster:
+
+    def __init__(self, occupancy, origin=(0, 0, 0), block_types=None, chunk_size=8):
+        # occupancy is used as it is (not copied), so a grid shared with the sunlight map stays one grid;
+        # block_types: uint8 grid of the same shape with the type of every voxel, 1 for all solid voxels if None
+        self.occupancy = occupancy
+        self.origin = np.asarray(origin, dtype=np.int64)
+        self.block_types = block_types
+        self.chunk_size = chunk_size
+        self.shape = np.array(occupancy.shape, dtype=np.int64)
+        self.update_chunks()
+
+    @classmethod
+    def from_voxel_map(cls, voxel_map, **raycaster_args):
+        occupancy, origin = occupancy_from_voxel_map(voxel_map)
+        return cls(occupancy, origin, **raycaster_args)
+
+    def update_chunks(self, chunks=None):
+        # which chunks contain a solid voxel, for all chunks or only for the given chunk coordinates (N, 3)
+        c = self.chunk_size
+        if chunks is None:
+            counts = -(-self.shape // c)
+            padded = np.zeros(counts * c, dtype=bool)
+            padded[:self.shape[0], :self.shape[1], :self.shape[2]] = self.occupancy
+            self.chunk_solid = padded.reshape(counts[0], c, counts[1], c, counts[2], c).any(axis=(1, 3, 5))
+            return
+        for x, y, z in np.unique(chunks, axis=0).tolist():
+            self.chunk_solid[x, y, z] = self.occupancy[x * c:(x + 1) * c, y * c:(y + 1) * c, z * c:(z + 1) * c].any()
+
+    def set_voxels(self, coords, solid, block_type=1):
+        # terrain edits; the occupancy may already have been changed by whoever shares it
+        local = voxel_coords(coords) - self.origin
+        if not np.all((local >= 0) & (local < self.shape)):
+            raise ValueError("Voxel outside of the raycast grid.")
+        self.occupancy[tuple(local.T)] = solid
+        if self.block_types is not None:
+            self.block_types[tuple(local.T)] = block_type if solid else 0
+        self.update_chunks(local // self.chunk_size)
+
+    def _setup(self, origins, directions, t):
+        # DDA state of rays starting at parameter t: voxel, the t of the next border per axis
+        p = origins + directions * t[:, None]
+        voxel = np.floor(p).astype(np.int64)
+        # a ray exactly on a border going backwards is in the voxel it enters
+        voxel -= (p == voxel) & (directions < 0)
+        voxel = np.clip(voxel, 0, self.shape - 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_max = t[:, None] + (voxel + (directions > 0) - p) / directions
+        t_max = np.where(directions == 0, np.inf, t_max)
+        return voxel, t_max
+
+    def cast(self, origins, directions, max_distance=32.0):
+        # returns (distance, block type) per ray, (inf, 0) where nothing was hit within max_distance;
+        # a ray starting inside a solid voxel hits it at distance 0
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3) - self.origin
+        directions = normalize(directions)
+        n = len(origins)
+        distance = np.full(n, np.inf)
+        block_type = np.zeros(n, dtype=np.uint8)
+        if n == 0 or not self.occupancy.any():
+            return distance, block_type
+
+        # clip every ray to the grid
+        t_enter, t_exit = slab_intersection(origins, directions, np.zeros(3), self.shape.astype(np.float64))
+        t = np.maximum(t_enter, 0.0)
+        t_end = np.minimum(t_exit, max_distance)
+        active = np.flatnonzero(t <= t_end)
+        voxel = np.zeros((n, 3), dtype=np.int64)
+        t_max = np.zeros((n, 3))
+        voxel[active], t_max[active] = self._setup(origins[active], directions[active], t[active])
+
+        step = np.sign(directions).astype(np.int64)
+        t_delta = np.abs(1.0 / np.where(directions == 0, np.inf, directions))
+        c = self.chunk_size
+        while len(active):
+            v = voxel[active]
+            chunk = v // c
+            in_solid_chunk = self.chunk_solid[chunk[:, 0], chunk[:, 1], chunk[:, 2]]
+            hit = np.zeros(len(active), dtype=bool)
+            hit[in_solid_chunk] = self.occupancy[v[in_solid_chunk, 0], v[in_solid_chunk, 1], v[in_solid_chunk, 2]]
+
+            rays = active[hit]
+            distance[rays] = t[rays]
+            if self.block_types is None:
+                block_type[rays] = 1
+            else:
+                block_type[rays] = self.block_types[v[hit, 0], v[hit, 1], v[hit, 2]]
+
+            # rays in empty chunks jump to the border of the chunk
+            jumping = active[~in_solid_chunk]
+            if len(jumping):
+                border = (chunk[~in_solid_chunk] + (directions[jumping] > 0)) * c
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    leave = (border - origins[jumping]) / directions[jumping]
+                leave = np.where(directions[jumping] == 0, np.inf, leave).min(axis=1)
+                t[jumping] = np.maximum(leave, t[jumping]) + 1e-9
+                voxel[jumping], t_max[jumping] = self._setup(origins[jumping], directions[jumping], t[jumping])
+
+            # the others advance by one voxel along the axis with the nearest border
+            stepping = active[in_solid_chunk & ~hit]
+            if len(stepping):
+                axis = np.argmin(t_max[stepping], axis=1)
+                t[stepping] = t_max[stepping, axis]
+                voxel[stepping, axis] += step[stepping, axis]
+                t_max[stepping, axis] += t_delta[stepping, axis]
+
+            active = active[~hit]
+            active = active[(t[active] <= t_end[active])
+                            & np.all((voxel[active] >= 0) & (voxel[active] < self.shape), axis=1)]
+        return distance, block_type
+
+
+def cast_boxes(origins, directions, box_min, box_max, box_ids, max_distance=32.0, exclude_ids=None):
+    # nearest box hit per ray: returns (distance, box id), (inf, -1) for rays which hit no box within max_distance;
+    # rays starting inside a box hit it at distance 0, boxes with the id exclude_ids[ray] are ignored
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    directions = normalize(directions)
+    box_min = np.asarray(box_min, dtype=np.float64).reshape(-1, 3)
+    box_max = np.asarray(box_max, dtype=np.float64).reshape(-1, 3)
+    box_ids = np.asarray(box_ids, dtype=np.int64)
+    distance = np.full(len(origins), np.inf)
+    hit_ids = np.full(len(origins), -1, dtype=np.int64)
+    if len(origins) == 0 or len(box_min) == 0:
+        return distance, hit_ids
+
+    # broadphase: every ray is cut into segments, the candidates of a segment are the boxes whose center is
+    # within reach of its middle. Many segments share a grid cell, so candidates are looked up once per
+    # distinct cell and then narrowed down per segment (a box may come up twice per ray)
+    pieces = max(int(np.ceil(max_distance / segment_length)), 1)
+    length = max_distance / pieces
+    reach = 0.5 * length + 0.5 * np.linalg.norm(box_max - box_min, axis=1).max()
+    grid = SpatialHashGrid(cell_size=max(reach, 1.0))
+    grid.build(0.5 * (box_min + box_max), box_ids)
+    middles = origins[:, None, :] + directions[:, None, :] * (length * (np.arange(pieces) + 0.5))[None, :, None]
+    cells = grid.cell_coords(middles.reshape(-1, 3))
+    _, first, inverse = np.unique(pack_cell_keys(cells), return_index=True, return_inverse=True)
+    # cells are at least as large as reach, so the 3x3x3 cells around a cell hold every box within reach of it
+    offsets, items = grid.query_cells(cells[first] - 1, cells[first] + 1)
+    counts = np.diff(offsets)[inverse]
+    flat = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            + np.repeat(offsets[:-1][inverse], counts))
+    boxes = items[flat]
+    segments = np.repeat(np.arange(len(inverse)), counts)
+    # most boxes of the cell block are farther than reach from the middle of the segment
+    delta = grid.positions[boxes] - middles.reshape(-1, 3)[segments]
+    near = np.einsum("ij,ij->i", delta, delta) <= reach * reach
+    boxes = boxes[near]
+    rays = segments[near] // pieces
+    if exclude_ids is not None:
+        exclude_ids = np.broadcast_to(np.asarray(exclude_ids, dtype=np.int64), (len(origins),))
+        keep = box_ids[boxes] != exclude_ids[rays]
+        rays, boxes = rays[keep], boxes[keep]
+
+    t_enter, t_exit = slab_intersection(origins[rays], directions[rays], box_min[boxes], box_max[boxes])
+    t_enter = np.maximum(t_enter, 0.0)
+    hit = (t_enter <= t_exit) & (t_enter <= max_distance)
+    rays, boxes, t_enter = rays[hit], boxes[hit], t_enter[hit]
+
+    # nearest box per ray, of boxes hit at the same distance the one with the lowest id
+    order = np.lexsort((box_ids[boxes], t_enter, rays))
+    rays, boxes, t_enter = rays[order], boxes[order], t_enter[order]
+    first = np.r_[True, rays[1:] != rays[:-1]] if len(rays) else np.zeros(0, dtype=bool)
+    distance[rays[first]] = t_enter[first]
+    hit_ids[rays[first]] = box_ids[boxes[first]]
+    return distance, hit_ids
@@ -0,0 +1,83 @@
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from common import *
+
+logging_setup()
+logger_regions = logging.getLogger(__name__)
+
+
+# Spatially partitioned work on a thread pool. The world is split into square regions (x, y) of region_size,
+# and neighboring regions are joined into one strip per thread with about the same amount of work each.
+# The per-entity kernels of a tick (ray casting, spring-mass integration) run once per strip on the pool and
+# their results are merged back by index, so a tick gives the same results with any number of threads.
+# These kernels only read the world or act within one body, so all strips run at the same time; whatever spans
+# regions (rays hitting entities of other regions, sunlight and nutrients scattered into shared fields) is
+# handled by the caller in a single ordered pass.
+# The heavy parts are NumPy kernels, which release the GIL on large arrays. On free-threaded CPython builds
+# (3.13t and later) the Python parts between them run in parallel as well.
+# This module must stay free of Panda3D, it is used by headless workers.
+
+
+def gil_enabled():
+    is_enabled = getattr(sys, "_is_gil_enabled", None)
+    return True if is_enabled is None else is_enabled()
+
+
+def region_keys(positions, region_size):
+    # (N, 2) integer region coordinates of world positions (N, 3)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    return np.floor(positions[:, :2] / region_size).astype(np.int64)
+
+
+def group_by_region(positions, region_size):
+    # [(region, indices)] with the regions in sorted order and the indices ascending within each region
+    keys = region_keys(positions, region_size)
+    if not len(keys):
+        return []
+    regions, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    splits = np.cumsum(np.bincount(inverse, minlength=len(regions)))[:-1]
+    return list(zip(map(tuple, regions.tolist()), np.split(order, splits)))
+
+
+class RegionPool:
+
+    def __init__(self, workers=None, region_size=32.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.region_size = region_size
+        # with one worker everything runs on the calling thread
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="region") if self.workers > 1 else None
+        self.tasks = 0
+        logger_regions.info(f"Region pool with {self.workers} threads, regions of {region_size} voxels, "
+                            f"{'GIL enabled' if gil_enabled() else 'free-threaded build'}.")
+
+    def partition(self, positions):
+        # indices of the positions in at most one batch per thread: whole regions, consecutive in region order
+        # (strips of neighboring regions), with about the same number of positions in every batch
+        groups = group_by_region(positions, self.region_size)
+        if not groups:
+            return []
+        sizes = np.cumsum([len(indices) for region, indices in groups])
+        cuts = np.searchsorted(sizes, sizes[-1] * np.arange(1, self.workers) / self.workers) + 1
+        cuts = np.unique(np.minimum(cuts, len(groups)))
+        batches = np.split(np.arange(len(groups)), cuts)
+        return [np.concatenate([groups[g][1] for g in batch]) for batch in batches if len(batch)]
+
+    def map(self, fn, items):
+        # fn(item) for every item, the results in the order of the items
+        items = list(items)
+        self.tasks += len(items)
+        if self.executor is None or len(items) < 2:
+            return [fn(item) for item in items]
+        return list(self.executor.map(fn, items))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,37 @@
+import json
+import zlib
+
+import numpy as np
+
+
+# Every random decision of a run is drawn from a stream derived from one master seed.
+# A stream is identified by a kind ("entity", "terrain", ...) and integer ids (entity id, chunk x, chunk y, ...),
+# so the numbers an entity or a chunk gets do not depend on the order in which they are processed,
+# or on which thread or process processes them.
+
+
+def _zigzag(value):
+    # SeedSequence only accepts non-negative keys, chunk coordinates can be negative
+    value = int(value)
+    return 2 * value if value >= 0 else -2 * value - 1
+
+
+def stream_seed(master_seed, kind, *ids):
+    kind_key = zlib.crc32(kind.encode("utf-8"))
+    return np.random.SeedSequence(int(master_seed), spawn_key=(kind_key, *(_zigzag(i) for i in ids)))
+
+
+def make_rng(master_seed, kind, *ids):
+    return np.random.Generator(np.random.PCG64(stream_seed(master_seed, kind, *ids)))
+
+
+def rng_state(rng):
+    # JSON-serializable state of a generator, restored exactly by restore_rng
+    return json.dumps(rng.bit_generator.state)
+
+
+def restore_rng(state):
+    state = json.loads(state)
+    bit_generator = getattr(np.random, state["bit_generator"])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
@@ -0,0 +1,142 @@
+import heapq
+import logging
+
+import numpy as np
+
+from common import *
+
+logging_setup()
+logger_scheduler = logging.getLogger(__name__)
+
+
+# Simulation-time event queue for sparse behaviour (growth, aging, delayed releases, ...), so nothing has to be
+# polled every tick for the few entities or cells with something due.
+# Events live in a binary heap ordered by (time, event id); the id breaks ties, so events due at the same time
+# always run in the order they were scheduled and runs stay deterministic. Scheduling is O(log n).
+# Cancelling is O(1): the entry is only marked and skipped when it comes up, and the heap is compacted once
+# more than half of it is cancelled.
+# Due events are handed out in batches per event type, handlers get arrays of times, targets and payloads.
+# Events which should survive a checkpoint use integer targets (entity ids, ...) and float payloads.
+# This module must stay free of Panda3D, the simulation runs headless.
+
+# entry layout: [time, event id, event type, target, payload]; event type None marks a cancelled entry,
+# event id -1 an entry which already ran
+_TIME, _ID, _TYPE, _TARGET, _PAYLOAD = range(5)
+
+
+class EventScheduler:
+
+    def __init__(self):
+        self.heap = []
+        self.next_id = 0
+        self.cancelled = 0
+        self.processed = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def schedule(self, time, event_type, target, payload=0.0):
+        # returns the entry, which is the handle for cancel()
+        entry = [float(time), self.next_id, event_type, target, payload]
+        self.next_id += 1
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def schedule_many(self, times, event_type, targets, payloads=None):
+        # many events of one type at once, large batches are added with one heapify instead of single pushes
+        times = np.asarray(times, dtype=np.float64).tolist()
+        targets = np.asarray(targets).tolist()
+        payloads = [0.0] * len(times) if payloads is None else np.asarray(payloads).tolist()
+        entries = [[time, self.next_id + i, event_type, target, payload]
+                   for i, (time, target, payload) in enumerate(zip(times, targets, payloads))]
+        self.next_id += len(entries)
+        if len(entries) > len(self.heap) // 8:
+            self.heap.extend(entries)
+            heapq.heapify(self.heap)
+        else:
+            for entry in entries:
+                heapq.heappush(self.heap, entry)
+        return entries
+
+    def cancel(self, entry):
+        # cancelling an event which already ran (or None) does nothing
+        if entry is None or entry[_ID] < 0 or entry[_TYPE] is None:
+            return False
+        entry[_TYPE] = None
+        self.cancelled += 1
+        if self.cancelled > 1024 and self.cancelled * 2 > len(self.heap):
+            self.compact()
+        return True
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if entry[_TYPE] is not None]
+        heapq.heapify(self.heap)
+        self.cancelled = 0
+
+    def next_time(self):
+        while self.heap and self.heap[0][_TYPE] is None:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+        return self.heap[0][_TIME] if self.heap else None
+
+    def pop_due(self, until):
+        # removes all events due at or before 'until', grouped by type (in order of first occurrence),
+        # every group in time order
+        batches = {}
+        heap = self.heap
+        while heap and heap[0][_TIME] <= until:
+            entry = heapq.heappop(heap)
+            if entry[_TYPE] is None:
+                self.cancelled -= 1
+                continue
+            entry[_ID] = -1
+            batches.setdefault(entry[_TYPE], []).append(entry)
+        return batches
+
+    def run_until(self, until, handlers):
+        # runs everything due at or before 'until': handlers[event type](times, targets, payloads) per batch;
+        # events the handlers schedule which are due as well run in further rounds
+        processed = 0
+        while True:
+            batches = self.pop_due(until)
+            if not batches:
+                break
+            for event_type, entries in batches.items():
+                handlers[event_type](np.array([entry[_TIME] for entry in entries], dtype=np.float64),
+                                     np.array([entry[_TARGET] for entry in entries]),
+                                     np.array([entry[_PAYLOAD] for entry in entries]))
+                processed += len(entries)
+        self.processed += processed
+        return processed
+
+    def pending(self, event_type=None):
+        # entries still waiting, of one type or of all types
+        return [entry for entry in self.heap
+                if entry[_TYPE] is not None and (event_type is None or entry[_TYPE] == event_type)]
+
+    def get_state(self):
+        # (header, arrays) for checkpoint.py, in the same layout as NutrientField.get_state
+        entries = self.pending()
+        types = sorted({entry[_TYPE] for entry in entries})
+        type_codes = {event_type: code for code, event_type in enumerate(types)}
+        header = {"next_id": self.next_id, "types": types}
+        arrays = {
+            "event_times": np.array([entry[_TIME] for entry in entries], dtype=np.float64),
+            "event_ids": np.array([entry[_ID] for entry in entries], dtype=np.int64),
+            "event_types": np.array([type_codes[entry[_TYPE]] for entry in entries], dtype=np.uint16),
+            "event_targets": np.array([entry[_TARGET] for entry in entries], dtype=np.int64),
+            "event_payloads": np.array([entry[_PAYLOAD] for entry in entries], dtype=np.float64),
+        }
+        return header, arrays
+
+    @classmethod
+    def from_state(cls, header, arrays):
+        scheduler = cls()
+        types = header["types"]
+        scheduler.heap = [[time, event_id, types[code], target, payload] for time, event_id, code, target, payload
+                          in zip(arrays["event_times"].tolist(), arrays["event_ids"].tolist(),
+                                 arrays["event_types"].tolist(), arrays["event_targets"].tolist(),
+                                 arrays["event_payloads"].tolist())]
+        heapq.heapify(scheduler.heap)
+        scheduler.next_id = header["next_id"]
+        return scheduler
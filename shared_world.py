@@ -0,0 +1,198 @@
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from common import *
+
+logging_setup()
+logger_shared = logging.getLogger(__name__)
+
+
+# World arrays (heightmap, dense voxel chunks, entity columns) in multiprocessing.shared_memory,
+# so worker pools read them as numpy views instead of receiving pickled copies with every job.
+#
+# Ownership:
+# - The process which allocates a SharedWorld owns its blocks. Only the owner resizes (a resize is a new
+#   block under a new name) and only the owner unlinks the blocks, in close().
+# - Workers attach from handles(), a small picklable dict which is sent along with every job. Attachments
+#   are cached per block name (attach_world), so a worker maps every block once and notices resized ones.
+#
+# Versioning (a sequence lock per array, kept in the block header next to the number of used rows):
+# - A writer calls begin_write() before and end_write() after changing an array. The sequence number is odd
+#   while a write is in progress and grows by two with every finished write.
+# - A reader which has to see a consistent state either reads between two barriers of its pool (jobs carry
+#   the sequence number they were dispatched at, changed_since() tells whether the owner wrote meanwhile),
+#   or takes a copy with read(), which retries until no write overlapped it.
+# - Workers may write in place, but only to disjoint regions handed out by the owner (split_rows), between
+#   dispatch and collection of one batch of jobs. The owner then calls begin_write()/end_write() once for the
+#   whole batch, so readers see one new version and not one per worker.
+# This module must stay free of Panda3D, it is used by headless workers.
+
+# sequence number, used rows; 64 bytes keep the data aligned to a cache line
+_header_dtype = np.dtype([("sequence", "<u8"), ("rows", "<u8")])
+_header_bytes = 64
+
+
+class SharedArray:
+    # one numpy array in a shared memory block, behind the header of the versioning protocol
+
+    def __init__(self, block, shape, dtype, owner):
+        self.block = block
+        self.owner = owner
+        self.header = np.ndarray((), dtype=_header_dtype, buffer=block.buf)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=_header_bytes)
+
+    @classmethod
+    def create(cls, shape, dtype, initial=None):
+        shape = tuple(int(s) for s in np.atleast_1d(shape))
+        dtype = np.dtype(dtype)
+        size = _header_bytes + max(int(np.prod(shape, dtype=np.int64)) * dtype.itemsize, 1)
+        shared = cls(shared_memory.SharedMemory(create=True, size=size), shape, dtype, owner=True)
+        shared.header["sequence"] = 0
+        shared.header["rows"] = shape[0]
+        if initial is not None:
+            initial = np.asarray(initial)
+            shared.array[:len(initial)] = initial
+            shared.header["rows"] = len(initial)
+        return shared
+
+    @classmethod
+    def attach(cls, handle):
+        name, shape, dtype = handle
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype, owner=False)
+
+    def handle(self):
+        return (self.block.name, self.array.shape, self.array.dtype.str)
+
+    @property
+    def capacity(self):
+        return self.array.shape[0]
+
+    @property
+    def rows(self):
+        return int(self.header["rows"])
+
+    @property
+    def sequence(self):
+        return int(self.header["sequence"])
+
+    def view(self, writable=False):
+        # zero-copy view of the used rows, read-only unless the caller owns a region to write
+        view = self.array[:self.rows]
+        view.flags.writeable = writable
+        return view
+
+    def begin_write(self):
+        self.header["sequence"] += 1
+
+    def end_write(self, rows=None):
+        if rows is not None:
+            self.header["rows"] = rows
+        self.header["sequence"] += 1
+
+    def changed_since(self, sequence):
+        return self.sequence != sequence
+
+    def read(self):
+        # consistent copy of the used rows and the sequence number it belongs to
+        while True:
+            sequence = self.sequence
+            if sequence % 2:
+                continue
+            data = self.array[:self.rows].copy()
+            if self.sequence == sequence:
+                return data, sequence
+
+    def close(self):
+        # views handed out must be dropped before, the block cannot be closed while they exist
+        self.header = self.array = None
+        self.block.close()
+        if self.owner:
+            self.block.unlink()
+
+
+class SharedWorld:
+    # named SharedArrays of one world, see the protocol above
+
+    def __init__(self, arrays=None, owner=True):
+        self.arrays = arrays if arrays is not None else {}
+        self.owner = owner
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def allocate(self, name, shape, dtype, initial=None):
+        if not self.owner:
+            raise RuntimeError("Only the process owning a SharedWorld allocates arrays.")
+        if name in self.arrays:
+            self.arrays.pop(name).close()
+        self.arrays[name] = SharedArray.create(shape, dtype, initial)
+        return self.arrays[name]
+
+    def share(self, name, array):
+        # moves an existing array into shared memory, returns the shared view to keep using instead
+        array = np.asarray(array)
+        return self.allocate(name, array.shape, array.dtype, array).array
+
+    def publish(self, name, values):
+        # replaces the rows of a column array (entity columns, ...), growing its block when needed;
+        # a grown array lives in a new block, workers pick it up with the next handles()
+        values = np.asarray(values)
+        shared = self.arrays.get(name)
+        if shared is None or shared.capacity < len(values) or shared.array.shape[1:] != values.shape[1:] \
+                or shared.array.dtype != values.dtype:
+            capacity = max(len(values) * 2, 16)
+            sequence = shared.sequence + 2 if shared is not None else 0
+            shared = self.allocate(name, (capacity,) + values.shape[1:], values.dtype)
+            shared.header["sequence"] = sequence
+        shared.begin_write()
+        shared.array[:len(values)] = values
+        shared.end_write(len(values))
+        return shared
+
+    def handles(self):
+        return {name: shared.handle() for name, shared in self.arrays.items()}
+
+    def sequences(self):
+        return {name: shared.sequence for name, shared in self.arrays.items()}
+
+    def nbytes(self):
+        return sum(shared.block.size for shared in self.arrays.values())
+
+    def close(self):
+        for shared in self.arrays.values():
+            shared.close()
+        self.arrays = {}
+
+
+# attachments of this (worker) process, block name -> SharedArray
+_attached = {}
+
+
+def attach_world(handles):
+    # worker side: SharedWorld over the blocks of the handles, every block is mapped only once per process
+    arrays = {}
+    for name, handle in handles.items():
+        shared = _attached.get(handle[0])
+        if shared is None:
+            shared = _attached[handle[0]] = SharedArray.attach(handle)
+        arrays[name] = shared
+
+    # blocks the owner replaced (grown arrays) are released
+    current = {handle[0] for handle in handles.values()}
+    for block_name in [block_name for block_name in _attached if block_name not in current]:
+        try:
+            _attached.pop(block_name).close()
+        except BufferError:
+            logger_shared.warning(f"Views of the replaced block {block_name} are still in use.")
+    return SharedWorld(arrays, owner=False)
+
+
+def split_rows(rows, parts):
+    # disjoint (start, stop) row ranges for 'parts' writers
+    bounds = np.linspace(0, rows, parts + 1).astype(np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
@@ -0,0 +1,232 @@
+import logging
+import socket
+import struct
+
+import numpy as np
+
+from common import *
+
+logging_setup()
+logger_protocol = logging.getLogger(__name__)
+
+
+# Wire format between the simulation server (sim_server.py) and viewers.
+# Every message is one frame: uint32 payload length, then the payload:
+#   uint8 kind, int64 tick, uint8 number of arrays, then every array as
+#   uint8 dtype code, uint8 ndim, uint32 per dimension, raw little-endian bytes.
+# Messages only carry what changed since the viewer last got an update: positions of entities which moved,
+# hprs of those which turned, energies which changed by more than energy_resolution, cells of entities whose
+# body changed, ids of removed entities, and voxel changes of the terrain. A viewer which connects late first
+# gets every entity and body and every terrain edit so far.
+# This module must stay free of Panda3D, the server side runs headless.
+
+default_port = 5005
+# smallest change of an entity's energy which is sent to the viewers
+energy_resolution = 1e-3
+
+HELLO = 0           # [tick_dt, master_seed]
+ENTITIES = 1        # see encode_entities
+VOXELS = 2          # [coords (N, 3) int32, solid (N,) bool]
+
+_dtypes = [np.dtype(t) for t in ("<i1", "<u1", "<i2", "<u2", "<i4", "<u4", "<i8", "<u8", "<f4", "<f8", "?")]
+_dtype_codes = {dtype: code for code, dtype in enumerate(_dtypes)}
+
+_frame_header = struct.Struct("<I")
+_message_header = struct.Struct("<BqB")
+_array_header = struct.Struct("<BB")
+
+
+def encode_message(kind, tick, arrays):
+    parts = [_message_header.pack(kind, tick, len(arrays))]
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        dtype = array.dtype.newbyteorder("<") if array.dtype.byteorder == ">" else array.dtype
+        parts.append(_array_header.pack(_dtype_codes[np.dtype(dtype)], array.ndim))
+        parts.append(struct.pack(f"<{array.ndim}I", *array.shape))
+        parts.append(array.astype(dtype, copy=False).tobytes())
+    payload = b"".join(parts)
+    return _frame_header.pack(len(payload)) + payload
+
+
+def decode_message(payload):
+    kind, tick, count = _message_header.unpack_from(payload, 0)
+    offset = _message_header.size
+    arrays = []
+    for _ in range(count):
+        code, ndim = _array_header.unpack_from(payload, offset)
+        offset += _array_header.size
+        shape = struct.unpack_from(f"<{ndim}I", payload, offset)
+        offset += 4 * ndim
+        dtype = _dtypes[code]
+        size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        arrays.append(np.frombuffer(payload, dtype=dtype, count=size // dtype.itemsize, offset=offset).reshape(shape))
+        offset += size
+    return kind, tick, arrays
+
+
+def encode_entities(tick, moved_ids, positions, turned_ids, hprs, energy_ids, energies, removed, body_ids,
+                    body_counts, body_offsets, body_types):
+    # positions of the moved entities, hprs of the turned ones (a subset of the moved ones), changed energies,
+    # removed entity ids, and the cells (offsets to the entity position and type ids, concatenated, with
+    # per-body counts) of every entity whose body changed
+    return encode_message(ENTITIES, tick, [
+        np.asarray(moved_ids, dtype=np.int64), np.asarray(positions, dtype=np.float32).reshape(-1, 3),
+        np.asarray(turned_ids, dtype=np.int64), np.asarray(hprs, dtype=np.float32).reshape(-1, 3),
+        np.asarray(energy_ids, dtype=np.int64), np.asarray(energies, dtype=np.float32),
+        np.asarray(removed, dtype=np.int64), np.asarray(body_ids, dtype=np.int64),
+        np.asarray(body_counts, dtype=np.int32), np.asarray(body_offsets, dtype=np.float32).reshape(-1, 3),
+        np.asarray(body_types, dtype=np.uint8)])
+
+
+def encode_voxels(tick, coords, solid):
+    return encode_message(VOXELS, tick, [np.asarray(coords, dtype=np.int32).reshape(-1, 3),
+                                         np.asarray(solid, dtype=bool)])
+
+
+class FrameReader:
+    # collects bytes from a non-blocking socket and cuts them into complete message payloads
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        payloads = []
+        while len(self.buffer) >= _frame_header.size:
+            (length,) = _frame_header.unpack_from(self.buffer, 0)
+            end = _frame_header.size + length
+            if len(self.buffer) < end:
+                break
+            payloads.append(bytes(self.buffer[_frame_header.size:end]))
+            del self.buffer[:end]
+        return payloads
+
+
+class RemoteEntity:
+    __slots__ = ("entity_id", "previous_pos", "previous_hpr", "previous_tick", "pos", "hpr", "tick", "energy",
+                 "cell_offsets", "cell_types", "body_changed")
+
+    def __init__(self, entity_id):
+        self.entity_id = entity_id
+        self.previous_pos = self.pos = None
+        self.previous_hpr = self.hpr = None
+        self.previous_tick = self.tick = None
+        self.energy = 0.0
+        self.cell_offsets = np.empty((0, 3), dtype=np.float32)
+        self.cell_types = np.empty(0, dtype=np.uint8)
+        self.body_changed = False
+
+    def interpolated(self, tick):
+        # position and hpr at a (fractional) tick between the two latest snapshots
+        if self.previous_tick is None or self.tick == self.previous_tick:
+            return self.pos, self.hpr
+        t = min(max((tick - self.previous_tick) / (self.tick - self.previous_tick), 0.0), 1.0)
+        return (self.previous_pos + (self.pos - self.previous_pos) * t,
+                self.previous_hpr + (self.hpr - self.previous_hpr) * t)
+
+
+# Viewer side of the connection: receives messages without ever blocking the render loop
+# and keeps the latest state of every entity, with the snapshot before it for interpolation.
+class SimulationClient:
+
+    def __init__(self, host="127.0.0.1", port=default_port, timeout=5.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.reader = FrameReader()
+
+        self.entities = {}          # entity id -> RemoteEntity
+        self.removed = []           # ids removed since the last call of take_removed()
+        self.voxel_changes = []     # (coords, solid) since the last call of take_voxel_changes()
+        self.tick_dt = None
+        self.master_seed = None
+        self.tick = -1
+        self.entities_tick = None   # tick of the latest entity update
+        self.connected = True
+        self.bytes_received = 0
+
+    def poll(self):
+        # reads whatever arrived and applies all complete messages, returns the number of messages
+        chunks = []
+        while True:
+            try:
+                data = self.sock.recv(1 << 20)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b""
+            if not data:
+                self.connected = False
+                break
+            chunks.append(data)
+        if not chunks:
+            return 0
+
+        data = b"".join(chunks)
+        self.bytes_received += len(data)
+        payloads = self.reader.feed(data)
+        for payload in payloads:
+            self.apply(*decode_message(payload))
+        return len(payloads)
+
+    def apply(self, kind, tick, arrays):
+        if kind == HELLO:
+            self.tick_dt = float(arrays[0][0])
+            self.master_seed = int(arrays[1][0])
+        elif kind == ENTITIES:
+            self.apply_entities(tick, *arrays)
+        elif kind == VOXELS:
+            self.voxel_changes.append((arrays[0], arrays[1]))
+        else:
+            logger_protocol.warning(f"Unknown message kind {kind}.")
+        self.tick = max(self.tick, tick)
+
+    def apply_entities(self, tick, moved_ids, positions, turned_ids, hprs, energy_ids, energies, removed, body_ids,
+                       body_counts, body_offsets, body_types):
+        for entity_id in removed.tolist():
+            if self.entities.pop(entity_id, None) is not None:
+                self.removed.append(entity_id)
+
+        # entities which are not in the update did not move since the one before, so a moved entity was still
+        # where it was at the tick of that update, it moved between there and this tick
+        hpr_of = dict(zip(turned_ids.tolist(), hprs))
+        for entity_id, pos in zip(moved_ids.tolist(), positions):
+            entity = self.entities.get(entity_id)
+            if entity is None:
+                entity = self.entities[entity_id] = RemoteEntity(entity_id)
+            hpr = hpr_of.get(entity_id)
+            if entity.pos is None:
+                entity.previous_pos, entity.previous_hpr, entity.previous_tick = pos.copy(), hpr.copy(), tick
+            else:
+                entity.previous_pos, entity.previous_hpr = entity.pos, entity.hpr
+                entity.previous_tick = self.entities_tick
+            entity.pos, entity.tick = pos.copy(), tick
+            if hpr is not None:
+                entity.hpr = hpr.copy()
+        self.entities_tick = tick
+
+        for entity_id, energy in zip(energy_ids.tolist(), energies.tolist()):
+            entity = self.entities.get(entity_id)
+            if entity is not None:
+                entity.energy = energy
+
+        starts = np.cumsum(body_counts) - body_counts
+        for entity_id, start, count in zip(body_ids.tolist(), starts.tolist(), body_counts.tolist()):
+            entity = self.entities.get(entity_id)
+            if entity is None:
+                continue
+            entity.cell_offsets = body_offsets[start:start + count].copy()
+            entity.cell_types = body_types[start:start + count].copy()
+            entity.body_changed = True
+
+    def take_removed(self):
+        removed, self.removed = self.removed, []
+        return removed
+
+    def take_voxel_changes(self):
+        changes, self.voxel_changes = self.voxel_changes, []
+        return changes
+
+    def close(self):
+        self.sock.close()
+        self.connected = False
@@ -0,0 +1,242 @@
+import argparse
+import logging
+import socket
+import time
+
+import numpy as np
+
+from common import *
+from occupancy import *
+from light_map import *
+from sim_protocol import *
+from simulation import *
+from genome import random_genome
+from telemetry import *
+
+logging_setup()
+logger_server = logging.getLogger(__name__)
+
+
+class ClientConnection:
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.outgoing = bytearray()
+        self.queued = []                # messages which must not be coalesced (voxel changes)
+        self.body_versions = {}         # entity id -> body version the viewer has
+        self.sent = None                # (entity ids, positions, hprs, energies) as the viewer has them
+
+
+# Runs a headless Simulation in its own process and streams deltas to any number of viewers.
+# The simulation never waits for a viewer: sockets are non-blocking, and a new entity update is only
+# built for a viewer once everything before it was sent. A slow viewer therefore skips ticks, but the
+# next update is computed against what that viewer already has, so no body change gets lost.
+class SimulationServer:
+
+    def __init__(self, simulation, host="127.0.0.1", port=default_port):
+        self.simulation = simulation
+        self.listener = socket.create_server((host, port))
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.clients = []
+        self.body_cache = {}            # entity id -> (body version, cell offsets, cell types)
+        simulation.voxel_changes = []
+        self.bytes_sent = 0
+        logger_server.info(f"Simulation server listening on {host}:{self.port}.")
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = ClientConnection(sock, address)
+            client.outgoing += encode_message(HELLO, self.simulation.tick, [
+                np.array([self.simulation.tick_dt]), np.array([self.simulation.master_seed], dtype=np.int64)])
+            # every terrain edit of the run so far, including those of a resumed checkpoint
+            if self.simulation.terrain_edits:
+                client.queued.append(encode_voxels(self.simulation.tick, *self.simulation.terrain_edit_arrays()))
+            self.clients.append(client)
+            logger_server.info(f"Viewer connected from {address}.")
+
+    def publish_terrain_edits(self):
+        # sends the terrain edits of the simulation since the last tick
+        changes = self.simulation.take_voxel_changes()
+        if not changes:
+            return
+        coords = np.concatenate([c for c, solid in changes])
+        solid = np.concatenate([solid for c, solid in changes])
+        self.publish_voxels(coords, solid)
+
+    def publish_voxels(self, coords, solid):
+        # terrain changes are queued for every viewer, they are sent before the next entity update
+        message = encode_voxels(self.simulation.tick, coords, solid)
+        for client in self.clients:
+            client.queued.append(message)
+
+    def body(self, entity):
+        cached = self.body_cache.get(entity.entity_id)
+        if cached is None or cached[0] != entity.body_version:
+            offsets = np.array([tuple(cell.pos) for cell in entity.cells], dtype=np.float32).reshape(-1, 3)
+            offsets -= np.array(tuple(entity.entity_pos), dtype=np.float32)
+            types = np.array([cell.cell_type.type_id for cell in entity.cells], dtype=np.uint8)
+            cached = self.body_cache[entity.entity_id] = (entity.body_version, offsets, types)
+        return cached
+
+    def entity_update(self, client, transforms):
+        entities = self.simulation.entities
+        current = {entity.entity_id for entity in entities}
+        removed = [entity_id for entity_id in client.body_versions if entity_id not in current]
+        for entity_id in removed:
+            del client.body_versions[entity_id]
+
+        body_ids, counts, offsets, types = [], [], [], []
+        for entity in entities:
+            version, body_offsets, body_types = self.body(entity)
+            if client.body_versions.get(entity.entity_id) != version:
+                client.body_versions[entity.entity_id] = version
+                body_ids.append(entity.entity_id)
+                counts.append(len(body_types))
+                offsets.append(body_offsets)
+                types.append(body_types)
+
+        # only rows which differ from what the viewer has are sent; entities it does not know get every row
+        ids, positions, hprs, energies = transforms
+        moved = turned = energy_changed = np.ones(len(ids), dtype=bool)
+        if client.sent is not None and len(client.sent[0]):
+            sent_ids, sent_positions, sent_hprs, sent_energies = client.sent
+            index = np.minimum(np.searchsorted(sent_ids, ids), len(sent_ids) - 1)
+            known = sent_ids[index] == ids
+            turned = ~known | np.any(hprs != sent_hprs[index], axis=1)
+            moved = turned | np.any(positions != sent_positions[index], axis=1)
+            energy_changed = ~known | (np.abs(energies - sent_energies[index]) > energy_resolution)
+            # unchanged rows keep the values the viewer has, so small drifts add up until they are sent
+            client.sent = (ids, np.where(moved[:, None], positions, sent_positions[index]),
+                           np.where(turned[:, None], hprs, sent_hprs[index]),
+                           np.where(energy_changed, energies, sent_energies[index]))
+        else:
+            client.sent = transforms
+
+        return encode_entities(
+            self.simulation.tick, ids[moved], positions[moved], ids[turned], hprs[turned], ids[energy_changed],
+            energies[energy_changed], removed, body_ids, counts,
+            np.concatenate(offsets) if offsets else np.empty((0, 3)),
+            np.concatenate(types) if types else np.empty(0))
+
+    def send_updates(self):
+        entities = self.simulation.entities
+        for entity_id in set(self.body_cache) - {entity.entity_id for entity in entities}:
+            del self.body_cache[entity_id]
+
+        transforms = None
+        for client in list(self.clients):
+            if not client.outgoing:
+                while client.queued:
+                    client.outgoing += client.queued.pop(0)
+                if transforms is None:
+                    # sorted by entity id, as entity_update looks them up in what a viewer was sent before
+                    ids = np.array([entity.entity_id for entity in entities], dtype=np.int64)
+                    order = np.argsort(ids)
+                    positions = np.array([tuple(entity.entity_pos) for entity in entities], dtype=np.float32)
+                    hprs = np.array([tuple(entity.entity_hpr) for entity in entities], dtype=np.float32)
+                    energies = np.array([entity.energy for entity in entities], dtype=np.float32)
+                    transforms = (ids[order], positions.reshape(-1, 3)[order], hprs.reshape(-1, 3)[order],
+                                  energies[order])
+                client.outgoing += self.entity_update(client, transforms)
+            self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            logger_server.info(f"Viewer {client.address} disconnected.")
+            client.sock.close()
+            self.clients.remove(client)
+            return
+        del client.outgoing[:sent]
+        self.bytes_sent += sent
+
+    def run(self, ticks=None, realtime=True):
+        # steps the simulation (in real time, or as fast as possible) and streams every tick
+        start = time.perf_counter()
+        done = 0
+        while ticks is None or done < ticks:
+            self.accept()
+            self.simulation.step()
+            self.publish_terrain_edits()
+            self.send_updates()
+            done += 1
+            if realtime:
+                delay = start + done * self.simulation.tick_dt - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        return done
+
+    def close(self):
+        for client in self.clients:
+            client.sock.close()
+        self.clients = []
+        self.listener.close()
+
+
+def create_simulation(master_seed, entity_count, checkpoint=None, heightmap="Perlin/heightmap.npy",
+                      world_size=100, max_height=10):
+    # the same world as VoxelWorld: entity at (5, 3, 10), more entities grown from random genomes,
+    # nutrients over the terrain, sunlight map and raycaster of the heightmap terrain (if the heightmap exists)
+    if checkpoint is not None:
+        simulation = Simulation.load_checkpoint(checkpoint, headless=True)
+    else:
+        simulation = Simulation(master_seed, headless=True)
+        simulation.spawn_entity(entity_pos=(5, 3, 10))
+        rng = make_rng(master_seed, "spawn")
+        for _ in range(entity_count - 1):
+            pos = (rng.uniform(0, world_size), rng.uniform(0, world_size), max_height + 1)
+            simulation.spawn_entity(entity_pos=pos, genome=random_genome(rng, 16))
+
+    if simulation.nutrients is None:
+        simulation.create_nutrients((world_size, world_size))
+    try:
+        heights = np.load(heightmap)[:world_size, :world_size]
+    except FileNotFoundError:
+        logger_server.info("No heightmap, running without sunlight map and terrain vision.")
+    else:
+        simulation.set_terrain(heightmap_occupancy(heights, max_height))
+    return simulation
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless simulation server, view it with main.py --connect")
+    parser.add_argument("--seed", type=int, default=42, help="master seed of the run")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--entities", type=int, default=1)
+    parser.add_argument("--resume", default=None, help="checkpoint file (.npz) to resume from")
+    parser.add_argument("--ticks", type=int, default=None, help="stop after this many ticks")
+    parser.add_argument("--fast", action="store_true", help="do not pace ticks to real time")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="run ray casting and locomotion per spatial region on this many threads")
+    parser.add_argument("--region-size", type=float, default=32.0, help="side of a spatial region in voxels")
+    parser.add_argument("--telemetry", default=None, metavar="DIR", help="write population telemetry into this directory")
+    parser.add_argument("--telemetry-interval", type=float, default=1.0, help="seconds of simulation time between samples")
+    args = parser.parse_args()
+
+    simulation = create_simulation(args.seed, args.entities, args.resume)
+    if args.threads is not None:
+        simulation.set_workers(args.threads, args.region_size)
+    if args.telemetry is not None:
+        simulation.telemetry = TelemetrySink(args.telemetry, args.telemetry_interval)
+
+    server = SimulationServer(simulation, args.host, args.port)
+    try:
+        server.run(args.ticks, realtime=not args.fast)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if simulation.telemetry is not None:
+            simulation.telemetry.close()
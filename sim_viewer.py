@@ -0,0 +1,69 @@
+import logging
+
+from panda3d.core import NodePath
+
+from common import *
+from cell import build_cell_batch_mesh
+from lattice import to_lattice
+from organism_mesher import face_mask
+from sim_protocol import *
+
+logging_setup()
+logger_viewer = logging.getLogger(__name__)
+
+
+# Shows the entities of a simulation running in another process (sim_server.py).
+# Every remote entity is one node holding a single batched mesh of its cells, rebuilt only when the
+# server reports a body change. Transforms are interpolated between the two latest snapshots while the
+# viewer renders one tick behind the newest one, so motion stays smooth whatever rate either side runs at.
+class RemoteView:
+
+    def __init__(self, client, parent, on_voxels=None):
+        self.client = client
+        self.parent = parent
+        self.on_voxels = on_voxels          # on_voxels(coords, solid) for terrain changes of the server
+        self.nodes = {}                     # entity id -> NodePath
+        self.render_tick = None
+        self.body_rebuilds = 0
+
+    def update(self, dt):
+        self.client.poll()
+
+        for entity_id in self.client.take_removed():
+            node = self.nodes.pop(entity_id, None)
+            if node is not None:
+                node.removeNode()
+        for coords, solid in self.client.take_voxel_changes():
+            if self.on_voxels is not None:
+                self.on_voxels(coords, solid)
+
+        if self.client.tick_dt is None or self.client.tick < 0:
+            return
+
+        # the render clock follows local time, but stays between the two newest ticks
+        latest = self.client.tick
+        if self.render_tick is None:
+            self.render_tick = latest - 1
+        self.render_tick = min(max(self.render_tick + dt / self.client.tick_dt, latest - 1), latest)
+
+        for entity_id, entity in self.client.entities.items():
+            node = self.nodes.get(entity_id)
+            if node is None:
+                node = self.nodes[entity_id] = self.parent.attachNewNode(f"remote_entity_{entity_id}")
+            if entity.body_changed:
+                node.getChildren().detach()
+                node.attachNewNode(build_cell_batch_mesh(entity.cell_offsets, entity.cell_types,
+                                                         name=f"remote_body_{entity_id}",
+                                                         face_mask=face_mask(to_lattice(entity.cell_offsets))))
+                entity.body_changed = False
+                self.body_rebuilds += 1
+
+            pos, hpr = entity.interpolated(self.render_tick)
+            node.setPos(*(float(c) for c in pos))
+            node.setHpr(*(float(c) for c in hpr))
+
+    def close(self):
+        for node in self.nodes.values():
+            node.removeNode()
+        self.nodes = {}
+        self.client.close()
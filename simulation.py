@@ -0,0 +1,405 @@
+import logging
+
+import numpy as np
+import torch
+from panda3d.core import LVector3
+
+from common import *
+from rng_streams import *
+from entity import *
+from brain import *
+from cell_types import *
+from nutrients import *
+from scheduler import *
+from locomotion import *
+from light_map import *
+from raycast import *
+from region_pool import *
+
+logging_setup()
+logger_simulation = logging.getLogger(__name__)
+
+
+# energy a photosynthetic cell gains per second of simulation time at light intensity 1
+photosynthesis_rate = 0.01
+photosynthetic_type_ids = np.array(type_ids_with("photosynthetic"), dtype=np.int64)
+optic_type_id = cell_type_id("Optic")
+
+# nutrients a FoodIngestion cell can take from the nutrient field per second
+ingestion_rate = 0.05
+# fraction of eaten nutrients turned into energy, every Gastric cell of an entity adds 'gastric_efficiency'
+base_digestion_efficiency = 0.5
+gastric_efficiency = 0.1
+
+# Optic cells look along the direction from the center of their entity to the cell,
+# with a few rays spread in a cone around it
+vision_range = 24.0
+vision_cone = 0.35          # tangent of the cone half angle
+vision_rays = np.array([[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1]], dtype=np.float64)
+cell_half_width = 0.25
+
+
+# The state of a run which is independent of any window: entities, their brains and the clock.
+# The simulation advances in fixed ticks, so the results only depend on the master seed
+# and the number of ticks, not on the frame rate of a viewer.
+class Simulation:
+
+    def __init__(self, master_seed=0, tick_dt=1.0 / 30.0, headless=True):
+        self.master_seed = master_seed
+        self.tick_dt = tick_dt
+        self.headless = headless
+
+        self.tick = 0
+        self.time = 0.0
+        self.accumulator = 0.0
+        self.next_entity_id = 0
+
+        self.entities = []
+        self.brains = BrainEvaluator()
+        self.brain_body_versions = {}   # entity id -> body version its controller was last fitted to
+
+        # sparse events in simulation time, run in batches per event type at the start of the tick they are due in
+        self.events = EventScheduler()
+        self.event_handlers = {"grow": self.grow_entities}
+        self.growth_events = {}         # entity id -> pending growth event
+
+        # spring-mass bodies of all entities with muscles, fins or gliders, driven by their brains
+        self.locomotion = LocomotionEngine(base_actuator_count)
+
+        # SunlightMap of the terrain (see light_map.py), set by whoever generates the world
+        # without one, photosynthetic cells gain no energy
+        self.light_map = None
+        self.light_body_version = None
+        # VoxelRaycaster over the same terrain grid, for vision; without one rays only see entities
+        self.raycaster = None
+
+        # every terrain edit of the run, (x, y, z) -> solid; saved in checkpoints and applied again by set_terrain,
+        # since the terrain itself is generated by whoever loads the run
+        self.terrain_edits = {}
+        # terrain edits (coords, solid) since the last take_voxel_changes(), only recorded once whoever streams
+        # them (sim_server.py) sets this to a list
+        self.voxel_changes = None
+
+        # NutrientField (see nutrients.py) organisms eat from and excrete into, part of the simulation state
+        self.nutrients = None
+
+        # flattened cells of all entities, gathered at most once per tick
+        self.cell_columns_tick = None
+        self.cell_columns_cache = None
+
+        # TelemetrySink (see telemetry.py) sampling population statistics while the simulation runs
+        self.telemetry = None
+
+        # SharedWorld (see shared_world.py) the entity columns are published to every tick, for worker pools
+        self.shared_world = None
+
+        # RegionPool (see region_pool.py) running ray casting and locomotion per spatial region on threads,
+        # without one they run in a single batch; the results are the same either way
+        self.region_pool = None
+
+    def spawn_entity(self, entity_pos, entity_hpr=(0, 0, 0), genome=None, with_brain=True):
+        entity_id = self.next_entity_id
+        self.next_entity_id += 1
+
+        rng = make_rng(self.master_seed, "entity", entity_id)
+        entity_args = dict(entity_id=entity_id, rng=rng, headless=self.headless)
+        if genome is None:
+            entity = Entity(LVector3(entity_pos), entity_hpr, **entity_args)
+        else:
+            entity = Entity.from_genome(genome, LVector3(entity_pos), entity_hpr, **entity_args)
+
+        if with_brain:
+            # the brain weights come from the entity's own stream as well
+            generator = torch.Generator().manual_seed(int(rng.integers(2**63)))
+            self.brains.set_controller(entity, BrainController.for_entity(entity, generator))
+
+        self.entities.append(entity)
+        self.growth_events[entity_id] = self.events.schedule(self.time + growth_interval, "grow", entity_id)
+        return entity
+
+    def remove_entity(self, entity):
+        self.entities.remove(entity)
+        self.events.cancel(self.growth_events.pop(entity.entity_id, None))
+        self.brains.remove_controller(entity)
+        self.brain_body_versions.pop(entity.entity_id, None)
+        if not self.headless:
+            entity.destroy()
+
+    def step(self):
+        # advances the simulation by exactly one tick
+        self.events.run_until((self.tick + 1) * self.tick_dt, self.event_handlers)
+        self.locomotion.step(self.entities, self.tick_dt, self.region_pool)
+        # bodies may have changed or moved
+        self.cell_columns_tick = None
+        self.apply_sunlight()
+        self.sense_optics()
+        if self.nutrients is not None:
+            self.nutrients.advance(self.tick_dt)
+            self.feed()
+        self.fit_brains()
+        self.brains.step()
+
+        self.tick += 1
+        self.time = self.tick * self.tick_dt
+        if self.shared_world is not None:
+            self.publish_columns(self.shared_world)
+        if self.telemetry is not None:
+            self.telemetry.maybe_sample(self)
+
+    def grow_entities(self, times, entity_ids, payloads):
+        # every entity in the batch grows one cell and schedules its next growth step
+        entities = {entity.entity_id: entity for entity in self.entities}
+        for time, entity_id in zip(times.tolist(), entity_ids.tolist()):
+            entity = entities.get(entity_id)
+            if entity is None:
+                continue
+            entity.grow()
+            self.growth_events[entity_id] = self.events.schedule(time + growth_interval, "grow", entity_id)
+
+    def fit_brains(self):
+        # controllers of bodies which changed since they were last fitted are resized to the new body,
+        # so new sensor and actuated cells get their inputs and outputs
+        for entity, controller in list(self.brains.controllers.items()):
+            if self.brain_body_versions.get(entity.entity_id) == entity.body_version:
+                continue
+            self.brain_body_versions[entity.entity_id] = entity.body_version
+            shape = entity.brain_shape()
+            if shape == (controller.n_inputs, controller.n_hidden, controller.n_outputs):
+                continue
+            # the new weights come from the entity's own stream, like the weights at spawn
+            generator = torch.Generator().manual_seed(int(entity.rng.integers(2**63)))
+            self.brains.set_controller(entity, controller.resized(*shape, generator))
+
+    def set_workers(self, workers, region_size=32.0):
+        # runs the per-region kernels of every tick on 'workers' threads, None for the single batch
+        if self.region_pool is not None:
+            self.region_pool.close()
+        self.region_pool = None if workers is None else RegionPool(workers, region_size)
+
+    def set_terrain(self, occupancy, origin=(0, 0, 0), **light_args):
+        # sunlight map and raycaster of the terrain, sharing one occupancy grid
+        self.light_map = SunlightMap(occupancy, origin, **light_args)
+        self.raycaster = VoxelRaycaster(self.light_map.occupancy, self.light_map.origin)
+        # edits made before (for example by a run resumed from a checkpoint)
+        coords, solid = self.terrain_edit_arrays()
+        for value in (True, False):
+            if (solid == value).any():
+                self.light_map.set_voxels(coords[solid == value], value)
+                self.raycaster.set_voxels(coords[solid == value], value)
+
+    def set_voxels(self, coords, solid):
+        # terrain edits, kept in sync between sunlight map and raycaster
+        if self.light_map is not None:
+            self.light_map.set_voxels(coords, solid)
+        if self.raycaster is not None:
+            self.raycaster.set_voxels(coords, solid)
+        coords = voxel_coords(coords)
+        solid = np.broadcast_to(np.asarray(solid, dtype=bool), len(coords)).copy()
+        for key, value in zip(map(tuple, coords.tolist()), solid.tolist()):
+            self.terrain_edits[key] = value
+        if self.voxel_changes is not None:
+            self.voxel_changes.append((coords, solid))
+
+    def terrain_edit_arrays(self):
+        # all terrain edits of the run as (coords (N, 3), solid (N,))
+        coords = np.array(list(self.terrain_edits), dtype=np.int64).reshape(-1, 3)
+        return coords, np.array(list(self.terrain_edits.values()), dtype=bool)
+
+    def take_voxel_changes(self):
+        changes, self.voxel_changes = self.voxel_changes or [], []
+        return changes
+
+    def entity_bounds(self):
+        # axis-aligned box around the cells of every entity with cells: (entity indices, min, max)
+        positions, entity_index, _ = self.cell_columns()
+        if not len(positions):
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros((0, 3))
+        starts = np.r_[0, np.flatnonzero(np.diff(entity_index)) + 1]
+        box_min = np.minimum.reduceat(positions, starts, axis=0) - cell_half_width
+        box_max = np.maximum.reduceat(positions, starts, axis=0) + cell_half_width
+        return entity_index[starts], box_min, box_max
+
+    def cast_rays(self, origins, directions, max_distance=vision_range, exclude_ids=None):
+        # batched rays against terrain and entities: (distance, block type, entity id) per ray,
+        # block type 0 where no terrain was hit first, entity id -1 where no entity was hit first
+        # with a RegionPool the rays are cast per strip of regions of their origins, against the entities in reach
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        if exclude_ids is not None:
+            exclude_ids = np.broadcast_to(np.asarray(exclude_ids, dtype=np.int64), (len(origins),))
+        indices, box_min, box_max = self.entity_bounds()
+        entity_ids = np.array([entity.entity_id for entity in self.entities], dtype=np.int64)[indices]
+        if self.region_pool is None:
+            return self._cast_rays(origins, directions, max_distance, exclude_ids, box_min, box_max, entity_ids)
+
+        def cast_region(rays):
+            # only boxes within max_distance of the ray origins can be hit
+            lo = origins[rays].min(axis=0) - max_distance
+            hi = origins[rays].max(axis=0) + max_distance
+            near = np.all((box_max >= lo) & (box_min <= hi), axis=1)
+            return self._cast_rays(origins[rays], directions[rays], max_distance,
+                                   None if exclude_ids is None else exclude_ids[rays],
+                                   box_min[near], box_max[near], entity_ids[near])
+
+        batches = self.region_pool.partition(origins)
+        distance = np.full(len(origins), np.inf)
+        block_type = np.zeros(len(origins), dtype=np.uint8)
+        entity_id = np.full(len(origins), -1, dtype=np.int64)
+        for rays, result in zip(batches, self.region_pool.map(cast_region, batches)):
+            distance[rays], block_type[rays], entity_id[rays] = result
+        return distance, block_type, entity_id
+
+    def _cast_rays(self, origins, directions, max_distance, exclude_ids, box_min, box_max, box_ids):
+        if self.raycaster is not None:
+            terrain_distance, block_type = self.raycaster.cast(origins, directions, max_distance)
+        else:
+            terrain_distance = np.full(len(origins), np.inf)
+            block_type = np.zeros(len(origins), dtype=np.uint8)
+
+        entity_distance, entity_id = cast_boxes(origins, directions, box_min, box_max, box_ids,
+                                                max_distance, exclude_ids)
+
+        entity_first = entity_distance < terrain_distance
+        distance = np.minimum(entity_distance, terrain_distance)
+        block_type[entity_first] = 0
+        entity_id[~entity_first] = -1
+        return distance, block_type, entity_id
+
+    def sense_optics(self):
+        # every Optic cell sees the mean closeness of what its rays hit: towards 1 for near entities,
+        # towards -1 for near terrain, 0 for nothing within vision_range
+        if not self.entities:
+            return
+        positions, entity_index, type_ids = self.cell_columns()
+        optic = np.flatnonzero(type_ids == optic_type_id)
+        if not len(optic):
+            return
+
+        counts = np.bincount(entity_index, minlength=len(self.entities))
+        centers = np.column_stack([np.bincount(entity_index, weights=positions[:, k], minlength=len(self.entities))
+                                   for k in range(3)]) / np.maximum(counts, 1)[:, None]
+        owners = entity_index[optic]
+        forward = positions[optic] - centers[owners]
+        # a cell in the center of its entity looks up
+        forward[np.linalg.norm(forward, axis=1) < 1e-9] = (0, 0, 1)
+        forward = normalize(forward)
+        # two directions perpendicular to forward span the cone
+        helper = np.where(np.abs(forward[:, 2:3]) < 0.9, [[0.0, 0.0, 1.0]], [[1.0, 0.0, 0.0]])
+        side = normalize(np.cross(forward, helper))
+        up = np.cross(forward, side)
+        spread = vision_cone * vision_rays
+        directions = (forward[:, None, :] + spread[None, :, 0:1] * side[:, None, :]
+                      + spread[None, :, 1:2] * up[:, None, :]).reshape(-1, 3)
+
+        rays_per_cell = len(vision_rays)
+        origins = np.repeat(positions[optic], rays_per_cell, axis=0)
+        own_ids = np.array([entity.entity_id for entity in self.entities], dtype=np.int64)[owners]
+        distance, _, entity_id = self.cast_rays(origins, directions, vision_range,
+                                                np.repeat(own_ids, rays_per_cell))
+        closeness = np.where(np.isfinite(distance), 1.0 - distance / vision_range, 0.0)
+        closeness = np.where(entity_id >= 0, closeness, -closeness)
+        values = closeness.reshape(-1, rays_per_cell).mean(axis=1).tolist()
+
+        # cell_columns() lists the cells in entity order, as does this walk
+        values = iter(values)
+        for entity in self.entities:
+            for cell in entity.cells:
+                if cell.cell_type.type_id == optic_type_id:
+                    cell.sensor_value = next(values)
+
+    def create_nutrients(self, shape, sources=20, rate=0.05):
+        # nutrient field with sources scattered from the run's own random stream
+        self.nutrients = NutrientField(shape)
+        self.nutrients.scatter_sources(make_rng(self.master_seed, "nutrients"), sources, rate)
+        return self.nutrients
+
+    def cell_columns(self):
+        # positions (N, 3), owning entity index (N,) and type id (N,) of all cells of all entities
+        # cached for the current tick, so several batched systems share one pass over the cells
+        if self.cell_columns_tick != self.tick:
+            positions, entity_index, _ = gather_cell_positions(self.entities)
+            type_ids = np.fromiter((cell.cell_type.type_id for entity in self.entities for cell in entity.cells),
+                                   dtype=np.int64, count=len(positions))
+            self.cell_columns_cache = (positions, entity_index, type_ids)
+            self.cell_columns_tick = self.tick
+        return self.cell_columns_cache
+
+    def publish_columns(self, shared_world):
+        # entity and cell columns (structure of arrays) into shared memory, workers read them zero-copy
+        positions, entity_index, type_ids = self.cell_columns()
+        shared_world.publish("cell_positions", positions)
+        shared_world.publish("cell_entity_index", entity_index)
+        shared_world.publish("cell_type_ids", type_ids)
+        shared_world.publish("entity_ids", np.array([entity.entity_id for entity in self.entities], dtype=np.int64))
+        shared_world.publish("entity_positions", np.array([tuple(entity.entity_pos) for entity in self.entities],
+                                                          dtype=np.float64).reshape(-1, 3))
+        shared_world.publish("entity_energy", np.array([entity.energy for entity in self.entities], dtype=np.float64))
+
+    def apply_sunlight(self):
+        # photosynthetic cells of all entities gain energy proportional to the light at their position,
+        # one batched light query per tick
+        if self.light_map is None or not self.entities:
+            return
+
+        positions, entity_index, type_ids = self.cell_columns()
+        # organism shadows only need to be rebuilt when a body changed or moved
+        body_version = tuple((entity.entity_id, entity.body_version, entity.move_version) for entity in self.entities)
+        if body_version != self.light_body_version:
+            self.light_map.set_organisms(positions)
+            self.light_body_version = body_version
+
+        photosynthetic = np.isin(type_ids, photosynthetic_type_ids)
+        if not photosynthetic.any():
+            return
+
+        light = self.light_map.light_at(positions[photosynthetic])
+        gain = np.bincount(entity_index[photosynthetic], weights=light, minlength=len(self.entities))
+        gain *= photosynthesis_rate * self.tick_dt
+        for entity, energy in zip(self.entities, gain):
+            entity.energy += float(energy)
+
+    def feed(self):
+        # FoodIngestion cells of all entities eat from the nutrient field in one batched consume call,
+        # what is not digested is excreted again at the entity's Excretion cells
+        if not self.entities:
+            return
+        positions, entity_index, type_ids = self.cell_columns()
+        n_entities = len(self.entities)
+
+        eating = type_ids == cell_type_id("FoodIngestionCell")
+        if not eating.any():
+            return
+        taken = self.nutrients.consume(positions[eating], ingestion_rate * self.tick_dt)
+        eaten = np.bincount(entity_index[eating], weights=taken, minlength=n_entities)
+
+        gastric = np.bincount(entity_index[type_ids == cell_type_id("Gastric")], minlength=n_entities)
+        efficiency = np.minimum(base_digestion_efficiency + gastric_efficiency * gastric, 1.0)
+        for entity, energy in zip(self.entities, eaten * efficiency):
+            entity.energy += float(energy)
+
+        # the undigested rest is split evenly between the excretion cells of an entity
+        excreting = type_ids == cell_type_id("Excretion")
+        if excreting.any():
+            owners = entity_index[excreting]
+            per_cell = (eaten * (1.0 - efficiency))[owners] / np.bincount(owners, minlength=n_entities)[owners]
+            self.nutrients.deposit(positions[excreting], per_cell)
+
+    def advance(self, frame_dt, max_ticks=5):
+        # converts the (variable) frame time of a viewer into whole ticks
+        # at most max_ticks are run per call, so a slow frame cannot stall the viewer
+        self.accumulator = min(self.accumulator + frame_dt, max_ticks * self.tick_dt)
+        ticks = 0
+        while self.accumulator >= self.tick_dt:
+            self.accumulator -= self.tick_dt
+            self.step()
+            ticks += 1
+        return ticks
+
+    def save_checkpoint(self, path):
+        from checkpoint import save_checkpoint
+        return save_checkpoint(self, path)
+
+    @classmethod
+    def load_checkpoint(cls, path, headless=True):
+        from checkpoint import load_checkpoint
+        return load_checkpoint(path, headless)
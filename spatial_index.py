@@ -0,0 +1,294 @@
+import logging
+
+import numpy as np
+
+from common import *
+
+logging_setup()
+logger_spatial = logging.getLogger(__name__)
+
+
+# Grid coordinates are packed into a single int64 key, 21 bits per axis.
+# That allows +/- 2^20 grid cells along every axis, which is far beyond the world size.
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+
+# the most (box, grid cell) or (box, item) pairs a query looks at in one vectorized step,
+# which bounds the memory of wide queries over many points
+chunk_elements = 1 << 20
+
+
+def pack_cell_keys(cell_coords):
+    # cell_coords: (..., 3) integer grid coordinates
+    c = np.asarray(cell_coords, dtype=np.int64) + _KEY_OFFSET
+    return (c[..., 0] << (2 * _KEY_BITS)) | (c[..., 1] << _KEY_BITS) | c[..., 2]
+
+
+def _expand_ranges(starts, counts):
+    # turns a list of [start, start + count) ranges into one flat index array
+    # returns the flat indices and, for every flat index, the number of the range it belongs to
+    total = int(counts.sum())
+    range_ids = np.repeat(np.arange(len(counts)), counts)
+    if total == 0:
+        return np.empty(0, dtype=np.int64), range_ids
+    first = np.cumsum(counts) - counts
+    flat = np.arange(total, dtype=np.int64) - np.repeat(first, counts) + np.repeat(starts, counts)
+    return flat, range_ids
+
+
+# Uniform hashed grid over points (entity and cell positions).
+# Items are stored sorted by their packed cell key, so every grid cell is one contiguous
+# slice of the sorted arrays and lookups are done with np.searchsorted.
+# All queries are batched: they take arrays of query points and return CSR-style results
+# (offsets, indices), where the neighbors of query q are indices[offsets[q]:offsets[q+1]].
+class SpatialHashGrid:
+
+    def __init__(self, cell_size=1.0):
+        if cell_size <= 0:
+            raise ValueError("Argument 'cell_size' must be positive.")
+
+        self.cell_size = float(cell_size)
+
+        self.positions = np.empty((0, 3), dtype=np.float64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.int64)
+
+        # permutation which sorts the items by key, and the keys in that order
+        self.order = np.empty(0, dtype=np.int64)
+        self.sorted_keys = np.empty(0, dtype=np.int64)
+
+        self.full_rebuilds = 0
+        self.partial_updates = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell_coords(self, points):
+        return np.floor(np.asarray(points, dtype=np.float64) / self.cell_size).astype(np.int64)
+
+    def build(self, positions, ids=None):
+        # (re)builds the index from scratch
+        # ids are optional group labels (for example the entity id of every cell)
+        self.positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+        if ids is None:
+            self.ids = np.arange(len(self.positions), dtype=np.int64)
+        else:
+            self.ids = np.array(ids, dtype=np.int64).reshape(-1)
+            if len(self.ids) != len(self.positions):
+                raise ValueError("Arguments 'positions' and 'ids' must have the same length.")
+
+        self.keys = pack_cell_keys(self.cell_coords(self.positions))
+        self.order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+        self.full_rebuilds += 1
+
+    def update(self, positions, ids=None):
+        # updates the positions of all items
+        # only items which crossed a cell border have to be moved inside the sorted arrays
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        if len(positions) != len(self.positions):
+            self.build(positions, ids)
+            return
+
+        if ids is not None:
+            self.ids = np.array(ids, dtype=np.int64).reshape(-1)
+
+        new_keys = pack_cell_keys(self.cell_coords(positions))
+        moved = np.flatnonzero(new_keys != self.keys)
+        self.positions = positions.copy()
+
+        if len(moved) == 0:
+            return
+
+        # a full argsort is cheaper once a large part of the items moved
+        if len(moved) * 8 > len(positions):
+            self.keys = new_keys
+            self.order = np.argsort(self.keys, kind="stable")
+            self.sorted_keys = self.keys[self.order]
+            self.full_rebuilds += 1
+            return
+
+        # remove the moved items from the sorted arrays and re-insert them at their new keys
+        keep = np.ones(len(self.order), dtype=bool)
+        keep[np.isin(self.order, moved, assume_unique=True)] = False
+        order = self.order[keep]
+        sorted_keys = self.sorted_keys[keep]
+
+        self.keys = new_keys
+        moved_keys = new_keys[moved]
+        moved_sort = np.argsort(moved_keys, kind="stable")
+        moved = moved[moved_sort]
+        moved_keys = moved_keys[moved_sort]
+
+        insert_at = np.searchsorted(sorted_keys, moved_keys, side="right")
+        self.order = np.insert(order, insert_at, moved)
+        self.sorted_keys = np.insert(sorted_keys, insert_at, moved_keys)
+        self.partial_updates += 1
+
+    def _candidates(self, lo_cells, hi_cells):
+        # collects all items inside the grid-cell boxes [lo_cells, hi_cells] (inclusive), one box per query
+        # returns (query index, item index) pairs, sorted by query
+        n_queries = len(lo_cells)
+        if n_queries == 0 or len(self.positions) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        spans = hi_cells - lo_cells + 1
+        # for huge boxes (wide radius and knn searches over sparse items), testing the grid cell of every item
+        # is cheaper than walking all grid cells of the box
+        huge = np.prod(spans.astype(np.float64), axis=1) > len(self.positions)
+        parts = []
+        if huge.any():
+            parts.append(self._candidates_by_items(np.flatnonzero(huge), lo_cells, hi_cells))
+
+        # the other boxes walk their grid cells, grouped by span so that a small box never walks the cells
+        # of a larger one
+        small = np.flatnonzero(~huge)
+        if len(small):
+            group_spans, group = np.unique(spans[small], axis=0, return_inverse=True)
+            group = group.reshape(-1)
+            for g, span in enumerate(group_spans):
+                parts.append(self._candidates_by_cells(small[group == g], lo_cells, span))
+
+        query_ids = np.concatenate([q for q, _ in parts])
+        item_ids = np.concatenate([i for _, i in parts])
+        if len(parts) > 1:
+            order = np.argsort(query_ids, kind="stable")
+            query_ids, item_ids = query_ids[order], item_ids[order]
+        return query_ids, item_ids
+
+    def _candidates_by_cells(self, queries, lo_cells, span):
+        # items in the boxes of 'queries', which all span the same number of grid cells along every axis
+        # the boxes are walked in chunks, so that no more than chunk_elements grid cells are looked up at once
+        offsets = np.stack(np.meshgrid(*(np.arange(s) for s in span), indexing="ij"), axis=-1).reshape(-1, 3)
+        step = max(chunk_elements // len(offsets), 1)
+        query_ids = []
+        item_ids = []
+        for first in range(0, len(queries), step):
+            chunk = queries[first:first + step]
+            keys = pack_cell_keys(lo_cells[chunk][:, None, :] + offsets[None, :, :]).reshape(-1)
+            starts = np.searchsorted(self.sorted_keys, keys, side="left")
+            ends = np.searchsorted(self.sorted_keys, keys, side="right")
+            flat, box_ids = _expand_ranges(starts, ends - starts)
+            query_ids.append(chunk[box_ids // len(offsets)])
+            item_ids.append(self.order[flat])
+        return np.concatenate(query_ids), np.concatenate(item_ids)
+
+    def _candidates_by_items(self, queries, lo_cells, hi_cells):
+        # items in the boxes of 'queries', found by testing the grid cell of every item against every box
+        # the boxes are tested in chunks, so that no more than chunk_elements (box, item) pairs are tested at once
+        item_cells = self.cell_coords(self.positions)
+        step = max(chunk_elements // len(item_cells), 1)
+        query_ids = []
+        item_ids = []
+        for first in range(0, len(queries), step):
+            chunk = queries[first:first + step]
+            inside = np.all((item_cells[None, :, :] >= lo_cells[chunk][:, None, :])
+                            & (item_cells[None, :, :] <= hi_cells[chunk][:, None, :]), axis=-1)
+            box_ids, items = np.nonzero(inside)
+            query_ids.append(chunk[box_ids])
+            item_ids.append(items.astype(np.int64))
+        return np.concatenate(query_ids), np.concatenate(item_ids)
+
+    @staticmethod
+    def _to_csr(n_queries, query_ids, item_ids, *columns):
+        # query_ids must be sorted ascending, which _candidates already guarantees
+        counts = np.bincount(query_ids, minlength=n_queries)
+        offsets = np.zeros(n_queries + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return (offsets, item_ids) + columns
+
+    def query_radius(self, points, radius, exclude_ids=None):
+        # returns (offsets, indices, distances) of all items within 'radius' of every query point
+        # items whose id equals exclude_ids[q] are skipped (for example the querying entity itself)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(points),))
+
+        lo = self.cell_coords(points - radius[:, None])
+        hi = self.cell_coords(points + radius[:, None])
+        query_ids, item_ids = self._candidates(lo, hi)
+
+        diff = self.positions[item_ids] - points[query_ids]
+        dist = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+        keep = dist <= radius[query_ids]
+        if exclude_ids is not None:
+            exclude_ids = np.broadcast_to(np.asarray(exclude_ids, dtype=np.int64), (len(points),))
+            keep &= self.ids[item_ids] != exclude_ids[query_ids]
+
+        return self._to_csr(len(points), query_ids[keep], item_ids[keep], dist[keep])
+
+    def query_cells(self, lo_cells, hi_cells):
+        # returns (offsets, indices) of all items in the grid cells [lo_cells, hi_cells] (inclusive, cell coordinates)
+        lo_cells = np.asarray(lo_cells, dtype=np.int64).reshape(-1, 3)
+        hi_cells = np.asarray(hi_cells, dtype=np.int64).reshape(-1, 3)
+        return self._to_csr(len(lo_cells), *self._candidates(lo_cells, hi_cells))
+
+    def query_aabb(self, box_min, box_max):
+        # returns (offsets, indices) of all items inside the axis-aligned boxes [box_min, box_max]
+        box_min = np.asarray(box_min, dtype=np.float64).reshape(-1, 3)
+        box_max = np.asarray(box_max, dtype=np.float64).reshape(-1, 3)
+
+        lo = self.cell_coords(box_min)
+        hi = self.cell_coords(box_max)
+
+        query_ids, item_ids = self._candidates(lo, hi)
+        p = self.positions[item_ids]
+        keep = np.all((p >= box_min[query_ids]) & (p <= box_max[query_ids]), axis=-1)
+        return self._to_csr(len(box_min), query_ids[keep], item_ids[keep])
+
+    def query_knn(self, points, k, exclude_ids=None, max_radius=None):
+        # returns (indices, distances), both of shape (Q, k), sorted by distance
+        # missing neighbors are padded with index -1 and distance inf
+        # the search radius doubles for every query which has not found k items yet
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        n_queries = len(points)
+        indices = np.full((n_queries, k), -1, dtype=np.int64)
+        distances = np.full((n_queries, k), np.inf)
+        if n_queries == 0 or len(self.positions) == 0 or k <= 0:
+            return indices, distances
+
+        if max_radius is None:
+            extent = self.positions.max(axis=0) - self.positions.min(axis=0)
+            far = np.abs(points - self.positions.mean(axis=0)).max()
+            max_radius = float(np.linalg.norm(extent)) + far + self.cell_size
+
+        if exclude_ids is not None:
+            exclude_ids = np.broadcast_to(np.asarray(exclude_ids, dtype=np.int64), (n_queries,))
+
+        pending = np.arange(n_queries)
+        radius = self.cell_size
+        while len(pending):
+            last_round = radius >= max_radius
+            excl = None if exclude_ids is None else exclude_ids[pending]
+            offsets, items, dist = self.query_radius(points[pending], min(radius, max_radius), excl)
+            counts = np.diff(offsets)
+
+            # every item within the radius was found, so the k nearest of them are exact
+            done = (counts >= k) | last_round
+            if done.any():
+                width = max(int(counts[done].max()), 1)
+                pad_dist = np.full((len(pending), width), np.inf)
+                pad_item = np.full((len(pending), width), -1, dtype=np.int64)
+                rows = np.repeat(np.arange(len(pending)), counts)
+                cols = np.arange(len(items)) - np.repeat(offsets[:-1], counts)
+                row_mask = done[rows]
+                pad_dist[rows[row_mask], cols[row_mask]] = dist[row_mask]
+                pad_item[rows[row_mask], cols[row_mask]] = items[row_mask]
+
+                pad_dist = pad_dist[done]
+                pad_item = pad_item[done]
+                take = min(k, width)
+                best = np.argsort(pad_dist, axis=1, kind="stable")[:, :take]
+                target = pending[done]
+                distances[target, :take] = np.take_along_axis(pad_dist, best, axis=1)
+                indices[target, :take] = np.take_along_axis(pad_item, best, axis=1)
+
+            pending = pending[~done]
+            radius *= 2.0
+
+        indices[np.isinf(distances)] = -1
+        return indices, distances
+
+    def neighbors_of_all(self, radius, exclude_same_id=True):
+        # radius query for every indexed item at once, for example all cells of all entities
+        exclude = self.ids if exclude_same_id else None
+        return self.query_radius(self.positions, radius, exclude)
@@ -0,0 +1,204 @@
+import atexit
+import glob
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+
+from common import *
+from cell_types import *
+from genome import genome_hash
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logging_setup()
+logger_telemetry = logging.getLogger(__name__)
+
+
+# Population telemetry of a run, for analysing evolution without parsing Simulation.log.
+# Every 'interval' seconds of simulation time one row goes into the "population" table (entity count,
+# cells per type, energy statistics, number of distinct genomes) and one row per entity into the
+# "entities" table (id, genome hash, cells, energy).
+# Rows are written into preallocated typed columns; full chunks are handed to a background thread which
+# writes every chunk to its own file, <table>_<chunk>.npz or .parquet (when pyarrow is installed).
+# Files are never rewritten, a run resumed into the same directory continues the chunk numbering.
+# This module must stay free of Panda3D, the simulation runs headless.
+
+population_columns = {
+    "tick": np.int64, "time": np.float64, "entities": np.int32, "cells": np.int32,
+    "energy_total": np.float64, "energy_mean": np.float64, "energy_min": np.float64, "energy_max": np.float64,
+    "distinct_genomes": np.int32,
+    **{f"cells_{name}": np.int32 for name in CELL_TYPE_NAMES},
+}
+
+entity_columns = {
+    "tick": np.int64, "entity_id": np.int64, "genome_hash": np.uint64, "cells": np.int32, "energy": np.float32,
+}
+
+
+def genome_hash64(genome):
+    # genome.genome_hash (the phenotype cache key) cut to 64 bits for the uint64 column, 0 without genome
+    if genome is None:
+        return 0
+    return int(genome_hash(genome)[:16], 16)
+
+
+class ColumnBuffer:
+    # preallocated typed columns, filled block by block; append() returns the chunks which became full
+
+    def __init__(self, columns, capacity):
+        self.columns = columns
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        self.arrays = {name: np.empty(self.capacity, dtype=dtype) for name, dtype in self.columns.items()}
+        self.rows = 0
+
+    def append(self, values):
+        # values: column name -> scalar or array, all arrays of the same length
+        count = max((len(v) for v in values.values() if np.ndim(v)), default=1)
+        full = []
+        done = 0
+        while done < count:
+            take = min(count - done, self.capacity - self.rows)
+            for name, value in values.items():
+                self.arrays[name][self.rows:self.rows + take] = value[done:done + take] if np.ndim(value) else value
+            self.rows += take
+            done += take
+            if self.rows == self.capacity:
+                full.append(self.take())
+        return full
+
+    def take(self):
+        # the filled rows as a chunk, the buffer starts over
+        chunk = {name: array[:self.rows] for name, array in self.arrays.items()}
+        self.reset()
+        return chunk
+
+
+class TelemetrySink:
+
+    def __init__(self, path, interval=1.0, chunk_rows=4096, file_format=None):
+        self.path = path
+        self.interval = interval                # seconds of simulation time between two samples
+        self.file_format = file_format or ("parquet" if pyarrow is not None else "npz")
+        if self.file_format == "parquet" and pyarrow is None:
+            raise ValueError("Parquet telemetry needs pyarrow.")
+        os.makedirs(path, exist_ok=True)
+
+        self.buffers = {"population": ColumnBuffer(population_columns, chunk_rows),
+                        "entities": ColumnBuffer(entity_columns, chunk_rows * 16)}
+        self.chunk_index = {table: self._existing_chunks(table) for table in self.buffers}
+        self.genome_hashes = {}                 # entity id -> genome hash, genomes never change
+        self.next_sample = None
+        self.samples = 0
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="telemetry_writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _existing_chunks(self, table):
+        return len(glob.glob(os.path.join(self.path, f"{table}_*.*")))
+
+    def maybe_sample(self, simulation):
+        # called every tick, samples once per interval
+        if self.next_sample is None or simulation.time >= self.next_sample - 1e-9:
+            self.sample(simulation)
+            self.next_sample = simulation.time + self.interval
+
+    def sample(self, simulation):
+        entities = simulation.entities
+        _, entity_index, type_ids = simulation.cell_columns()
+        energy = np.array([entity.energy for entity in entities], dtype=np.float64)
+        cells = np.bincount(entity_index, minlength=len(entities)).astype(np.int32)
+        per_type = np.bincount(type_ids, minlength=cell_type_count)
+
+        hashes = {}
+        for entity in entities:
+            cached = self.genome_hashes.get(entity.entity_id)
+            hashes[entity.entity_id] = cached if cached is not None else genome_hash64(entity.genome)
+        self.genome_hashes = hashes
+        hash_column = np.fromiter(hashes.values(), dtype=np.uint64, count=len(hashes))
+
+        row = {
+            "tick": simulation.tick, "time": simulation.time, "entities": len(entities), "cells": len(type_ids),
+            "energy_total": energy.sum(), "energy_mean": energy.mean() if len(energy) else 0.0,
+            "energy_min": energy.min() if len(energy) else 0.0,
+            "energy_max": energy.max() if len(energy) else 0.0,
+            "distinct_genomes": len(np.unique(hash_column)),
+            **{f"cells_{name}": per_type[type_id] for type_id, name in enumerate(CELL_TYPE_NAMES)},
+        }
+        self._queue_chunks("population", self.buffers["population"].append(row))
+        if entities:
+            self._queue_chunks("entities", self.buffers["entities"].append({
+                "tick": simulation.tick, "entity_id": np.array(list(hashes.keys()), dtype=np.int64),
+                "genome_hash": hash_column, "cells": cells, "energy": energy}))
+        self.samples += 1
+
+    def _queue_chunks(self, table, chunks):
+        for chunk in chunks:
+            self.queue.put((table, self.chunk_index[table], chunk))
+            self.chunk_index[table] += 1
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            table, index, chunk = item
+            try:
+                self._write_chunk(table, index, chunk)
+            except Exception:
+                logger_telemetry.exception(f"Writing telemetry chunk {index} of '{table}' failed.")
+            self.queue.task_done()
+
+    def _write_chunk(self, table, index, chunk):
+        base = os.path.join(self.path, f"{table}_{index:06d}")
+        if self.file_format == "parquet":
+            pyarrow.parquet.write_table(pyarrow.table(chunk), base + ".parquet")
+        else:
+            np.savez_compressed(base + ".npz", **chunk)
+
+    def flush(self):
+        # hands the partly filled buffers to the writer and waits until everything is on disk
+        for table, buffer in self.buffers.items():
+            if buffer.rows:
+                self._queue_chunks(table, [buffer.take()])
+        self.queue.join()
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+        atexit.unregister(self.close)
+        logger_telemetry.info(f"Wrote {self.samples} telemetry samples to {self.path}.")
+
+
+def read_telemetry(path, table="population"):
+    # all chunks of a table concatenated, column name -> array
+    files = sorted(glob.glob(os.path.join(path, f"{table}_*.npz")) + glob.glob(os.path.join(path, f"{table}_*.parquet")))
+    chunks = []
+    for file in files:
+        if file.endswith(".parquet"):
+            if pyarrow is None:
+                raise ValueError(f"Reading {file} needs pyarrow.")
+            parquet_table = pyarrow.parquet.read_table(file)
+            chunks.append({name: parquet_table.column(name).to_numpy() for name in parquet_table.column_names})
+        else:
+            with np.load(file) as data:
+                chunks.append(dict(data))
+    columns = population_columns if table == "population" else entity_columns
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.empty(0, dtype=dtype)
+            for name, dtype in columns.items()}
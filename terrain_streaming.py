@@ -0,0 +1,259 @@
+import atexit
+import logging
+import math
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+from common import *
+from chunk_mesher import *
+from perlin import perlin_chunk
+
+logging_setup()
+logger_streaming = logging.getLogger(__name__)
+
+
+# Terrain of unbounded size, streamed in square chunks of columns around a moving point (the camera).
+# - Chunks within load_radius (in chunks) are loaded, the nearest first and at most loads_per_update per
+#   update, so a fast camera costs a few chunks per frame and never a whole ring at once.
+# - Chunks beyond unload_radius are unloaded; the gap between the radii keeps a camera moving back and forth
+#   over a chunk border from loading and unloading the same chunks every frame.
+# - Loaded chunks are kept in LRU order. With max_bytes set, the least recently used chunks outside of
+#   load_radius are evicted to make room, and loading stops when only wanted chunks are left. An allow
+#   callback (MemoryTracker.allow in main.py) can refuse a load as well.
+# - A chunk is generated from Perlin noise (perlin.perlin_chunk, the same terrain as Perlin/heightmap.npy for
+#   the same seed and scale), or read from save_dir if it was modified before. Modified chunks are written to
+#   save_dir when they are evicted and when the program exits.
+# Column heights are stored per chunk, edited voxels as overrides like in heightfield.py.
+# This module must stay free of Panda3D, it is used by headless workers; world_geometry.StreamedTerrain
+# turns the chunks into scene-graph nodes.
+
+
+class TerrainChunk:
+
+    def __init__(self, coords, heights, overrides=None):
+        self.coords = coords                # (chunk x, chunk y)
+        self.heights = heights              # int16 top solid z per column, the column is solid from z=0
+        self.overrides = overrides or {}    # (x, y, z) world voxel -> True for added, False for removed voxels
+        self.modified = False               # overrides changed since the chunk was loaded or saved
+        self.dirty = True                   # the mesh is out of date
+        self.mesh_bytes = 0                 # size of the chunk's mesh, set by whoever builds it
+        self.node = None                    # scene-graph node, owned by the renderer
+
+    def storage_bytes(self):
+        per_override = sys.getsizeof((0, 0, 0)) if self.overrides else 0
+        return self.heights.nbytes + sys.getsizeof(self.overrides) + len(self.overrides) * per_override
+
+
+class ChunkStreamer:
+
+    def __init__(self, seed=42, chunk_size=32, max_height=10, noise_scale=0.05, load_radius=3.0, unload_radius=5.0,
+                 max_bytes=None, save_dir=None, loads_per_update=1):
+        if unload_radius < load_radius:
+            raise ValueError("Argument 'unload_radius' must not be smaller than 'load_radius'.")
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.max_height = max_height
+        self.noise_scale = noise_scale
+        self.load_radius = load_radius
+        self.unload_radius = unload_radius
+        self.max_bytes = max_bytes
+        self.save_dir = save_dir
+        self.loads_per_update = loads_per_update
+        # optional allow(extra_bytes) -> bool asked before every load, for example MemoryTracker.allow
+        self.allow = None
+
+        self.chunks = OrderedDict()         # (chunk x, chunk y) -> TerrainChunk, least recently used first
+        self.unloaded = []                  # chunks unloaded since the renderer last collected them
+        self.keep = set()                   # chunks within load_radius at the last update, never evicted
+        self.loads = 0
+        self.generated = 0
+        self.evictions = 0
+        self.saves = 0
+        if save_dir is not None:
+            os.makedirs(save_dir, exist_ok=True)
+            atexit.register(self.flush)
+
+    def chunk_of(self, x, y):
+        return (math.floor(x / self.chunk_size), math.floor(y / self.chunk_size))
+
+    def distance(self, coords, position):
+        # distance from a position to the center of a chunk, in chunks
+        center_x = (coords[0] + 0.5) * self.chunk_size
+        center_y = (coords[1] + 0.5) * self.chunk_size
+        return math.hypot(center_x - position[0], center_y - position[1]) / self.chunk_size
+
+    def wanted(self, position):
+        # coordinates of all chunks within load_radius of a position, nearest first
+        cx, cy = self.chunk_of(position[0], position[1])
+        reach = math.ceil(self.load_radius) + 1
+        candidates = [(self.distance((x, y), position), (x, y))
+                      for x in range(cx - reach, cx + reach + 1) for y in range(cy - reach, cy + reach + 1)]
+        return [coords for d, coords in sorted(candidates) if d <= self.load_radius]
+
+    def generate_heights(self, x0, y0, width, height):
+        # column heights of any area of the unbounded terrain, filled like VoxelMesh.generate_base_terrain
+        noise = perlin_chunk(self.seed, x0, y0, width, height, self.noise_scale)
+        return (noise * self.max_height).astype(np.int16)
+
+    def _path(self, coords):
+        return os.path.join(self.save_dir, f"chunk_{coords[0]}_{coords[1]}.npz")
+
+    def load(self, coords):
+        # reads a chunk saved before or generates it, and makes it the most recently used one
+        chunk = self.chunks.get(coords)
+        if chunk is not None:
+            self.chunks.move_to_end(coords)
+            return chunk
+
+        if self.save_dir is not None and os.path.exists(self._path(coords)):
+            with np.load(self._path(coords)) as data:
+                overrides = dict(zip(map(tuple, data["override_coords"].tolist()), data["override_values"].tolist()))
+                chunk = TerrainChunk(coords, data["heights"], overrides)
+        else:
+            x0, y0 = coords[0] * self.chunk_size, coords[1] * self.chunk_size
+            chunk = TerrainChunk(coords, self.generate_heights(x0, y0, self.chunk_size, self.chunk_size))
+            self.generated += 1
+        self.chunks[coords] = chunk
+        self.loads += 1
+        return chunk
+
+    def save(self, chunk):
+        coords = np.array(list(chunk.overrides.keys()), dtype=np.int64).reshape(-1, 3)
+        values = np.array(list(chunk.overrides.values()), dtype=bool)
+        np.savez(self._path(chunk.coords), heights=chunk.heights, override_coords=coords, override_values=values)
+        chunk.modified = False
+        self.saves += 1
+
+    def unload(self, coords):
+        chunk = self.chunks.pop(coords)
+        if chunk.modified:
+            if self.save_dir is not None:
+                self.save(chunk)
+            else:
+                logger_streaming.info(f"Chunk {coords} was modified but there is no save directory, edits are lost.")
+        self.unloaded.append(chunk)
+        return chunk
+
+    def flush(self):
+        # writes all modified chunks, for example when the program exits
+        if self.save_dir is None:
+            return
+        for chunk in self.chunks.values():
+            if chunk.modified:
+                self.save(chunk)
+
+    def bytes_used(self):
+        return sum(chunk.storage_bytes() + chunk.mesh_bytes for chunk in self.chunks.values())
+
+    def chunk_estimate(self):
+        # expected size of one more chunk: the mean of the loaded ones
+        if not self.chunks:
+            return 0
+        return self.bytes_used() // len(self.chunks)
+
+    def evict_bytes(self, excess_bytes):
+        # evicts least recently used chunks outside of load_radius until 'excess_bytes' are freed
+        # returns the bytes freed (usable as a MemoryTracker eviction callback)
+        freed = 0
+        for coords in list(self.chunks):
+            if freed >= excess_bytes:
+                break
+            if coords in self.keep:
+                continue
+            chunk = self.chunks[coords]
+            freed += chunk.storage_bytes() + chunk.mesh_bytes
+            self.unload(coords)
+            self.evictions += 1
+        return freed
+
+    def update(self, position):
+        # streams the chunks around a position (x, y, ...), returns the chunks loaded by this update;
+        # chunks which have to be (re)meshed are in dirty_chunks(), unloaded ones are collected from self.unloaded
+        wanted = self.wanted(position)
+        for coords in reversed(wanted):
+            if coords in self.chunks:
+                self.chunks.move_to_end(coords)
+
+        for coords in [c for c in self.chunks if self.distance(c, position) > self.unload_radius]:
+            self.unload(coords)
+
+        loaded = []
+        self.keep = set(wanted)
+        for coords in wanted:
+            if len(loaded) >= self.loads_per_update:
+                break
+            if coords in self.chunks:
+                continue
+            if self.max_bytes is not None:
+                excess = self.bytes_used() + self.chunk_estimate() - self.max_bytes
+                if excess > 0 and self.evict_bytes(excess) < excess:
+                    # only wanted chunks are left, the budget is full
+                    break
+            if self.allow is not None and not self.allow(self.chunk_estimate()):
+                break
+            loaded.append(self.load(coords))
+        return loaded
+
+    def dirty_chunks(self):
+        return [chunk for chunk in self.chunks.values() if chunk.dirty]
+
+    def set_voxel(self, x, y, z, solid):
+        # adds or removes a voxel, the chunk is loaded if needed and marked as modified;
+        # neighbor chunks sharing the border are re-meshed as well (their faces and shading depend on it)
+        x, y, z = int(x), int(y), int(z)
+        coords = self.chunk_of(x, y)
+        chunk = self.load(coords)
+        local_x, local_y = x - coords[0] * self.chunk_size, y - coords[1] * self.chunk_size
+        in_column = 0 <= z <= chunk.heights[local_x, local_y]
+        if solid == in_column:
+            chunk.overrides.pop((x, y, z), None)
+        else:
+            chunk.overrides[(x, y, z)] = bool(solid)
+        chunk.modified = True
+        chunk.dirty = True
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbor = self.chunks.get(self.chunk_of(x + dx, y + dy))
+                if neighbor is not None:
+                    neighbor.dirty = True
+
+    def region_occupancy(self, x0, y0, width, height):
+        # dense (grid, origin) of any area with the edits of loaded chunks, for meshing and for the sunlight map;
+        # loaded chunks give their stored heights and overrides, only columns of other chunks are generated
+        heights = np.empty((width, height), dtype=np.int16)
+        overrides = []
+        (first_x, first_y), (last_x, last_y) = self.chunk_of(x0, y0), self.chunk_of(x0 + width - 1, y0 + height - 1)
+        for chunk_x in range(first_x, last_x + 1):
+            for chunk_y in range(first_y, last_y + 1):
+                cx0, cy0 = chunk_x * self.chunk_size, chunk_y * self.chunk_size
+                ax0, ay0 = max(x0, cx0), max(y0, cy0)
+                ax1, ay1 = min(x0 + width, cx0 + self.chunk_size), min(y0 + height, cy0 + self.chunk_size)
+                chunk = self.chunks.get((chunk_x, chunk_y))
+                if chunk is None:
+                    heights[ax0 - x0:ax1 - x0, ay0 - y0:ay1 - y0] = self.generate_heights(ax0, ay0, ax1 - ax0,
+                                                                                          ay1 - ay0)
+                    continue
+                heights[ax0 - x0:ax1 - x0, ay0 - y0:ay1 - y0] = chunk.heights[ax0 - cx0:ax1 - cx0, ay0 - cy0:ay1 - cy0]
+                overrides += [(key, solid) for key, solid in chunk.overrides.items()
+                              if ax0 <= key[0] < ax1 and ay0 <= key[1] < ay1 and key[2] >= 0]
+        top = max([int(heights.max(initial=0))] + [key[2] for key, solid in overrides if solid])
+        grid = np.arange(top + 1)[None, None, :] <= heights[:, :, None]
+        for (x, y, z), solid in overrides:
+            grid[x - x0, y - y0, z] = solid
+        return grid, np.array([x0, y0, 0], dtype=np.int64)
+
+    def mesh(self, chunk, texture_coords=(4, 0), ambient_occlusion=True, skylight=False):
+        # vertex and index arrays of a chunk (see chunk_mesher.mesh_arrays) in world coordinates;
+        # the one voxel border comes from the neighbor columns, so faces and shading match across chunks
+        size = self.chunk_size
+        x0, y0 = chunk.coords[0] * size, chunk.coords[1] * size
+        grid, _ = self.region_occupancy(x0 - 1, y0 - 1, size + 2, size + 2)
+        # one empty layer below z=0 and above the highest voxel, so bottom faces and skylight are exact
+        padded = np.zeros((size + 2, size + 2, grid.shape[2] + 2), dtype=bool)
+        padded[:, :, 1:-1] = grid
+        arrays = mesh_arrays(padded, texture_coords, (x0, y0, 0), ambient_occlusion, skylight)
+        chunk.dirty = False
+        return arrays
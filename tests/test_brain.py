@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+
+from simulation import *
+
+
+def test_controller_is_resized_after_growth():
+    simulation = Simulation(master_seed=3)
+    entity = simulation.spawn_entity((0, 0, 10))
+    simulation.step()
+    before = simulation.brains.controllers[entity]
+    assert (before.n_inputs, before.n_hidden, before.n_outputs) == entity.brain_shape()
+
+    # a growth event which adds a muscle, an eye and a neural cell
+    kinds = iter(["Muscle", "Optic", "Neural"])
+    entity.grow = lambda: entity.add_cell(entity.base_cell, next(kinds))
+    for _ in range(3):
+        simulation.grow_entities(np.array([simulation.time]), np.array([entity.entity_id]), None)
+    simulation.step()
+
+    after = simulation.brains.controllers[entity]
+    assert (after.n_inputs, after.n_hidden, after.n_outputs) == entity.brain_shape()
+    assert after.n_outputs == before.n_outputs + 1
+    assert after.n_inputs == before.n_inputs + 1
+    assert len(entity.actuator_commands) == after.n_outputs
+    # the weights of the old body are kept
+    assert torch.equal(after.w1[:before.n_hidden, :before.n_inputs], before.w1)
+    assert torch.equal(after.w2[:before.n_outputs, :before.n_hidden], before.w2)
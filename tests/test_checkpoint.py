@@ -0,0 +1,40 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from occupancy import *
+from simulation import *
+
+
+def terrain():
+    heights = np.random.default_rng(0).uniform(0.2, 0.6, (24, 24))
+    heights[0, 0] = 1.0         # one column reaching up to z=6
+    return heightmap_occupancy(heights, 6)
+
+
+def test_resume_after_terrain_edit(tmp_path):
+    simulation = Simulation(master_seed=5)
+    simulation.spawn_entity((12, 12, 8))
+    simulation.set_terrain(terrain())
+    for _ in range(5):
+        simulation.step()
+    simulation.set_voxels([(3, 4, 0), (3, 5, 0)], False)
+    simulation.set_voxels([(10, 10, 5)], True)
+    path = simulation.save_checkpoint(str(tmp_path / "run.npz"))
+
+    resumed = Simulation.load_checkpoint(path)
+    assert resumed.terrain_edits == simulation.terrain_edits
+    # the caller generates the same terrain again, the edits are applied to it
+    resumed.set_terrain(terrain())
+    assert np.array_equal(resumed.light_map.occupancy, simulation.light_map.occupancy)
+    assert np.array_equal(resumed.light_map.sun_top, simulation.light_map.sun_top)
+    assert np.array_equal(resumed.raycaster.occupancy, simulation.raycaster.occupancy)
+
+    for _ in range(20):
+        simulation.step()
+        resumed.step()
+    assert [tuple(e.entity_pos) for e in resumed.entities] == [tuple(e.entity_pos) for e in simulation.entities]
+    assert [e.energy for e in resumed.entities] == [e.energy for e in simulation.entities]
@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from panda3d.core import LVector3
+
+from entity import *
+from locomotion import *
+
+
+def swimmer(entity_id, x):
+    entity = Entity(LVector3(x, 0, 10), (0, 0, 0), entity_id=entity_id, rng=np.random.default_rng(entity_id),
+                    headless=True)
+    for kind in ["Muscle", "Muscle", "Fin", "Bone"]:
+        entity.add_cell(entity.base_cell, kind)
+    entity.actuator_commands = np.array([0.0, 1.0, -1.0, 1.0], dtype=np.float32)
+    return entity
+
+
+def entity_slice(engine, i):
+    return slice(int(engine.starts[i]), int(engine.starts[i + 1]))
+
+
+def test_body_change_keeps_the_state_of_other_cells():
+    engine = LocomotionEngine(base_actuator_count)
+    a, b = swimmer(0, 0.0), swimmer(1, 20.0)
+    for _ in range(10):
+        engine.step([a, b], 1.0 / 30.0)
+
+    a_rows, b_rows = entity_slice(engine, 0), entity_slice(engine, 1)
+    a_position, a_velocity = engine.position[a_rows].copy(), engine.velocity[a_rows].copy()
+    b_position, b_velocity = engine.position[b_rows].copy(), engine.velocity[b_rows].copy()
+    b_plan = np.array([tuple(cell.pos) for cell in b.cells])
+    # the bodies are deformed and their cells move at different speeds
+    assert not np.allclose(b_position - b_plan, (b_position - b_plan).mean(axis=0))
+    assert not np.allclose(b_velocity, b_velocity.mean(axis=0))
+
+    # only a grows
+    a.add_cell(a.base_cell, "Muscle")
+    engine.sync([a, b])
+
+    b_rows = entity_slice(engine, 1)
+    assert np.array_equal(engine.position[b_rows], b_position)
+    assert np.array_equal(engine.velocity[b_rows], b_velocity)
+    a_rows = entity_slice(engine, 0)
+    assert a_rows.stop - a_rows.start == len(a_position) + 1
+    assert np.array_equal(engine.position[a_rows][:len(a_position)], a_position)
+    assert np.array_equal(engine.velocity[a_rows][:len(a_velocity)], a_velocity)
+    # the new cell starts on the body plan
+    assert np.allclose(engine.position[a_rows][-1], tuple(a.cells[-1].pos))
@@ -0,0 +1,57 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory_tracker import *
+
+
+def test_eviction_within_budget():
+    sizes = {"cache": 1000}
+    tracker = MemoryTracker()
+    tracker.register("cache", lambda: sizes["cache"])
+
+    def evict(excess_bytes):
+        sizes["cache"] -= excess_bytes
+    tracker.set_budget("cache", 600, evict)
+    assert tracker.check_budgets() == ["cache"]
+    assert sizes["cache"] == 600
+    assert not tracker.budgets["cache"].unmet
+    assert tracker.check_budgets() == []
+
+
+def test_budget_which_eviction_cannot_meet_is_reported():
+    # the eviction frees only part of the excess, the rest is still in use
+    sizes = {"cells": 1000}
+    tracker = MemoryTracker()
+    tracker.register("cells", lambda: sizes["cells"])
+
+    def evict(excess_bytes):
+        sizes["cells"] -= 100
+    tracker.set_budget("cells", 600, evict)
+    tracker.check_budgets()
+    assert tracker.budgets["cells"].unmet
+    assert "cannot be met" in tracker.format_report()
+
+    sizes["cells"] = 500
+    tracker.check_budgets()
+    assert not tracker.budgets["cells"].unmet
+
+
+def test_budget_checks_run_without_export():
+    sizes = {"cache": 1000}
+    tracker = MemoryTracker()
+    tracker.register("cache", lambda: sizes["cache"])
+    evicted = threading.Event()
+
+    def evict(excess_bytes):
+        sizes["cache"] -= excess_bytes
+        evicted.set()
+    tracker.set_budget("cache", 600, evict)
+    tracker.start_budget_checks(interval=0.01)
+    try:
+        assert evicted.wait(5.0)
+    finally:
+        tracker.stop_budget_checks()
+    assert tracker.export_file is None
@@ -0,0 +1,37 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+from nutrients import *
+
+
+@pytest.mark.parametrize("shape", [(32, 32), (20, 20, 20)])
+def test_default_field_is_stable(shape):
+    # the default diffusion rate must lie within the stability limit of 1 / (2 * ndim)
+    field = NutrientField(shape)
+    assert field.diffusion <= 1.0 / (2 * len(shape))
+
+    center = np.array([s // 2 for s in shape] + [0] * (3 - len(shape)))
+    field.deposit(center[None, :], 100.0)
+    for _ in range(50):
+        field.step()
+    assert field.values.min() >= 0
+    assert field.total() == pytest.approx(100.0, rel=1e-4)
+    assert field.values.max() < 100.0
+
+
+def test_unstable_diffusion_is_rejected():
+    with pytest.raises(ValueError):
+        NutrientField((8, 8, 8), diffusion=0.2)
+
+
+def test_default_3d_field_steps():
+    # a 3D field built without arguments must be stable and step without raising
+    field = NutrientField((16, 16, 16))
+    field.deposit(np.array([[8, 8, 8]]), 10.0)
+    field.step()
+    assert field.total() == pytest.approx(10.0, rel=1e-6)
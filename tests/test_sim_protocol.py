@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from sim_protocol import *
+from sim_server import SimulationServer
+
+
+class FakeCellType:
+    type_id = 1
+
+
+class FakeCell:
+    cell_type = FakeCellType()
+
+    def __init__(self, pos):
+        self.pos = pos
+
+
+class FakeEntity:
+
+    def __init__(self, entity_id, pos):
+        self.entity_id = entity_id
+        self.entity_pos = pos
+        self.entity_hpr = (0.0, 0.0, 0.0)
+        self.energy = 1.0
+        self.body_version = 0
+        self.cells = [FakeCell(pos)]
+
+
+class FakeSimulation:
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.tick = 0
+        self.tick_dt = 0.1
+        self.master_seed = 0
+        self.terrain_edits = {}
+
+    def take_voxel_changes(self):
+        return []
+
+
+class RecordingClient(SimulationClient):
+    # keeps the arrays of every entity update
+
+    def __init__(self, port):
+        super().__init__(port=port)
+        self.updates = []
+
+    def apply(self, kind, tick, arrays):
+        if kind == ENTITIES:
+            self.updates.append(arrays)
+        super().apply(kind, tick, arrays)
+
+
+def receive(server, client):
+    # steps the server once, returns the ids of the moved, turned and energy-changed rows the viewer got
+    server.simulation.tick += 1
+    server.send_updates()
+    count = len(client.updates)
+    deadline = time.time() + 5
+    while len(client.updates) == count and time.time() < deadline:
+        client.poll()
+    return [client.updates[-1][i].tolist() for i in (0, 2, 4)]
+
+
+def test_only_changed_rows_are_sent():
+    moving, resting = FakeEntity(3, (1.0, 2.0, 3.0)), FakeEntity(7, (5.0, 5.0, 5.0))
+    server = SimulationServer(FakeSimulation([resting, moving]), port=0)
+    client = RecordingClient(server.port)
+    try:
+        time.sleep(0.1)
+        server.accept()
+        server.send_updates()       # sends the hello
+        # the first update carries every row
+        assert receive(server, client) == [[3, 7], [3, 7], [3, 7]]
+
+        moving.entity_pos = (2.0, 2.0, 3.0)
+        resting.energy += energy_resolution / 2
+        assert receive(server, client) == [[3], [], []]
+        assert client.entities[3].previous_tick == 1 and client.entities[3].tick == 2
+        assert client.entities[3].hpr.tolist() == [0.0, 0.0, 0.0]
+
+        # nothing moved: the interpolation of the moved entity starts where the last update left it
+        resting.energy += energy_resolution
+        assert receive(server, client) == [[], [], [7]]
+        moving.entity_pos = (3.0, 2.0, 3.0)
+        moving.entity_hpr = (90.0, 0.0, 0.0)
+        assert receive(server, client) == [[3], [3], []]
+        entity = client.entities[3]
+        assert entity.previous_tick == 3 and entity.tick == 4
+        pos, hpr = entity.interpolated(3.5)
+        assert np.allclose(pos, (2.5, 2.0, 3.0)) and np.allclose(hpr, (45.0, 0.0, 0.0))
+        assert client.entities[7].energy == np.float32(1.0 + energy_resolution * 1.5)
+    finally:
+        client.sock.close()
+        server.close()
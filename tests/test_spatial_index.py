@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from spatial_index import *
+
+
+def brute_knn(positions, points, k):
+    dist = np.linalg.norm(points[:, None, :] - positions[None, :, :], axis=-1)
+    order = np.argsort(dist, axis=1, kind="stable")[:, :k]
+    return order, np.take_along_axis(dist, order, axis=1)
+
+
+def test_knn_sparse_far_apart_points():
+    # the search radius grows to the whole extent, which must not walk every grid cell in between
+    grid = SpatialHashGrid(cell_size=1.0)
+    positions = np.array([[0.0, 0.0, 0.0], [60.0, 0.0, 0.0]])
+    grid.build(positions)
+    indices, distances = grid.query_knn(positions, 2)
+    assert indices.tolist() == [[0, 1], [1, 0]]
+    assert np.allclose(distances, [[0.0, 60.0], [0.0, 60.0]])
+
+
+def test_radius_sparse_matches_brute_force():
+    rng = np.random.default_rng(0)
+    grid = SpatialHashGrid(cell_size=0.5)
+    positions = rng.uniform(-500, 500, (20, 3))
+    grid.build(positions)
+    points = rng.uniform(-500, 500, (5, 3))
+    offsets, items, dist = grid.query_radius(points, 400.0)
+    for q, point in enumerate(points):
+        expected = np.flatnonzero(np.linalg.norm(positions - point, axis=1) <= 400.0)
+        assert sorted(items[offsets[q]:offsets[q + 1]].tolist()) == expected.tolist()
+
+    indices, distances = grid.query_knn(points, 3)
+    expected_indices, expected_distances = brute_knn(positions, points, 3)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(distances, expected_distances)
+
+
+def test_knn_dense_matches_brute_force():
+    rng = np.random.default_rng(1)
+    grid = SpatialHashGrid(cell_size=1.0)
+    positions = rng.uniform(0, 10, (2000, 3))
+    grid.build(positions)
+    points = rng.uniform(0, 10, (50, 3))
+    indices, distances = grid.query_knn(points, 5)
+    expected_indices, expected_distances = brute_knn(positions, points, 5)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(distances, expected_distances)
+
+
+def test_mixed_radii_match_brute_force(monkeypatch):
+    # one huge query must neither make the small ones walk its grid cells nor change their results,
+    # also when the queries are looked up in many small chunks
+    import spatial_index
+    monkeypatch.setattr(spatial_index, "chunk_elements", 64)
+    rng = np.random.default_rng(2)
+    grid = SpatialHashGrid(cell_size=1.0)
+    positions = rng.uniform(0, 20, (300, 3))
+    grid.build(positions)
+    points = rng.uniform(0, 20, (40, 3))
+    radius = rng.choice([0.5, 1.5, 3.0, 500.0], len(points))
+    offsets, items, dist = grid.query_radius(points, radius)
+    for q, point in enumerate(points):
+        expected = np.flatnonzero(np.linalg.norm(positions - point, axis=1) <= radius[q])
+        assert sorted(items[offsets[q]:offsets[q + 1]].tolist()) == expected.tolist()
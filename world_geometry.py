@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 from math import cos, sin, pi
 
 import numpy as np
@@ -10,10 +11,15 @@ from panda3d.core import (
     GeomVertexWriter, GeomTriangles, GeomNode, 
     LVector3, LColor, DirectionalLight, AmbientLight, 
     WindowProperties, ClockObject, Loader, loadPrcFileData,
-    SamplerState, Texture
+    SamplerState, Texture, GeomVertexArrayFormat, InternalName,
+    BoundingBox, LPoint3, Shader
 )
 
 from common import *
+from occupancy import *
+from chunk_mesher import *
+from heightfield import *
+from memory_tracker import voxel_map_bytes, geom_node_bytes
 
 logger_geometry = logging.getLogger(__name__)
 
@@ -108,11 +114,113 @@ class Voxel:
 
 
 
+# vertex formats of vectorized terrain meshes (see chunk_mesher.py),
+# with baked lighting a uint8 color column is added which modulates texture and lights
+_terrain_array_format = GeomVertexArrayFormat()
+_terrain_array_format.addColumn(InternalName.getVertex(), 3, Geom.NT_float32, Geom.C_point)
+_terrain_array_format.addColumn(InternalName.getNormal(), 3, Geom.NT_float32, Geom.C_normal)
+_terrain_array_format.addColumn(InternalName.getTexcoord(), 2, Geom.NT_float32, Geom.C_texcoord)
+_lit_terrain_array_format = GeomVertexArrayFormat(_terrain_array_format)
+_lit_terrain_array_format.addColumn(InternalName.getColor(), 4, Geom.NT_uint8, Geom.C_color)
+
+terrain_vertex_format = GeomVertexFormat.registerFormat(GeomVertexFormat(_terrain_array_format))
+lit_terrain_vertex_format = GeomVertexFormat.registerFormat(GeomVertexFormat(_lit_terrain_array_format))
+
+
+def _vertex_dtype(array_format, names):
+    formats = {"vertex": (np.float32, 3), "normal": (np.float32, 3), "texcoord": (np.float32, 2), "color": (np.uint8, 4)}
+    return np.dtype({
+        "names": names,
+        "formats": [formats[name] for name in names],
+        "offsets": [array_format.getColumn(name).getStart() for name in names],
+        "itemsize": array_format.getStride()})
+
+
+terrain_vertex_dtype = _vertex_dtype(_terrain_array_format, ["vertex", "normal", "texcoord"])
+lit_terrain_vertex_dtype = _vertex_dtype(_lit_terrain_array_format, ["vertex", "normal", "texcoord", "color"])
+
+
+def build_terrain_node(arrays, name="terrain_node"):
+    # GeomNode from the arrays of chunk_mesher.mesh_arrays, written in one copy per array
+    lit = arrays["color"] is not None
+    vertices = np.empty(len(arrays["vertex"]), dtype=lit_terrain_vertex_dtype if lit else terrain_vertex_dtype)
+    for column in vertices.dtype.names:
+        vertices[column] = arrays[column]
+
+    vdata = GeomVertexData(name, lit_terrain_vertex_format if lit else terrain_vertex_format, Geom.UHStatic)
+    vdata.uncleanSetNumRows(len(vertices))
+    memoryview(vdata.modifyArray(0)).cast('B')[:] = vertices.tobytes()
+
+    tris = GeomTriangles(Geom.UHStatic)
+    tris.setIndexType(Geom.NT_uint32)
+    index_array = tris.modifyVertices()
+    index_array.uncleanSetNumRows(len(arrays["index"]))
+    memoryview(index_array).cast('B')[:] = arrays["index"].tobytes()
+
+    geom = Geom(vdata)
+    geom.addPrimitive(tris)
+    node = GeomNode(name)
+    node.addGeom(geom)
+    return node
+
+
+# compact terrain vertex format (see chunk_mesher.compact_vertices), 8 bytes per vertex
+# it can only be drawn with the decoding shader in Shaders/, renderers without shader support use the formats above
+_compact_array_format = GeomVertexArrayFormat()
+_compact_array_format.addColumn(InternalName.make("compact_position"), 4, Geom.NT_uint8, Geom.C_other)
+_compact_array_format.addColumn(InternalName.make("compact_attribute"), 4, Geom.NT_uint8, Geom.C_other)
+compact_terrain_vertex_format = GeomVertexFormat.registerFormat(GeomVertexFormat(_compact_array_format))
+
+
+def build_compact_terrain_node(arrays, texture_coords, name="terrain_node"):
+    # GeomNode in the compact format, returns the node and the origin the node has to be placed at
+    vertex = arrays["vertex"]
+    origin = np.floor(vertex.min(axis=0)) if len(vertex) else np.zeros(3, dtype=np.float32)
+    vertices = compact_vertices(arrays, origin, texture_coords)
+
+    vdata = GeomVertexData(name, compact_terrain_vertex_format, Geom.UHStatic)
+    vdata.uncleanSetNumRows(len(vertices))
+    memoryview(vdata.modifyArray(0)).cast('B')[:] = vertices.tobytes()
+
+    tris = GeomTriangles(Geom.UHStatic)
+    tris.setIndexType(Geom.NT_uint32)
+    index_array = tris.modifyVertices()
+    index_array.uncleanSetNumRows(len(arrays["index"]))
+    memoryview(index_array).cast('B')[:] = arrays["index"].tobytes()
+
+    geom = Geom(vdata)
+    geom.addPrimitive(tris)
+    # there is no 'vertex' column Panda3D could compute bounds from
+    if len(vertex):
+        geom.setBounds(BoundingBox(LPoint3(*(vertex.min(axis=0) - origin)), LPoint3(*(vertex.max(axis=0) - origin))))
+    node = GeomNode(name)
+    node.addGeom(geom)
+    return node, LVector3(*origin)
+
+
+def load_compact_terrain_shader():
+    return Shader.load(Shader.SL_GLSL, vertex="Shaders/compact_terrain.vert", fragment="Shaders/compact_terrain.frag")
+
+
 # This is the object which holds joint voxels (for example a landscape) in an efficient way
 class VoxelMesh:
-    def __init__(self, base_voxel_object):
+    def __init__(self, base_voxel_object, ambient_occlusion=True, skylight=False, heightfield=True, compact=False):
         self.base_voxel_object = base_voxel_object 
 
+        # compact vertices need the decoding shader, the node then has to be placed at node_origin
+        self.compact = compact
+        self.node_origin = LVector3(0, 0, 0)
+
+        # heightmap terrain is stored as column heights plus explicit override voxels (see heightfield.py)
+        # instead of one voxel-map entry per voxel
+        self.use_heightfield = heightfield
+        self.heightfield = None
+
+        # lighting baked into vertex colors by the vectorized mesher
+        self.ambient_occlusion = ambient_occlusion
+        self.skylight = skylight
+        self.build_stats = None
+
         self.format = GeomVertexFormat.getV3n3t2()
         self.vdata = GeomVertexData('map_data', self.format, Geom.UHStatic)
 
@@ -122,6 +230,10 @@ class VoxelMesh:
         self.tris = GeomTriangles(Geom.UHStatic)
         self.texcoord = GeomVertexWriter(self.vdata, 'texcoord')
 
+        # kept for memory accounting (see memory_tracker.py)
+        self.voxel_map = {}
+        self.node = None
+
     def generate_base_terrain(self, x_size, y_size, max_height):
         # Loading Perlin noise
         try:
@@ -130,9 +242,12 @@ class VoxelMesh:
             print("Run perlin.py first!")
             return None
 
+        if self.use_heightfield:
+            return self.generate_heightfield_terrain(h_data, x_size, y_size, max_height)
+
         # We use a dictionary where every key is a tuple (x, y, z) and values are the Voxel objects
         # This "voxel-map" is used to not render faces that are between two voxels
-        voxel_map = {}
+        voxel_map = self.voxel_map
 
         logger_geometry.debug("Generating Voxel-Map.")
         for x in range(x_size):
@@ -168,23 +283,142 @@ class VoxelMesh:
         
         logger_geometry.debug("Voxel-map successfully generated.")
 
-        for pos, voxel_obj in voxel_map.items():
-            vx, vy, vz = pos
-
-            # generating the voxel geometry
-            # generate_embedded only generates faces if they are not between voxels
-            voxel_obj.generate_embedded(
-                vx, vy, vz,
-                self.vertex, self.normal, self.texcoord,
-                self.tris, self.vdata,
-                voxel_map
-            )                
-        # Create node 
-        self.tris.closePrimitive()
-        geom = Geom(self.vdata)
-        geom.addPrimitive(self.tris)
-        node = GeomNode('terrain_node')
-        node.addGeom(geom)
+        self.node = self.mesh_voxel_map()
+        return self.node
+
+    def generate_heightfield_terrain(self, h_data, x_size, y_size, max_height):
+        # same terrain as the voxel-map path, but only the floating form and the hole are stored as voxels
+        terrain = HeightfieldTerrain.from_heightmap(h_data, x_size, y_size, max_height)
+
+        # Creating test-form floating in sky
+        for pos in [(50, 50, 50), (51, 50, 50), (52, 50, 50), (52, 50, 51), (52, 50, 52)]:
+            terrain.set_voxel(*pos, True)
+
+        # Drilling a deep hole underneath floating form
+        for drillpos in range(30):
+            terrain.set_voxel(50, 50, drillpos, False)
+        self.heightfield = terrain
+
+        arrays = terrain.mesh(self.base_voxel_object.texture_coords, self.ambient_occlusion, self.skylight)
+        self.node = self.build_node(arrays)
+        return self.node
+
+    def set_voxels(self, coords, solid):
+        # terrain edits (for example streamed by the simulation server), the terrain is meshed again
+        # returns the new node
+        for (x, y, z), value in zip(np.asarray(coords).reshape(-1, 3).tolist(), np.asarray(solid).reshape(-1).tolist()):
+            if self.heightfield is not None:
+                self.heightfield.set_voxel(x, y, z, value)
+            elif value:
+                self.voxel_map[(x, y, z)] = self.base_voxel_object
+            else:
+                self.voxel_map.pop((x, y, z), None)
+
+        if self.heightfield is not None:
+            arrays = self.heightfield.mesh(self.base_voxel_object.texture_coords, self.ambient_occlusion, self.skylight)
+            self.node = self.build_node(arrays)
+        else:
+            self.node = self.mesh_voxel_map()
+        return self.node
+
+    def occupancy(self):
+        # dense (grid, origin) of the terrain, whichever way it is stored
+        if self.heightfield is not None:
+            return self.heightfield.occupancy()
+        return occupancy_from_voxel_map(self.voxel_map)
+
+    def storage_bytes(self):
+        if self.heightfield is not None:
+            return self.heightfield.storage_bytes()
+        return voxel_map_bytes(self.voxel_map)
+
+    def mesh_voxel_map(self):
+        # meshes the whole voxel map at once with the vectorized mesher, faces between voxels are culled
+        # like in Voxel.generate_embedded, ambient occlusion and skylight are baked into vertex colors
+        occupancy, origin = occupancy_from_voxel_map(self.voxel_map)
+        arrays = mesh_arrays(pad_occupancy(occupancy), self.base_voxel_object.texture_coords, origin,
+                             self.ambient_occlusion, self.skylight)
+        return self.build_node(arrays)
+
+    def build_node(self, arrays):
+        start = time.perf_counter()
+        node = None
+        if self.compact:
+            try:
+                node, self.node_origin = build_compact_terrain_node(arrays, self.base_voxel_object.texture_coords)
+            except ValueError as error:
+                logger_geometry.info(f"{error} Using the standard vertex format.")
+                self.compact = False
+        if node is None:
+            node = build_terrain_node(arrays)
+        self.build_stats = dict(arrays["stats"], geom_seconds=time.perf_counter() - start,
+                                node_vertex_bytes=node.getGeom(0).getVertexData().getArray(0).getDataSizeBytes())
+        stats = self.build_stats
+        logger_geometry.info(
+            f"Meshed {stats['faces']} faces in {stats['face_seconds'] * 1000:.1f} ms, "
+            f"baked lighting {stats['light_seconds'] * 1000:.1f} ms, "
+            f"{stats['vertex_bytes']} vertex bytes of which {stats['color_bytes']} are baked colors, "
+            f"{stats['node_vertex_bytes']} bytes in the {'compact' if self.compact else 'standard'} format.")
         return node
 
 
+
+
+# Terrain streamed in chunks around the camera (see terrain_streaming.py), one GeomNode per chunk below 'root'.
+# Chunk meshes are built when a chunk is loaded or edited and removed from the scene graph when it is unloaded.
+class StreamedTerrain:
+    def __init__(self, streamer, parent, base_voxel_object, ambient_occlusion=True, skylight=False, compact=False):
+        self.streamer = streamer
+        self.base_voxel_object = base_voxel_object
+        self.ambient_occlusion = ambient_occlusion
+        self.skylight = skylight
+        self.compact = compact
+        self.root = parent.attachNewNode("streamed_terrain")
+        self.meshed = 0
+
+    def update(self, position):
+        # streams the chunks around a position, returns the number of chunk meshes built
+        self.streamer.update(position)
+        for chunk in self.streamer.unloaded:
+            if chunk.node is not None:
+                chunk.node.removeNode()
+                chunk.node = None
+        self.streamer.unloaded.clear()
+
+        dirty = self.streamer.dirty_chunks()
+        for chunk in dirty:
+            self.build_chunk(chunk)
+        return len(dirty)
+
+    def fill(self, position):
+        # loads every chunk within the load radius at once (at startup), as far as the memory cap allows
+        while self.update(position):
+            pass
+
+    def build_chunk(self, chunk):
+        arrays = self.streamer.mesh(chunk, self.base_voxel_object.texture_coords, self.ambient_occlusion, self.skylight)
+        name = f"terrain_chunk_{chunk.coords[0]}_{chunk.coords[1]}"
+        origin = LVector3(0, 0, 0)
+        node = None
+        if self.compact:
+            try:
+                node, origin = build_compact_terrain_node(arrays, self.base_voxel_object.texture_coords, name)
+            except ValueError as error:
+                logger_geometry.info(f"{error} Using the standard vertex format for chunk {chunk.coords}.")
+        standard = node is None
+        if standard:
+            node = build_terrain_node(arrays, name)
+
+        if chunk.node is not None:
+            chunk.node.removeNode()
+        chunk.node = self.root.attachNewNode(node)
+        chunk.node.setPos(origin)
+        if self.compact and standard:
+            # the compact decoding shader sits on the root, a chunk in the standard format is drawn without it
+            chunk.node.setShaderOff()
+        chunk.mesh_bytes = geom_node_bytes(node)
+        self.meshed += 1
+
+    def set_voxel(self, x, y, z, solid):
+        # terrain edit, the affected chunks are re-meshed by the next update
+        self.streamer.set_voxel(x, y, z, solid)